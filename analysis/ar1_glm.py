@@ -0,0 +1,254 @@
+"""A batched AR(1) GLM fit that gives the same results as nilearn's ``run_glm``.
+
+nilearn fits an OLS model, estimates each voxel's AR(1) coefficient from the residuals,
+truncates the coefficients to ``1 / bins`` steps, and refits each bin with its own
+whitened design. Most of that time goes to per-voxel Python loops (quantizing and
+labeling the coefficients) and to masking the whole data matrix once per bin.
+
+Here every step is done for all voxels at once:
+
+-   The OLS fit and the Yule-Walker estimates are single matrix products.
+-   Quantizing and labeling the coefficients is vectorized, with the same labels.
+-   The AR(1) whitening matrix is lower bidiagonal Toeplitz, so the data are whitened
+    for every voxel at once with one shifted subtraction, using each voxel's own
+    (quantized) coefficient.
+-   Each bin's whitened design is factorized (pseudo-inverted) once, and the voxels
+    are sorted by bin once, so each bin is a contiguous block instead of a mask.
+
+:func:`patch_nilearn_run_glm` makes ``FirstLevelModel`` use it, so models, contrasts,
+and ``save_glm_to_bids`` work as before.
+"""
+
+import argparse
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from nilearn.glm.contrasts import compute_contrast
+from nilearn.glm.first_level import first_level as nilearn_first_level
+from nilearn.glm.regression import ARModel, RegressionResults
+from scipy import linalg
+
+
+def ar1_coefficients(residuals):
+    """Estimate each voxel's AR(1) coefficient as nilearn's ``_yule_walker`` does.
+
+    Parameters
+    ----------
+    residuals : (T x V) :obj:`numpy.ndarray`
+        OLS residuals.
+
+    Returns
+    -------
+    rho : (V,) :obj:`numpy.ndarray`
+    """
+    n_vols = residuals.shape[0]
+    # nilearn demeans with the mean over all voxels and time points
+    centered = residuals - residuals.mean()
+    r0 = np.einsum("tv,tv->v", centered, centered) / n_vols
+    r1 = np.einsum("tv,tv->v", centered[:-1], centered[1:]) / (n_vols - 1)
+    return r1 / r0
+
+
+def quantize_ar1(rho, bins=100):
+    """Truncate AR(1) coefficients to ``1 / bins`` steps and label them as nilearn does.
+
+    Returns
+    -------
+    labels : (V,) :obj:`numpy.ndarray` of :obj:`str`
+        Each voxel's bin, named after its quantized coefficient.
+    bin_rho : (B,) :obj:`numpy.ndarray`
+        Each bin's quantized coefficient.
+    bin_idx : (V,) :obj:`numpy.ndarray`
+        Each voxel's bin index.
+    """
+    rho = (rho * bins).astype(int) * 1.0 / bins
+    bin_rho, bin_idx = np.unique(rho, return_inverse=True)
+    bin_labels = np.array([str(val) for val in bin_rho])
+    return bin_labels[bin_idx], bin_rho, bin_idx
+
+
+def run_glm_ar1(Y, X, noise_model="ar1", bins=100, n_jobs=1, verbose=0, random_state=None):
+    """Fit an AR(1) GLM to every voxel, as nilearn's ``run_glm`` does.
+
+    Takes the same arguments and returns the same labels and results as ``run_glm``.
+    Only ``noise_model="ar1"`` is batched; anything else goes to nilearn.
+    """
+    if noise_model != "ar1":
+        return _nilearn_run_glm(
+            Y,
+            X,
+            noise_model=noise_model,
+            bins=bins,
+            n_jobs=n_jobs,
+            verbose=verbose,
+            random_state=random_state,
+        )
+
+    if Y.shape[0] != X.shape[0]:
+        raise ValueError(f"Y {Y.shape} and X {X.shape} don't have the same number of rows")
+
+    Y = np.asarray(Y, dtype=np.float64)
+    X = np.asarray(X, dtype=np.float64)
+    residuals = Y - X @ (linalg.pinv(X) @ Y)
+    labels, bin_rho, bin_idx = quantize_ar1(ar1_coefficients(residuals), bins=bins)
+    del residuals
+
+    # Sort the voxels by bin once, so each bin is a contiguous block of columns
+    order = np.argsort(bin_idx, kind="stable")
+    bin_starts = np.searchsorted(bin_idx[order], np.arange(bin_rho.size + 1))
+    Y = Y[:, order]
+
+    # Whiten all voxels at once: wY[t] = Y[t] - rho * Y[t - 1]
+    voxel_rho = bin_rho[bin_idx[order]]
+    wY = Y.copy()
+    wY[1:] -= voxel_rho * Y[:-1]
+
+    results = {}
+    for i_bin, rho in enumerate(bin_rho):
+        voxels = slice(bin_starts[i_bin], bin_starts[i_bin + 1])
+        # One factorization of the bin's whitened design
+        model = ARModel(X, rho)
+        beta = model.calc_beta @ wY[:, voxels]
+        wresid = wY[:, voxels] - model.whitened_design @ beta
+        dispersion = np.sum(wresid**2, 0) / (X.shape[0] - X.shape[1])
+        results[labels[order[bin_starts[i_bin]]]] = RegressionResults(
+            beta,
+            Y[:, voxels],
+            model,
+            wY[:, voxels],
+            wresid,
+            dispersion=dispersion,
+            cov=model.normalized_cov_beta,
+        )
+
+    return labels, results
+
+
+_nilearn_run_glm = nilearn_first_level.run_glm
+
+
+@contextmanager
+def patch_nilearn_run_glm():
+    """Make nilearn's ``FirstLevelModel`` fit with :func:`run_glm_ar1`."""
+    nilearn_first_level.run_glm = run_glm_ar1
+    try:
+        yield
+    finally:
+        nilearn_first_level.run_glm = _nilearn_run_glm
+
+
+def _simulate(n_voxels, n_vols, n_regressors=10, seed=0):
+    """Simulate voxels with AR(1) noise of varying strength and a random design."""
+    rng = np.random.default_rng(seed)
+    X = np.column_stack((rng.normal(size=(n_vols, n_regressors - 1)), np.ones(n_vols)))
+    rho = rng.uniform(-0.3, 0.6, n_voxels)
+    noise = rng.normal(size=(n_vols, n_voxels))
+    for t in range(1, n_vols):
+        noise[t] += rho * noise[t - 1]
+    Y = X @ rng.normal(size=(n_regressors, n_voxels)) + noise
+    return Y, X
+
+
+def _load_run(bold_file, mask_file, design_file):
+    """Load a run's data as FirstLevelModel would, with its saved design matrix."""
+    import pandas as pd
+    from nilearn.glm.first_level.first_level import mean_scaling
+    from nilearn.maskers import NiftiMasker
+
+    Y = NiftiMasker(mask_file, smoothing_fwhm=5).fit_transform(bold_file)
+    Y, _ = mean_scaling(Y)
+    X = pd.read_table(design_file).to_numpy()
+    return Y, X
+
+
+def benchmark(
+    n_voxels=50000,
+    n_vols=150,
+    bold_file=None,
+    mask_file=None,
+    design_file=None,
+    rtol=1e-6,
+    atol=1e-10,
+):
+    """Time nilearn's AR(1) fit against the batched fit and check that they agree.
+
+    Raises
+    ------
+    AssertionError
+        If the AR(1) bins differ, or the betas, residual variances, or t values of a
+        contrast of the first regressor differ by more than `rtol` and `atol`.
+    """
+    if bold_file is None:
+        Y, X = _simulate(n_voxels, n_vols)
+    else:
+        Y, X = _load_run(bold_file, mask_file, design_file)
+
+    start = time.time()
+    labels_ref, results_ref = _nilearn_run_glm(Y, X, noise_model="ar1")
+    nilearn_seconds = time.time() - start
+
+    start = time.time()
+    labels, results = run_glm_ar1(Y, X)
+    batched_seconds = time.time() - start
+
+    np.testing.assert_array_equal(labels, labels_ref, err_msg="AR(1) bins differ")
+    assert sorted(results) == sorted(results_ref), "AR(1) bins differ"
+
+    beta_diff = dispersion_diff = 0
+    for label, result in results.items():
+        result_ref = results_ref[label]
+        beta_diff = max(beta_diff, np.abs(result.theta - result_ref.theta).max())
+        dispersion_rel = np.abs(result.dispersion / result_ref.dispersion - 1)
+        dispersion_diff = max(dispersion_diff, dispersion_rel.max())
+        np.testing.assert_allclose(
+            result.theta, result_ref.theta, rtol=rtol, atol=atol, err_msg="Betas differ"
+        )
+        np.testing.assert_allclose(
+            result.dispersion,
+            result_ref.dispersion,
+            rtol=rtol,
+            err_msg="Residual variances differ",
+        )
+
+    con_val = np.eye(X.shape[1])[0]
+    t_values = compute_contrast(labels, results, con_val, "t").stat()
+    t_values_ref = compute_contrast(labels_ref, results_ref, con_val, "t").stat()
+
+    print(f"{Y.shape[1]} voxels, {Y.shape[0]} volumes, {X.shape[1]} regressors")
+    print(f"\t{len(results)} AR(1) bins")
+    print(f"\tnilearn: {nilearn_seconds:.2f}s")
+    print(f"\tbatched: {batched_seconds:.2f}s ({nilearn_seconds / batched_seconds:.1f}x)")
+    print(f"\tMax absolute difference in betas: {beta_diff:.2e}")
+    print(f"\tMax relative difference in residual variance: {dispersion_diff:.2e}")
+    print(f"\tMax absolute difference in t values: {np.abs(t_values - t_values_ref).max():.2e}")
+    np.testing.assert_allclose(
+        t_values, t_values_ref, rtol=rtol, atol=atol, err_msg="Contrast t values differ"
+    )
+    return beta_diff, dispersion_diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmark the batched AR(1) GLM against nilearn's, on simulated data or on a "
+            "run (preprocessed BOLD, brain mask, and the design.tsv save_glm_to_bids wrote)."
+        )
+    )
+    parser.add_argument("--n-voxels", type=int, default=50000)
+    parser.add_argument("--n-vols", type=int, default=150)
+    parser.add_argument("--bold-file")
+    parser.add_argument("--mask-file")
+    parser.add_argument("--design-file")
+    parser.add_argument("--rtol", type=float, default=1e-6)
+    parser.add_argument("--atol", type=float, default=1e-10)
+    args = parser.parse_args()
+    benchmark(
+        n_voxels=args.n_voxels,
+        n_vols=args.n_vols,
+        bold_file=args.bold_file,
+        mask_file=args.mask_file,
+        design_file=args.design_file,
+        rtol=args.rtol,
+        atol=args.atol,
+    )
@@ -0,0 +1,271 @@
+"""Store first-level GLM sufficient statistics and compute contrasts from them.
+
+Every contrast nilearn computes from a fitted first-level model only needs, per voxel,
+the parameter estimates, the residual variance, and which AR(1) coefficient bin the
+voxel was whitened with, plus each bin's (whitened) design covariance and the residual
+degrees of freedom. Saving those after each fit lets any t or F contrast be computed
+later without the BOLD data or a refit.
+
+Each run's statistics go in a ``{prefix}_desc-glmstats`` directory, next to the
+``save_glm_to_bids`` outputs:
+
+-   ``betas.npy``: (voxels x regressors) float32 parameter estimates.
+-   ``dispersion.npy``: (voxels,) float32 residual variance.
+-   ``labels.npy``: (voxels,) index of each voxel's AR coefficient bin.
+-   ``covariances.npy``: (bins x regressors x regressors) float32 design covariance.
+-   ``mask.nii.gz``: the model's mask, which defines the voxel order.
+-   ``stats.json``: regressor names, AR coefficients, and residual degrees of freedom.
+
+The arrays are plain ``.npy`` files, so they can be memory-mapped.
+
+Run this file to compute contrasts for every run under a first-level derivatives
+directory. The maps are named as ``save_glm_to_bids`` names them.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+
+import numpy as np
+from nilearn.glm import expression_to_contrast_vector
+from nilearn.glm.contrasts import Contrast
+from nilearn.interfaces.bids.glm import _clean_contrast_name
+from nilearn.masking import unmask
+from scipy.linalg import sqrtm
+
+sys.path.append("..")
+from processing.parallel_gzip import save_img
+
+STATS_FILES = ["betas", "dispersion", "labels", "covariances"]
+
+
+def save_sufficient_stats(model, out_dir, prefix):
+    """Save a fitted single-run FirstLevelModel's sufficient statistics.
+
+    Parameters
+    ----------
+    model : :obj:`nilearn.glm.first_level.FirstLevelModel`
+        A model fit to one run, with ``minimize_memory`` either way.
+    out_dir : :obj:`str`
+        Directory to write the ``{prefix}_desc-glmstats`` directory in.
+    prefix : :obj:`str`
+        The run's output prefix.
+
+    Returns
+    -------
+    stats_dir : :obj:`str`
+        The statistics directory.
+    """
+    labels = model.labels_[0]
+    results = model.results_[0]
+    # nilearn keys the results by each bin's AR coefficient, as a string
+    ar_coefs = np.array(sorted(results))
+    label_idx = np.searchsorted(ar_coefs, labels).astype(np.int16)
+    regressors = model.design_matrices_[0].columns.tolist()
+
+    betas = np.zeros((labels.size, len(regressors)), dtype=np.float32)
+    dispersion = np.zeros(labels.size, dtype=np.float32)
+    covariances = np.zeros((ar_coefs.size, len(regressors), len(regressors)), dtype=np.float32)
+    for i_label, ar_coef in enumerate(ar_coefs):
+        label_mask = label_idx == i_label
+        betas[label_mask] = results[ar_coef].theta.T
+        dispersion[label_mask] = results[ar_coef].dispersion
+        covariances[i_label] = results[ar_coef].cov
+
+    stats_dir = os.path.join(out_dir, f"{prefix}_desc-glmstats")
+    # Write everything to a temporary directory first, so a half-written set is never read
+    tmp_dir = f"{stats_dir}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    np.save(os.path.join(tmp_dir, "betas.npy"), betas)
+    np.save(os.path.join(tmp_dir, "dispersion.npy"), dispersion)
+    np.save(os.path.join(tmp_dir, "labels.npy"), label_idx)
+    np.save(os.path.join(tmp_dir, "covariances.npy"), covariances)
+    model.masker_.mask_img_.to_filename(os.path.join(tmp_dir, "mask.nii.gz"))
+    metadata = {
+        "Regressors": regressors,
+        "ARCoefficients": [float(c) for c in ar_coefs],
+        "DegreesOfFreedom": int(results[ar_coefs[0]].df_residuals),
+        "NoiseModel": model.noise_model,
+    }
+    with open(os.path.join(tmp_dir, "stats.json"), "w") as fo:
+        json.dump(metadata, fo, sort_keys=True, indent=4)
+
+    if os.path.isdir(stats_dir):
+        shutil.rmtree(stats_dir)
+    os.replace(tmp_dir, stats_dir)
+    return stats_dir
+
+
+def load_sufficient_stats(stats_dir):
+    """Load a run's sufficient statistics, memory-mapping the arrays."""
+    with open(os.path.join(stats_dir, "stats.json"), "r") as fo:
+        stats = json.load(fo)
+
+    for name in STATS_FILES:
+        stats[name] = np.load(os.path.join(stats_dir, f"{name}.npy"), mmap_mode="r")
+
+    stats["mask"] = os.path.join(stats_dir, "mask.nii.gz")
+    return stats
+
+
+def compute_contrast(stats, con_val, stat_type=None):
+    """Compute a contrast from sufficient statistics, as nilearn's ``compute_contrast`` does.
+
+    Parameters
+    ----------
+    stats : :obj:`dict`
+        Output of :func:`load_sufficient_stats`.
+    con_val : (p,) or (q, p) :obj:`numpy.ndarray`
+        Contrast weights, with one column per regressor.
+    stat_type : {None, "t", "F"}, optional
+        Defaults to "t" for 1D `con_val` and "F" for 2D `con_val`.
+
+    Returns
+    -------
+    contrast : :obj:`nilearn.glm.contrasts.Contrast`
+    """
+    con_val = np.asarray(con_val, dtype=float)
+    dim = 1 if con_val.ndim == 1 else con_val.shape[0]
+    stat_type = stat_type or ("t" if dim == 1 else "F")
+    betas = np.asarray(stats["betas"], dtype=float)
+    dispersion = np.asarray(stats["dispersion"], dtype=float)
+    labels = np.asarray(stats["labels"])
+    covariances = np.asarray(stats["covariances"], dtype=float)
+
+    if stat_type == "t":
+        con_val = con_val.reshape(-1)
+        effect = betas @ con_val
+        # Contrast variance for each AR bin, then per voxel
+        con_var = np.einsum("p,lpq,q->l", con_val, covariances, con_val)
+        variance = dispersion * con_var[labels]
+    elif stat_type == "F":
+        con_val = np.atleast_2d(con_val)
+        effect = np.zeros((dim, labels.size))
+        for i_label, covariance in enumerate(covariances):
+            label_mask = labels == i_label
+            invcov = np.linalg.inv(np.atleast_2d(con_val @ covariance @ con_val.T))
+            effect[:, label_mask] = np.real(sqrtm(invcov)) @ (con_val @ betas[label_mask].T)
+        variance = dispersion
+    else:
+        raise ValueError(f"stat_type must be 't' or 'F', not {stat_type}")
+
+    return Contrast(
+        effect=effect,
+        variance=variance,
+        dim=dim,
+        dof=stats["DegreesOfFreedom"],
+        stat_type=stat_type,
+    )
+
+
+def parse_contrast(contrast, regressors):
+    """Turn a contrast expression into weights.
+
+    Rows separated by ";" make an F contrast, e.g., ``"zero_back; two_back"``.
+    """
+    rows = [r.strip() for r in contrast.split(";")]
+    con_val = np.array([expression_to_contrast_vector(r, regressors) for r in rows])
+    return con_val[0] if len(rows) == 1 else con_val
+
+
+def write_contrasts(stats_dir, contrasts):
+    """Compute contrasts for one run and write their maps next to its statistics.
+
+    Returns
+    -------
+    out_files : :obj:`list` of :obj:`str`
+    """
+    stats = load_sufficient_stats(stats_dir)
+    out_dir = os.path.dirname(stats_dir)
+    prefix = os.path.basename(stats_dir).replace("_desc-glmstats", "")
+    out_files = []
+    for contrast_name in contrasts:
+        con_val = parse_contrast(contrast_name, stats["Regressors"])
+        contrast = compute_contrast(stats, con_val)
+        maps = {
+            contrast.stat_type: contrast.stat(),
+            "z": contrast.z_score(),
+            "p": contrast.p_value(),
+        }
+        if contrast.stat_type == "t":
+            maps["effect"] = contrast.effect_size()
+            maps["variance"] = contrast.effect_variance()
+
+        name = _clean_contrast_name(" vs ".join(r.strip() for r in contrast_name.split(";")))
+        for stat, values in maps.items():
+            out_file = os.path.join(
+                out_dir, f"{prefix}_contrast-{name}_stat-{stat}_statmap.nii.gz"
+            )
+            img = unmask(np.asarray(values, dtype=np.float32), stats["mask"])
+            save_img(img, out_file, level="derivative")
+            out_files.append(out_file)
+
+    return out_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute first-level contrasts from saved sufficient statistics."
+    )
+    parser.add_argument(
+        "first_level_dir",
+        help="First-level derivatives directory, e.g., derivatives/fracback.",
+    )
+    parser.add_argument(
+        "contrasts",
+        nargs="+",
+        help=(
+            "Contrast expressions in terms of the design matrix columns, e.g., "
+            "'two_back - zero_back' or 'RTDur'. Separate rows with ';' for an F contrast."
+        ),
+    )
+    parser.add_argument(
+        "--subject-label",
+        nargs="+",
+        help="Subject label(s) (with or without 'sub-' prefix) to restrict processing.",
+    )
+    parser.add_argument(
+        "--session-label",
+        nargs="+",
+        help="Session label(s) (with or without 'ses-' prefix) to restrict processing.",
+    )
+    parser.add_argument(
+        "--n-procs",
+        type=int,
+        default=1,
+        help="Number of runs to process concurrently. Default is 1.",
+    )
+    args = parser.parse_args()
+
+    stats_dirs = sorted(
+        glob(os.path.join(args.first_level_dir, "sub-*", "ses-*", "func", "*_desc-glmstats"))
+    )
+    if args.subject_label:
+        subjects = {f"sub-{s.removeprefix('sub-')}" for s in args.subject_label}
+        stats_dirs = [d for d in stats_dirs if d.split(os.sep)[-4] in subjects]
+    if args.session_label:
+        sessions = {f"ses-{s.removeprefix('ses-')}" for s in args.session_label}
+        stats_dirs = [d for d in stats_dirs if d.split(os.sep)[-3] in sessions]
+
+    print(f"Computing {len(args.contrasts)} contrast(s) for {len(stats_dirs)} runs")
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.n_procs) as executor:
+        futures = {executor.submit(write_contrasts, d, args.contrasts): d for d in stats_dirs}
+        for future in as_completed(futures):
+            stats_dir = futures[future]
+            try:
+                future.result()
+            except Exception as exc:
+                print(f"FAILED: {stats_dir}")
+                traceback.print_exception(exc)
+                failed.append(stats_dir)
+            else:
+                print(f"FINISHED: {stats_dir}")
+
+    if failed:
+        raise RuntimeError(f"Contrasts failed for {len(failed)} run(s)")
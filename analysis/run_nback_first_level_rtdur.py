@@ -1,160 +1,448 @@
+"""Fit ConsDurRTDur first-level GLMs to the fractal n-back runs.
+
+Each subject/session is an independent job. Jobs run on a pool of worker processes,
+each with its BLAS/OpenMP threads capped, and a failed job doesn't stop the others.
+The confound strategies decide which nuisance regressors go in the models:
+
+-   ``tedana``: the rejected ICA components' time series from tedana.
+-   ``motion``: the six fMRIPrep motion parameters (the "notedana" model).
+
+With several strategies, each run is loaded and smoothed once, and every model is
+fit to that same smoothed data before being written to its own derivatives directory.
+nilearn smooths the whole image before masking it, so this gives the same results as
+fitting each model separately.
+"""
+
+import argparse
 import json
 import os
 import shutil
 import sys
-from glob import glob
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
 from pathlib import Path
 
 import nibabel as nb
 import numpy as np
 import pandas as pd
-from nilearn.glm.first_level import FirstLevelModel
+from nilearn import image
+from nilearn.glm.first_level import FirstLevelModel, make_first_level_design_matrix
 from nilearn.interfaces.bids import save_glm_to_bids
+from threadpoolctl import threadpool_limits
 
 sys.path.append("..")
-from processing.utils import events_to_rtdur
+from ar1_glm import patch_nilearn_run_glm
+from first_level_stats import save_sufficient_stats
+from processing.metadata_index import MetadataIndex
+from processing.nback_events import RTDurEvents
+from processing.nifti_cache import cached_path
+from processing.parallel_gzip import patch_nibabel_gzip
+from processing.regressors import build_task_regressors
 
+MOTION_COLUMNS = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+# Output directory (under the derivatives directory) for each confound strategy
+CONFOUND_STRATEGIES = {"tedana": "fracback", "motion": "fracback_notedana"}
+SMOOTHING_FWHM = 5
+BG_IMG = (
+    "/cbica/projects/executive_function/.cache/templateflow/"
+    "tpl-MNI152NLin6Asym/tpl-MNI152NLin6Asym_res-02_T1w.nii.gz"
+)
 
-if __name__ == "__main__":
-    # ---------- CONFIG ----------
-    bids_root = Path("/cbica/projects/executive_function/mebold_trt/ds005250")
-    derivatives_dir = Path("/cbica/projects/executive_function/mebold_trt/derivatives")
+
+def _strip_label(label, entity):
+    return label.removeprefix(f"{entity}-")
+
+
+def collect_jobs(
+    bids_root,
+    derivatives_dir,
+    confound_strategies,
+    subject_labels=None,
+    session_labels=None,
+    metadata_index=None,
+    rtdur_events=None,
+):
+    """Find the subject/sessions with the inputs the models need.
+
+    Returns
+    -------
+    jobs : :obj:`list` of :obj:`dict`
+        One job per subject/session, with its input files, timing, and events.
+        Only the confound strategies whose confounds exist are included.
+    skipped : :obj:`list` of :obj:`dict`
+        Summary rows for the subject/sessions that can't be modeled at all.
+    """
     fmriprep_dir = derivatives_dir / "nordic_fmriprep_unzipped" / "fmriprep"
     tedana_dir = derivatives_dir / "tedana"
-    out_dir = Path("/cbica/projects/executive_function/mebold_trt/derivatives/fracback")
-    out_dir.mkdir(parents=True, exist_ok=True)
+    metadata_index = metadata_index or MetadataIndex()
+    rtdur_events = rtdur_events or RTDurEvents(bids_root)
+
+    subject_ids = sorted(p.name.split("-")[1] for p in bids_root.glob("sub-*"))
+    if subject_labels:
+        subject_ids = [s for s in subject_ids if s in subject_labels]
 
-    subject_dirs = sorted(bids_root.glob("sub-*"))
-    for subject_dir in subject_dirs:
-        sub_id = os.path.basename(subject_dir).split("-")[1]
-        session_dirs = sorted(glob(f"{subject_dir}/ses-*"))
-        for session_dir in session_dirs:
-            ses_id = os.path.basename(session_dir).split("-")[1]
-            print(f"Running first-level GLM for subject: {sub_id} and session: {ses_id}")
+    jobs, skipped = [], []
+    for sub_id in subject_ids:
+        ses_ids = sorted(p.name.split("-")[1] for p in (bids_root / f"sub-{sub_id}").glob("ses-*"))
+        if session_labels:
+            ses_ids = [s for s in ses_ids if s in session_labels]
 
+        for ses_id in ses_ids:
             bids_func_dir = bids_root / f"sub-{sub_id}" / f"ses-{ses_id}" / "func"
             fmriprep_func_dir = fmriprep_dir / f"sub-{sub_id}" / f"ses-{ses_id}" / "func"
             tedana_func_dir = tedana_dir / f"sub-{sub_id}" / f"ses-{ses_id}" / "func"
             prefix = f"sub-{sub_id}_ses-{ses_id}_task-fracback_acq-MBME"
+            job = {
+                "subject": sub_id,
+                "session": ses_id,
+                "prefix": prefix,
+                "preproc_file": fmriprep_func_dir
+                / f"{prefix}_part-mag_space-MNI152NLin6Asym_res-2_desc-preproc_bold.nii.gz",
+                "mask_file": fmriprep_func_dir
+                / f"{prefix}_part-mag_space-MNI152NLin6Asym_res-2_desc-brain_mask.nii.gz",
+                "fmriprep_confounds_file": fmriprep_func_dir
+                / f"{prefix}_part-mag_desc-confounds_timeseries.tsv",
+                "events_file": bids_func_dir / f"{prefix}_events.tsv",
+            }
+            confounds_files = {
+                "tedana": tedana_func_dir / f"{prefix}_desc-rejected_timeseries.tsv",
+                "motion": job["fmriprep_confounds_file"],
+            }
+            job["confounds_files"] = {
+                s: confounds_files[s] for s in confound_strategies if confounds_files[s].exists()
+            }
+            job["missing"] = [s for s in confound_strategies if s not in job["confounds_files"]]
 
-            # ---------- Preprocessed data from fMRIPrep ----------
-            preproc_file = (
-                fmriprep_func_dir / f"{prefix}_part-mag_space-MNI152NLin6Asym_res-2_desc-preproc_bold.nii.gz"
-            )
-            if not preproc_file.exists():
-                print(
-                    f"\tPreprocessed file not found for subject: {sub_id} and session: {ses_id}\n"
-                    f"\t{preproc_file}"
+            missing = [k for k, v in job.items() if k.endswith("_file") and not v.exists()]
+            if not job["confounds_files"]:
+                missing.append(f"{', '.join(confound_strategies)} confounds")
+
+            if missing:
+                skipped.append(
+                    {
+                        "subject": sub_id,
+                        "session": ses_id,
+                        "status": "SKIPPED",
+                        "message": f"missing {', '.join(missing)}",
+                    }
                 )
                 continue
 
-            preproc_img = nb.load(preproc_file)
+            preproc_json_file = str(job["preproc_file"]).replace(".nii.gz", ".json")
+            preproc_json_data = metadata_index.get(preproc_json_file)
+            job["t_r"] = preproc_json_data["RepetitionTime"]
+            job["slice_time_ref"] = preproc_json_data["StartTime"]
+            job["dummy_scans"] = metadata_index.get(job["fmriprep_confounds_file"])["dummy_scans"]
+            # Long RTs are a lie!
+            job["events_df"] = rtdur_events.get(job["events_file"], max_rt=2)
+            jobs.append(job)
 
-            preproc_json = str(preproc_file).replace(".nii.gz", ".json")
-            with open(preproc_json, "r") as f:
-                preproc_json_data = json.load(f)
-            t_r = preproc_json_data["RepetitionTime"]
-            slice_time_ref = preproc_json_data["StartTime"]
+    return jobs, skipped
 
-            mask_file = fmriprep_func_dir / f"{prefix}_part-mag_space-MNI152NLin6Asym_res-2_desc-brain_mask.nii.gz"
-            if not mask_file.exists():
-                print(f"\tMask file not found for subject: {sub_id} and session: {ses_id}")
-                continue
 
-            mask_img = str(mask_file)
+def _save_model(model, job, out_dir):
+    """Write a fitted model's contrast, diagnostics, and sufficient statistics."""
+    func_out_dir = out_dir / f"sub-{job['subject']}" / f"ses-{job['session']}" / "func"
+    func_out_dir.mkdir(parents=True, exist_ok=True)
+    save_glm_to_bids(
+        model,
+        contrasts="two_back - zero_back",
+        contrast_types={"two_back - zero_back": "t"},
+        out_dir=func_out_dir,
+        prefix=job["prefix"],
+        bg_img=BG_IMG,
+    )
+    # Other contrasts can be computed from these later with first_level_stats.py
+    save_sufficient_stats(model, func_out_dir, job["prefix"])
 
-            # ---------- Dummy volumes from fMRIPrep ----------
-            confounds_file = fmriprep_func_dir / f"{prefix}_part-mag_desc-confounds_timeseries.tsv"
-            if not confounds_file.exists():
-                print(f"\tConfounds file not found for subject: {sub_id} and session: {ses_id}")
-                continue
+    # Post-Nilearn cleanup
+    # The description is the same for every job, so a rename is safe if jobs race
+    os.replace(func_out_dir / "dataset_description.json", out_dir / "dataset_description.json")
+    nilearn_func_out_dir = func_out_dir / f"sub-{job['subject']}"
+    # Move contents of nilearn_func_out_dir to func_out_dir
+    for item in nilearn_func_out_dir.iterdir():
+        shutil.move(item, func_out_dir / item.name)
+    nilearn_func_out_dir.rmdir()
 
-            fmriprep_confounds_df = pd.read_table(confounds_file)
-            # Infer the number of dummy volumes from the confounds dataframe
-            nss_cols = [c for c in fmriprep_confounds_df.columns if c.startswith("non_steady_state_outlier")]
+    # The data were smoothed before fitting, so the model doesn't know the kernel
+    statmap_file = func_out_dir / f"{job['prefix']}_statmap.json"
+    with statmap_file.open("r") as fo:
+        statmap_metadata = json.load(fo)
 
-            dummy_scans = 0
-            if nss_cols:
-                initial_volumes_df = fmriprep_confounds_df[nss_cols]
-                dummy_scans = np.any(initial_volumes_df.to_numpy(), axis=1)
-                dummy_scans = np.where(dummy_scans)[0]
+    statmap_metadata["ModelParameters"]["smoothing_fwhm"] = SMOOTHING_FWHM
+    with statmap_file.open("w") as fo:
+        json.dump(statmap_metadata, fo, indent=4, sort_keys=True)
 
-                # reasonably assumes all NSS volumes are contiguous
-                dummy_scans = int(dummy_scans[-1] + 1)
 
-            print(f"\t{dummy_scans} dummy scans")
+def fit_first_level(job, out_dirs, regressor_cache_dir=None, glm_backend="nilearn"):
+    """Fit and save one subject/session's first-level GLMs, one per confound strategy.
 
-            # ---------- Events from raw BIDS ----------
-            events_file = bids_func_dir / f"{prefix}_events.tsv"
-            if not events_file.exists():
-                print(f"\tEvents file not found for subject: {sub_id} and session: {ses_id}")
-                continue
+    Parameters
+    ----------
+    job : :obj:`dict`
+        A job from :func:`collect_jobs`.
+    out_dirs : :obj:`dict`
+        Derivatives directory for each confound strategy.
+    regressor_cache_dir : :obj:`pathlib.Path` or None, optional
+        Directory to cache the task regressors in.
+    glm_backend : {"nilearn", "batched"}, optional
+        Fit the AR(1) models with nilearn, or with the batched fit in ar1_glm.py.
 
-            events_df = pd.read_table(events_file)
-            cons_dur_rt_dur_events_df = events_to_rtdur(events_df)
+    Returns
+    -------
+    n_regressors : :obj:`dict`
+        Number of columns in each strategy's design matrix.
+    """
+    print(f"Running first-level GLM for subject: {job['subject']} and session: {job['session']}")
+    t_r = job["t_r"]
+    slice_time_ref = job["slice_time_ref"]
+    dummy_scans = job["dummy_scans"]
+    print(f"\t{dummy_scans} dummy scans")
 
-            # ---------- Confounds from TEDANA ----------
-            tedana_confounds = tedana_func_dir / f"{prefix}_desc-rejected_timeseries.tsv"
-            if not tedana_confounds.exists():
-                print(f"\tTedana classifications file not found for subject: {sub_id} and session: {ses_id}")
-                continue
-            confounds_df = pd.read_table(tedana_confounds)
-
-            # ---------- Remove dummy volumes if necessary ----------
-            if dummy_scans > 0:
-                cons_dur_rt_dur_events_df["onset"] = cons_dur_rt_dur_events_df["onset"] - (dummy_scans * t_r)
-                cons_dur_rt_dur_events_df = cons_dur_rt_dur_events_df.loc[cons_dur_rt_dur_events_df["onset"] >= 0].reset_index(drop=True)
-                preproc_img = preproc_img.slicer[..., dummy_scans:]
-                confounds_df = confounds_df.loc[dummy_scans:].reset_index(drop=True)
-
-            # ---------- Fit GLM ----------
-            model = FirstLevelModel(
-                t_r=t_r,
-                slice_time_ref=slice_time_ref,
-                hrf_model="glover",
-                mask_img=mask_img,
-                smoothing_fwhm=5,
-                noise_model="ar1",
-                minimize_memory=False,
-            )
-            model = model.fit(
-                run_imgs=preproc_img,
-                events=cons_dur_rt_dur_events_df,
-                confounds=confounds_df,
-            )
-
-            # Inspect design matrix
-            design_matrix = model.design_matrices_[0]
-            print("\tDesign matrix columns:")
-            print("\t\t", design_matrix.columns)
-            print(f"\tTotal # regressors in design matrix: {design_matrix.shape[1]}")
-
-            func_out_dir = out_dir / f"sub-{sub_id}" / f"ses-{ses_id}" / "func"
-            func_out_dir.mkdir(parents=True, exist_ok=True)
-            save_glm_to_bids(
-                model,
-                contrasts="two_back - zero_back",
-                contrast_types={"two_back - zero_back": "t"},
-                out_dir=func_out_dir,
-                prefix=prefix,
-                bg_img=(
-                    "/cbica/projects/executive_function/.cache/templateflow/"
-                    "tpl-MNI152NLin6Asym/tpl-MNI152NLin6Asym_res-02_T1w.nii.gz"
-                ),
-            )
-            print(f"\tDone fitting GLM for subject: {sub_id} and session: {ses_id}")
-
-            # Post-Nilearn cleanup
-            nilearn_func_out_dir = func_out_dir / f"sub-{sub_id}"
-            dataset_description_file = out_dir / "dataset_description.json"
-            nilearn_dataset_description_file = func_out_dir / "dataset_description.json"
-            if not dataset_description_file.exists():
-                shutil.copyfile(nilearn_dataset_description_file, dataset_description_file)
-
-            os.remove(nilearn_dataset_description_file)
-            # Move contents of nilearn_func_out_dir to func_out_dir
-            for item in nilearn_func_out_dir.iterdir():
-                shutil.move(item, func_out_dir / item.name)
-            nilearn_func_out_dir.rmdir()
+    # ---------- Load and smooth the run once for every model ----------
+    preproc_img = nb.load(cached_path(job["preproc_file"]))
+    if dummy_scans > 0:
+        preproc_img = preproc_img.slicer[..., dummy_scans:]
+
+    start = time.time()
+    smoothed_img = image.smooth_img(preproc_img, SMOOTHING_FWHM)
+    print(f"\tLoaded and smoothed in {time.time() - start:.1f}s")
+
+    # ---------- Task regressors ----------
+    # Same columns as FirstLevelModel would build from the events, but cached and
+    # shifted for the dummy volumes
+    n_volumes = smoothed_img.shape[3]
+    task_regressors_df = build_task_regressors(
+        job["events_df"],
+        tr=t_r,
+        n_volumes=n_volumes,
+        slice_time_ref=slice_time_ref,
+        hrf_model="glover",
+        dummy_scans=dummy_scans,
+        cache_dir=regressor_cache_dir,
+    )
+    frame_times = np.linspace(
+        slice_time_ref * t_r, (n_volumes - 1 + slice_time_ref) * t_r, n_volumes
+    )
+
+    n_regressors = {}
+    for confound_strategy, confounds_file in job["confounds_files"].items():
+        print(f"\tFitting the {confound_strategy} model")
+        confounds_df = pd.read_table(confounds_file)
+        if confound_strategy == "motion":
+            confounds_df = confounds_df[MOTION_COLUMNS]
+
+        confounds_df = confounds_df.loc[dummy_scans:].reset_index(drop=True)
+        regressors_df = pd.concat([task_regressors_df, confounds_df], axis=1)
+        design_matrix = make_first_level_design_matrix(
+            frame_times,
+            events=None,
+            drift_model="cosine",
+            high_pass=0.01,
+            add_regs=regressors_df.to_numpy(),
+            add_reg_names=regressors_df.columns.tolist(),
+        )
+
+        # ---------- Fit GLM ----------
+        model = FirstLevelModel(
+            t_r=t_r,
+            slice_time_ref=slice_time_ref,
+            hrf_model="glover",
+            mask_img=str(job["mask_file"]),
+            smoothing_fwhm=None,
+            noise_model="ar1",
+            minimize_memory=False,
+        )
+        with patch_nilearn_run_glm() if glm_backend == "batched" else nullcontext():
+            model = model.fit(run_imgs=smoothed_img, design_matrices=design_matrix)
+
+        # Inspect design matrix
+        design_matrix = model.design_matrices_[0]
+        print("\tDesign matrix columns:")
+        print("\t\t", design_matrix.columns)
+        print(f"\tTotal # regressors in design matrix: {design_matrix.shape[1]}")
+
+        _save_model(model, job, out_dirs[confound_strategy])
+        n_regressors[confound_strategy] = design_matrix.shape[1]
+
+    print(f"\tDone fitting GLM for subject: {job['subject']} and session: {job['session']}")
+    return n_regressors
+
+
+def _fit_first_level_worker(job, out_dirs, regressor_cache_dir, glm_backend, n_threads):
+    """Fit one job in a worker process, with capped threads and parallel gzip outputs."""
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+
+    with threadpool_limits(limits=n_threads), patch_nibabel_gzip("derivative", n_threads):
+        return fit_first_level(job, out_dirs, regressor_cache_dir, glm_backend)
+
+
+def run_first_level(
+    bids_root,
+    derivatives_dir,
+    confound_strategies=("tedana",),
+    out_dir=None,
+    subject_labels=None,
+    session_labels=None,
+    n_procs=1,
+    n_threads=None,
+    glm_backend="nilearn",
+):
+    bids_root = Path(bids_root)
+    derivatives_dir = Path(derivatives_dir)
+    out_dir = Path(out_dir or derivatives_dir)
+    out_dirs = {s: out_dir / CONFOUND_STRATEGIES[s] for s in confound_strategies}
+    for strategy_out_dir in out_dirs.values():
+        strategy_out_dir.mkdir(parents=True, exist_ok=True)
+
+    regressor_cache_dir = derivatives_dir / "regressor_cache"
+    subject_labels = [_strip_label(s, "sub") for s in subject_labels or []]
+    session_labels = [_strip_label(s, "ses") for s in session_labels or []]
+
+    # Resolve timing and events up front, so workers don't race on the shared caches
+    metadata_index = MetadataIndex(derivatives_dir / "metadata_index.json")
+    rtdur_events = RTDurEvents(bids_root, derivatives_dir / "fracback_events.npz")
+    jobs, summary = collect_jobs(
+        bids_root,
+        derivatives_dir,
+        confound_strategies,
+        subject_labels=subject_labels,
+        session_labels=session_labels,
+        metadata_index=metadata_index,
+        rtdur_events=rtdur_events,
+    )
+    metadata_index.save()
+    for row in summary:
+        print(f"SKIPPED: sub-{row['subject']}_ses-{row['session']} ({row['message']})")
+
+    if n_threads is None:
+        n_cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count()))
+        n_threads = max(1, n_cpus // n_procs)
+
+    print(f"\tFitting {len(jobs)} runs on {n_procs} workers ({n_threads} threads each)")
+    with ProcessPoolExecutor(max_workers=n_procs) as executor:
+        futures = {
+            executor.submit(
+                _fit_first_level_worker,
+                job,
+                out_dirs,
+                regressor_cache_dir,
+                glm_backend,
+                n_threads,
+            ): (job, time.time())
+            for job in jobs
+        }
+        for future in as_completed(futures):
+            job, start = futures[future]
+            row = {"subject": job["subject"], "session": job["session"]}
+            try:
+                n_regressors = future.result()
+            except Exception as exc:
+                # Don't let one failed job stop the others
+                print(f"FAILED: {job['prefix']}")
+                traceback.print_exception(exc)
+                row.update(status="FAILED", message=f"{type(exc).__name__}: {exc}")
+            else:
+                print(f"FINISHED: {job['prefix']}")
+                message = [f"{s}: {n} regressors" for s, n in n_regressors.items()]
+                message += [f"{s}: missing confounds" for s in job["missing"]]
+                row.update(status="FINISHED", message=", ".join(message))
+
+            # Includes time spent queued when there are more jobs than workers
+            row["minutes"] = round((time.time() - start) / 60, 1)
+            summary.append(row)
+
+    summary_df = pd.DataFrame(
+        summary, columns=["subject", "session", "status", "minutes", "message"]
+    )
+    summary_df = summary_df.sort_values(by=["subject", "session"])
+    print("\n" + summary_df.to_string(index=False))
+    n_failed = int((summary_df["status"] == "FAILED").sum())
+    if n_failed:
+        raise RuntimeError(f"First-level GLM failed for {n_failed} subject/session(s)")
 
     print("\n----\nDONE\n----\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "--bids-dir",
+        default="/cbica/projects/executive_function/mebold_trt/ds005250",
+        help="BIDS raw directory with the events files.",
+    )
+    parser.add_argument(
+        "--derivatives-dir",
+        default="/cbica/projects/executive_function/mebold_trt/derivatives",
+        help="Derivatives directory with the fMRIPrep and tedana outputs.",
+    )
+    parser.add_argument(
+        "--confounds",
+        nargs="+",
+        choices=sorted(CONFOUND_STRATEGIES),
+        default=["tedana"],
+        help=(
+            "Nuisance regressors to model: tedana's rejected components and/or fMRIPrep "
+            "motion. With both, each run is loaded and smoothed once for both models."
+        ),
+    )
+    parser.add_argument(
+        "--out-dir",
+        help=(
+            "Directory to write each strategy's derivatives (fracback, fracback_notedana) "
+            "to. Defaults to --derivatives-dir."
+        ),
+    )
+    parser.add_argument(
+        "--subject-label",
+        nargs="+",
+        help="Subject label(s) (with or without 'sub-' prefix) to restrict processing.",
+    )
+    parser.add_argument(
+        "--session-label",
+        nargs="+",
+        help="Session label(s) (with or without 'ses-' prefix) to restrict processing.",
+    )
+    parser.add_argument(
+        "--n-procs",
+        type=int,
+        default=1,
+        help="Number of subject/sessions to fit concurrently. Default is 1.",
+    )
+    parser.add_argument(
+        "--n-threads",
+        type=int,
+        help="BLAS/OpenMP threads per worker. Defaults to the CPUs available / --n-procs.",
+    )
+    parser.add_argument(
+        "--glm-backend",
+        choices=["nilearn", "batched"],
+        default="nilearn",
+        help=(
+            "Fit the AR(1) models with nilearn, or with a batched fit that whitens and "
+            "solves all voxels at once (see ar1_glm.py). Both give the same results."
+        ),
+    )
+    args = parser.parse_args()
+    run_first_level(
+        args.bids_dir,
+        args.derivatives_dir,
+        confound_strategies=args.confounds,
+        out_dir=args.out_dir,
+        subject_labels=args.subject_label,
+        session_labels=args.session_label,
+        n_procs=args.n_procs,
+        n_threads=args.n_threads,
+        glm_backend=args.glm_backend,
+    )
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import sys
 from pathlib import Path
 
 import nibabel as nb
@@ -8,6 +9,9 @@ from nilearn.glm.second_level import SecondLevelModel
 from nilearn.interfaces.bids import save_glm_to_bids
 from nilearn.image import load_img
 
+sys.path.append("..")
+from processing.parallel_gzip import patch_nibabel_gzip, save_img
+
 
 # ----------------------------------------------------------
 # CONFIG
@@ -101,7 +105,7 @@ for mask_file in mask_files:
     mask_data = mask_img.get_fdata().astype(bool)
     group_mask_data = group_mask_data * mask_data
 group_mask_img = nb.Nifti1Image(group_mask_data, mask_img.affine, mask_img.header)
-group_mask_img.to_filename(group_out_dir / "mask.nii.gz")
+save_img(group_mask_img, group_out_dir / "mask.nii.gz", level="derivative")
 
 # ----------------------------------------------------------
 # ANALYSIS 1: ONE-SAMPLE T-TEST
@@ -136,13 +140,14 @@ model = model.fit(
 group_contrast_name = "twoBackMinusZeroBack"
 contrasts = {group_contrast_name: "intercept"}
 
-save_glm_to_bids(
-    model=model,
-    contrasts=contrasts,
-    out_dir=group_out_dir,
-    prefix="model-onesample_",
-    bg_img=bg_img,              # <-- same bg as first level
-)
+with patch_nibabel_gzip("derivative"):
+    save_glm_to_bids(
+        model=model,
+        contrasts=contrasts,
+        out_dir=group_out_dir,
+        prefix="model-onesample_",
+        bg_img=bg_img,              # <-- same bg as first level
+    )
 
 print(f"\nSaved second-level BIDS-like outputs to:\n  {group_out_dir}\n")
 
@@ -179,12 +184,13 @@ model = model.fit(
 group_contrast_name = "ses_1 - ses_2"
 contrasts = {group_contrast_name: "ses_1 - ses_2"}
 
-save_glm_to_bids(
-    model=model,
-    contrasts=contrasts,
-    out_dir=group_out_dir,
-    prefix="model-paired_",
-    bg_img=bg_img,              # <-- same bg as first level
-)
+with patch_nibabel_gzip("derivative"):
+    save_glm_to_bids(
+        model=model,
+        contrasts=contrasts,
+        out_dir=group_out_dir,
+        prefix="model-paired_",
+        bg_img=bg_img,              # <-- same bg as first level
+    )
 
 print(f"\nSaved second-level BIDS-like outputs to:\n  {group_out_dir}\n")
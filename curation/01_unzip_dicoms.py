@@ -1,15 +1,139 @@
-"""Expand dicom zip files in order to heudiconv."""
+"""Expand dicom zip files in order to heudiconv.
 
+Archives are extracted concurrently, one per process. Each archive's members are
+streamed to disk, into a staging folder next to the archive, and zipfile checks each
+member's CRC as it's read, so a corrupt member fails its archive. Only once every
+member is verified are the files moved into place and the archive deleted.
+
+Extracted archives are recorded in a log before they're deleted. A restarted run skips
+logged archives, and deletes any that an interrupted run didn't get to. It also
+discards the staging folders of archives that were only partly extracted.
+"""
+
+import argparse
+import json
 import os
+import shutil
+import traceback
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from glob import glob
 
+RECORD_FILE = ".unzip_dicoms_record.jsonl"
+CHUNK_SIZE = 2**20
+
+
+def _staging_dir(zip_file, pid=None):
+    out_dir, name = os.path.split(zip_file)
+    return os.path.join(out_dir, f".{name}.{pid or os.getpid()}.tmp")
+
+
+def extract_zip(zip_file):
+    """Stream an archive's members to disk, verify them, and move them into place.
+
+    Returns
+    -------
+    n_members : :obj:`int`
+    """
+    out_dir = os.path.dirname(zip_file)
+    for stale_dir in glob(_staging_dir(zip_file, pid="*")):
+        shutil.rmtree(stale_dir)
+
+    staging_dir = _staging_dir(zip_file)
+    try:
+        with zipfile.ZipFile(zip_file, "r") as zip_ref:
+            members = zip_ref.infolist()
+            for member in members:
+                name = os.path.normpath(member.filename)
+                if os.path.isabs(name) or name.split(os.sep)[0] == "..":
+                    raise ValueError(f"{zip_file} has a member outside its folder: {name}")
+
+                out_file = os.path.join(staging_dir, name)
+                if member.is_dir():
+                    os.makedirs(out_file, exist_ok=True)
+                    continue
+
+                os.makedirs(os.path.dirname(out_file), exist_ok=True)
+                # Reading a member to the end raises BadZipFile if its CRC doesn't match
+                with zip_ref.open(member) as f_in, open(out_file, "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+
+                if os.path.getsize(out_file) != member.file_size:
+                    raise zipfile.BadZipFile(f"{zip_file}: {name} is truncated")
+
+        # Every member is verified, so move the files into place
+        for root, _, files in os.walk(staging_dir):
+            dest_dir = os.path.join(out_dir, os.path.relpath(root, staging_dir))
+            os.makedirs(dest_dir, exist_ok=True)
+            for file_ in files:
+                os.replace(os.path.join(root, file_), os.path.join(dest_dir, file_))
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    return len(members)
+
+
+def load_record(record_file):
+    """Read the archives a previous run extracted, with their sizes."""
+    if not os.path.isfile(record_file):
+        return {}
+
+    with open(record_file, "r") as fo:
+        entries = [json.loads(line) for line in fo if line.strip()]
+
+    return {entry["zip_file"]: entry["size"] for entry in entries}
+
+
 if __name__ == "__main__":
-    zip_files = sorted(
-        glob("/cbica/projects/executive_function/mebold_trt/sourcedata/*_*/*/*/*.dicom.zip")
+    parser = argparse.ArgumentParser(description="Expand dicom zip files for heudiconv.")
+    parser.add_argument(
+        "--sourcedata-dir",
+        default="/cbica/projects/executive_function/mebold_trt/sourcedata",
+        help="Folder with the dicom zip files.",
     )
+    parser.add_argument(
+        "--n-procs",
+        type=int,
+        help="Number of archives to extract concurrently. Defaults to the number of CPUs.",
+    )
+    args = parser.parse_args()
+
+    zip_files = sorted(glob(os.path.join(args.sourcedata_dir, "*_*/*/*/*.dicom.zip")))
+    record_file = os.path.join(args.sourcedata_dir, RECORD_FILE)
+    record = load_record(record_file)
+
+    # Archives that were extracted before the last run stopped only need deleting
+    to_extract = []
     for zip_file in zip_files:
-        with zipfile.ZipFile(zip_file, "r") as zip_ref:
-            zip_ref.extractall(os.path.dirname(zip_file))
+        if record.get(zip_file) == os.path.getsize(zip_file):
+            print(f"SKIPPED: {os.path.relpath(zip_file, args.sourcedata_dir)}")
+            os.remove(zip_file)
+        else:
+            to_extract.append(zip_file)
+
+    failed = []
+    with open(record_file, "a") as record_fo, ProcessPoolExecutor(args.n_procs) as executor:
+        futures = {
+            executor.submit(extract_zip, zip_file): zip_file for zip_file in to_extract
+        }
+        for future in as_completed(futures):
+            zip_file = futures[future]
+            name = os.path.relpath(zip_file, args.sourcedata_dir)
+            try:
+                n_members = future.result()
+            except Exception as exc:
+                print(f"FAILED: {name}")
+                traceback.print_exception(exc)
+                failed.append(name)
+                continue
+
+            # Record the archive before deleting it, so a restart never extracts it again
+            entry = {"zip_file": zip_file, "size": os.path.getsize(zip_file)}
+            record_fo.write(json.dumps(entry) + "\n")
+            record_fo.flush()
+            os.fsync(record_fo.fileno())
+            os.remove(zip_file)
+            print(f"DONE: {name} ({n_members} members)")
 
-        os.remove(zip_file)
+    if failed:
+        raise RuntimeError(f"Failed to extract {len(failed)} archive(s): {failed}")
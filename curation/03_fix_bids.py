@@ -40,221 +40,407 @@ Here is what the dupe situation looks like.
     I don't know if I need to retain these scans.
     Ted may not want to share them at all.
     I'm just going to add these to the bidsignore for now.
+
+Each session is planned from one listing of its directories before anything changes:
+the files to delete, every file's final name after all of the renames, the noise scans
+to split out, and the files to copy. The plan is then applied with a journal, so a
+session that fails partway (or a crash) is rolled back, either right away or the next
+time the script runs. scans.tsv is updated from the plan in one pass and written once.
+Run with ``--dry-run`` to print the plans without changing anything.
 """
 
+import argparse
+import json
 import os
 import shutil
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from fnmatch import fnmatchcase
 from glob import glob
 
 import nibabel as nb
 import pandas as pd
 
+sys.path.append("..")
+from processing.parallel_gzip import COMPRESSION_LEVELS, default_n_threads
+from processing.split_volumes import split_files
+
 N_NOISE_VOLS = 3
+# Runs of these lengths have noise scans at the end
+FULL_RUN_LENGTHS = (240, 204, 200)
+JOURNAL_FILE = ".fix_bids_journal.jsonl"
+TRASH_DIR = ".fix_bids_trash"
+
+# (session or None for all sessions, datatype, pattern)
+DELETE_RULES = [
+    # Remove events files
+    (None, "func", "*_events.tsv"),
+    # Remove duplicate frackack functional scans.
+    ("sub-03/ses-1", "func", "*task-frackack*_dup-*"),
+    # Delete duplicate functional scans.
+    ("sub-05/ses-2", "func", "*_dup-*"),
+    # Delete duplicate T1w scans.
+    ("sub-07/ses-2", "anat", "*T1w*_dup-*"),
+]
+
+
+def _rename_rest_dupe(name):
+    """Rename a sub-03 ses-1 rest dupe to run-03."""
+    echo = name.split("echo-")[1].split("_")[0]
+    prerun, postrun = name.split("_run-02_")
+    postrun = postrun.split("__")[0]
+    ext = ".nii.gz" if name.endswith(".nii.gz") else ".json"
+    return f"{prerun}_run-03_echo-{echo}_{postrun}{ext}"
+
+
+# (session or None for all sessions, pattern, rename) for func files, applied in order,
+# each to the names left by the rules before it
+RENAME_RULES = [
+    # Rename "frackack" scans to "rest" since no task was performed.
+    (
+        "sub-01/ses-1",
+        "*task-frackack_acq-multiecho*",
+        lambda name: name.replace("acq-multiecho_", "acq-multiecho_run-03_"),
+    ),
+    # Rename rest dupes to run-03.
+    ("sub-03/ses-1", "*task-rest_acq-multiecho_run-02*_dup-*", _rename_rest_dupe),
+    # Rename magnitude files from _bold to _part-mag_bold.
+    (
+        None,
+        "*echo-*_bold.*",
+        lambda name: name if "part-" in name else name.replace("_bold.", "_part-mag_bold."),
+    ),
+    # Rename phase files from _phase to _part-phase_bold.
+    (None, "*_phase.*", lambda name: name.replace("_phase.", "_part-phase_bold.")),
+    # Rename acq-multiecho files to acq-MBME
+    (None, "*acq-multiecho*", lambda name: name.replace("acq-multiecho", "acq-MBME")),
+    # Rename acq-singleecho files to acq-MBSE
+    (None, "*acq-singleecho*", lambda name: name.replace("acq-singleecho", "acq-MBSE")),
+    # Rename task-frackack files to task-fracback
+    (None, "*task-frackack*", lambda name: name.replace("task-frackack", "task-fracback")),
+]
+
+
+def plan_session(session_dir):
+    """Plan all of a session's changes from one listing of its directories.
+
+    Returns
+    -------
+    plan : :obj:`dict`
+        Paths relative to the session directory, as in scans.tsv, under "delete",
+        "rename" (old to new name), "split" (BOLD file, noise file, number of volumes,
+        by their new names), and "copy" (source, destination). "notes" has the files
+        that were skipped and why.
+    """
+    sub_id, ses_id = session_dir.rstrip(os.sep).split(os.sep)[-2:]
+    session = f"{sub_id}/{ses_id}"
+    scans_file = os.path.join(session_dir, f"{sub_id}_{ses_id}_scans.tsv")
+    if not os.path.isfile(scans_file):
+        raise FileNotFoundError(f"Scans file DNE: {scans_file}")
+
+    listing = {}
+    for datatype in ("anat", "fmap", "func"):
+        datatype_dir = os.path.join(session_dir, datatype)
+        listing[datatype] = sorted(os.listdir(datatype_dir)) if os.path.isdir(datatype_dir) else []
+
+    notes = []
+    delete = []
+    for rule_session, datatype, pattern in DELETE_RULES:
+        if rule_session not in (None, session):
+            continue
+
+        for name in listing[datatype]:
+            path = os.path.join(datatype, name)
+            if fnmatchcase(name, pattern) and path not in delete:
+                delete.append(path)
+
+    # Follow each func file through every rename
+    names = {
+        name: name for name in listing["func"] if os.path.join("func", name) not in delete
+    }
+    for rule_session, pattern, rename_func in RENAME_RULES:
+        if rule_session not in (None, session):
+            continue
+
+        for orig_name, name in names.items():
+            if fnmatchcase(name, pattern):
+                names[orig_name] = rename_func(name)
+
+    renamed = {orig: name for orig, name in names.items() if orig != name}
+    final_names = set(names.values())
+    if len(final_names) < len(names):
+        raise ValueError(f"Renames in {session} would give two files the same name")
+
+    taken = set(listing["func"]) - set(renamed)
+    collisions = sorted(taken.intersection(renamed.values()))
+    if collisions:
+        raise ValueError(f"Renames in {session} would overwrite {collisions}")
+
+    # Split out noise scans from all multi-echo BOLD files.
+    orig_names = {name: orig for orig, name in names.items()}
+    split = []
+    for name in sorted(final_names):
+        if not fnmatchcase(name, "*acq-MBME*_bold.nii.gz"):
+            continue
+
+        noise_name = name.replace("_bold.nii.gz", "_noRF.nii.gz")
+        if noise_name in final_names:
+            notes.append(f"File exists: {noise_name}")
+            continue
+
+        # Only reads the header
+        n_vols = nb.load(os.path.join(session_dir, "func", orig_names[name])).shape[-1]
+        if n_vols not in FULL_RUN_LENGTHS:
+            notes.append(f"File is a partial scan: {name}")
+            continue
+
+        split.append((os.path.join("func", name), os.path.join("func", noise_name), n_vols))
+
+    # Copy first echo's sbref of multi-echo field maps without echo entity.
+    copy = []
+    for name in listing["fmap"]:
+        if not fnmatchcase(name, "*_acq-ME*_echo-1_sbref.*"):
+            continue
+
+        out_name = name.replace("_echo-1_", "_").replace("_sbref", "_epi")
+        if out_name in listing["fmap"]:
+            notes.append(f"File exists: {out_name}")
+            continue
+
+        copy.append((os.path.join("fmap", name), os.path.join("fmap", out_name)))
+
+    return {
+        "session_dir": session_dir,
+        "scans_file": scans_file,
+        "delete": delete,
+        "rename": {
+            os.path.join("func", orig): os.path.join("func", name)
+            for orig, name in renamed.items()
+        },
+        "split": split,
+        "copy": copy,
+        "notes": notes,
+    }
+
+
+def format_plan(plan):
+    """Describe a plan, one change per line."""
+    lines = [f"\t{note}" for note in plan["notes"]]
+    lines += [f"\tDELETE: {path}" for path in plan["delete"]]
+    lines += [f"\tRENAME: {old} -> {new}" for old, new in plan["rename"].items()]
+    lines += [
+        f"\tSPLIT: {bold} -> {n_vols - N_NOISE_VOLS} + {N_NOISE_VOLS} volumes in {noise}"
+        for bold, noise, n_vols in plan["split"]
+    ]
+    lines += [f"\tCOPY: {src} -> {dst}" for src, dst in plan["copy"]]
+    return "\n".join(lines)
+
+
+def update_scans(scans_df, plan, failed_splits=()):
+    """Apply a plan's deletions, renames, and new files to a scans DataFrame at once."""
+    scans_df = scans_df.loc[~scans_df["filename"].isin(plan["delete"])].copy()
+    scans_df["filename"] = scans_df["filename"].map(plan["rename"]).fillna(scans_df["filename"])
+
+    # New files get their source file's row
+    new_files = [
+        (bold, noise) for bold, noise, _ in plan["split"] if bold not in failed_splits
+    ]
+    new_files += [(src, dst) for src, dst in plan["copy"] if dst.endswith(".nii.gz")]
+    if new_files:
+        sources, destinations = zip(*new_files)
+        rows = scans_df.drop_duplicates("filename").set_index("filename").loc[list(sources)]
+        rows = rows.reset_index()
+        rows["filename"] = destinations
+        scans_df = pd.concat([scans_df, rows], ignore_index=True)
+
+    return scans_df.sort_values(by=["acq_time", "filename"])
+
+
+def rollback_session(session_dir):
+    """Undo the changes recorded in a session's journal, newest first."""
+    journal_file = os.path.join(session_dir, JOURNAL_FILE)
+    with open(journal_file, "r") as fo:
+        entries = [json.loads(line) for line in fo if line.strip()]
+
+    for op, *paths in reversed(entries):
+        paths = [os.path.join(session_dir, path) for path in paths]
+        if op in ("delete", "replace"):
+            # Put back the file that was moved to the trash
+            path, trash_file = paths
+            if os.path.isfile(trash_file):
+                os.replace(trash_file, path)
+        elif op == "rename":
+            old, new = paths
+            if os.path.isfile(new) and not os.path.isfile(old):
+                os.rename(new, old)
+        elif op == "split":
+            bold, noise, trash_file = paths
+            if os.path.isfile(trash_file):
+                os.replace(trash_file, bold)
+            if os.path.isfile(noise):
+                os.remove(noise)
+        elif op == "copy":
+            _, dst = paths
+            if os.path.isfile(dst):
+                os.remove(dst)
+
+    os.remove(journal_file)
+    shutil.rmtree(os.path.join(session_dir, TRASH_DIR), ignore_errors=True)
+
+
+def apply_plan(plan, n_procs=None):
+    """Apply a session's plan, journaling each change first so it can be rolled back.
+
+    If any noise scan split fails, the other changes are kept along with the journal
+    and trash, and a RuntimeError is raised. The next run rolls the session back and
+    tries it again.
+    """
+    session_dir = plan["session_dir"]
+    journal_file = os.path.join(session_dir, JOURNAL_FILE)
+    trash_dir = os.path.join(session_dir, TRASH_DIR)
+    os.makedirs(trash_dir, exist_ok=True)
+
+    def _abs(path):
+        return os.path.join(session_dir, path)
+
+    def _trash(path):
+        return os.path.join(TRASH_DIR, path.replace(os.sep, "__"))
+
+    with open(journal_file, "a") as journal:
+
+        def _log(op, *paths):
+            journal.write(json.dumps([op, *paths]) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        try:
+            # Deleted files go to the trash until the session is done
+            for path in plan["delete"]:
+                _log("delete", path, _trash(path))
+                os.rename(_abs(path), _abs(_trash(path)))
+
+            for old, new in plan["rename"].items():
+                _log("rename", old, new)
+                os.rename(_abs(old), _abs(new))
+
+            # Keep a hard link to each original BOLD file until the session is done
+            for bold, noise, _ in plan["split"]:
+                _log("split", bold, noise, _trash(bold))
+                os.link(_abs(bold), _abs(_trash(bold)))
+
+            # Overwrite the BOLD scans, streaming every file concurrently
+            failed = split_files(
+                [
+                    (
+                        _abs(bold),
+                        [(_abs(bold), n_vols - N_NOISE_VOLS), (_abs(noise), N_NOISE_VOLS)],
+                    )
+                    for bold, noise, n_vols in plan["split"]
+                ],
+                n_procs=n_procs,
+                compresslevel=COMPRESSION_LEVELS["release"],
+            )
+            failed = [os.path.relpath(path, session_dir) for path in failed]
+
+            # Copy the JSON as well
+            copies = [
+                (bold.replace(".nii.gz", ".json"), noise.replace(".nii.gz", ".json"))
+                for bold, noise, _ in plan["split"]
+                if bold not in failed
+            ]
+            for src, dst in copies + plan["copy"]:
+                _log("copy", src, dst)
+                shutil.copyfile(_abs(src), _abs(dst))
+
+            # Save out the modified scans.tsv file.
+            scans_file = os.path.relpath(plan["scans_file"], session_dir)
+            scans_df = update_scans(pd.read_table(plan["scans_file"]), plan, failed)
+            _log("replace", scans_file, _trash(scans_file))
+            os.link(plan["scans_file"], _abs(_trash(scans_file)))
+            tmp_file = f"{plan['scans_file']}.{os.getpid()}.tmp"
+            scans_df.to_csv(tmp_file, sep="\t", na_rep="n/a", index=False)
+            os.replace(tmp_file, plan["scans_file"])
+        except BaseException:
+            rollback_session(session_dir)
+            raise
+
+    # Keep the journal and trash, so the next run rolls the session back and retries it
+    if failed:
+        raise RuntimeError(f"Failed to split noise scans out of {failed}")
+
+    os.remove(journal_file)
+    shutil.rmtree(trash_dir)
+
+
+def fix_session(session_dir, dry_run=False, n_procs=None):
+    """Plan a session's changes and apply them, unless it's a dry run.
+
+    Returns
+    -------
+    report : :obj:`str`
+    """
+    lines = []
+    if os.path.isfile(os.path.join(session_dir, JOURNAL_FILE)):
+        if dry_run:
+            lines.append("\tAn unfinished run would be rolled back first")
+        else:
+            lines.append("\tRolled back an unfinished run")
+            rollback_session(session_dir)
+    elif os.path.isdir(os.path.join(session_dir, TRASH_DIR)) and not dry_run:
+        # Left behind by a run that finished
+        shutil.rmtree(os.path.join(session_dir, TRASH_DIR))
+
+    plan = plan_session(session_dir)
+    lines.append(format_plan(plan))
+    if not dry_run:
+        apply_plan(plan, n_procs=n_procs)
+
+    return "\n".join(line for line in lines if line)
 
 
 if __name__ == "__main__":
-    dset_dir = "/cbica/projects/executive_function/mebold_trt/dset/"
-    subject_dirs = sorted(glob(os.path.join(dset_dir, "sub-*")))
-    for subject_dir in subject_dirs:
-        sub_id = os.path.basename(subject_dir)
-        session_dirs = sorted(glob(os.path.join(subject_dir, "ses-*")))
-        for session_dir in session_dirs:
-            ses_id = os.path.basename(session_dir)
-            anat_dir = os.path.join(session_dir, "anat")
-            fmap_dir = os.path.join(session_dir, "fmap")
-            func_dir = os.path.join(session_dir, "func")
-
-            # Remove events files
-            events_files = sorted(glob(os.path.join(func_dir, "*_events.tsv")))
-            for events_file in events_files:
-                os.remove(events_file)
-
-            # Load scans file
-            scans_file = os.path.join(session_dir, f"{sub_id}_{ses_id}_scans.tsv")
-            assert os.path.isfile(scans_file), f"Scans file DNE: {scans_file}"
-            scans_df = pd.read_table(scans_file)
-
-            if "sub-01/ses-1" in session_dir:
-                # Rename "frackack" scans to "rest" since no task was performed.
-                frackacks = sorted(
-                    glob(os.path.join(func_dir, "*task-frackack_acq-multiecho*"))
-                )
-                for frackack in frackacks:
-                    frackack_fname = os.path.join("func", os.path.basename(frackack))
-                    out_file = frackack.replace("acq-multiecho_", "acq-multiecho_run-03_")
-                    out_fname = os.path.join("func", os.path.basename(out_file))
-                    os.rename(frackack, out_file)
-                    scans_df = scans_df.replace({"filename": {frackack_fname: out_fname}})
-
-            if "sub-03/ses-1" in session_dir:
-                # Remove duplicate frackack functional scans.
-                dupe_frackacks = sorted(glob(os.path.join(func_dir, "*task-frackack*_dup-*")))
-                for dupe_frackack in dupe_frackacks:
-                    dupe_frackack_fname = os.path.join("func", os.path.basename(dupe_frackack))
-                    print(f"Removing {dupe_frackack_fname}")
-                    os.remove(dupe_frackack)
-                    scans_df = scans_df.loc[scans_df["filename"] != dupe_frackack_fname]
-                    scans_df = scans_df.reset_index(drop=True)
-
-                # Rename rest dupes to run-03.
-                run2_rests = sorted(
-                    glob(os.path.join(func_dir, "*task-rest_acq-multiecho_run-02*_dup-*"))
-                )
-                for run2_rest in run2_rests:
-                    run2_rest_fname = os.path.join("func", os.path.basename(run2_rest))
-                    echo = run2_rest_fname.split("echo-")[1].split("_")[0]
-                    prerun = run2_rest.split("_run-02_")[0]
-                    postrun = run2_rest.split("_run-02_")[1].split("__")[0]
-                    if run2_rest_fname.endswith(".nii.gz"):
-                        ext = ".nii.gz"
-                    else:
-                        ext = ".json"
-
-                    out_file = f"{prerun}_run-03_echo-{echo}_{postrun}{ext}"
-                    out_fname = os.path.join("func", os.path.basename(out_file))
-                    os.rename(run2_rest, out_file)
-                    scans_df = scans_df.replace({"filename": {run2_rest_fname: out_fname}})
-
-            if "sub-05/ses-2" in session_dir:
-                # Delete duplicate functional scans.
-                dupes = sorted(glob(os.path.join(func_dir, "*_dup-*")))
-                for dupe in dupes:
-                    dupe_fname = os.path.join("func", os.path.basename(dupe))
-                    print(f"Removing {dupe_fname}")
-                    scans_df = scans_df.loc[scans_df["filename"] != dupe_fname]
-                    scans_df = scans_df.reset_index(drop=True)
-                    os.remove(dupe)
-
-            if "sub-07/ses-2" in session_dir:
-                # Delete duplicate T1w scans.
-                dupes = sorted(glob(os.path.join(anat_dir, "*T1w*_dup-*")))
-                for dupe in dupes:
-                    dupe_fname = os.path.join("anat", os.path.basename(dupe))
-                    print(f"Removing {dupe_fname}")
-                    scans_df = scans_df.loc[scans_df["filename"] != dupe_fname]
-                    scans_df = scans_df.reset_index(drop=True)
-                    os.remove(dupe)
-
-            # Rename magnitude files from _bold to _part-mag_bold.
-            mag_files = sorted(glob(os.path.join(func_dir, "*echo-*_bold.*")))
-            for mag_file in mag_files:
-                if "part-" in mag_file:
-                    print(f"Skipping {mag_file}")
-                    continue
-
-                new_mag_file = mag_file.replace("_bold.", "_part-mag_bold.")
-                os.rename(mag_file, new_mag_file)
-
-                mag_filename = os.path.join("func", os.path.basename(mag_file))
-                new_mag_filename = os.path.join("func", os.path.basename(new_mag_file))
-
-                # Replace the filename in the scans.tsv file
-                scans_df = scans_df.replace({"filename": {mag_filename: new_mag_filename}})
-
-            # Rename phase files from _phase to _part-phase_bold.
-            phase_files = sorted(glob(os.path.join(func_dir, "*_phase.*")))
-            for phase_file in phase_files:
-                new_phase_file = phase_file.replace("_phase.", "_part-phase_bold.")
-                os.rename(phase_file, new_phase_file)
-
-                phase_filename = os.path.join("func", os.path.basename(phase_file))
-                new_phase_filename = os.path.join("func", os.path.basename(new_phase_file))
-
-                # Replace the filename in the scans.tsv file
-                scans_df = scans_df.replace({"filename": {phase_filename: new_phase_filename}})
-
-            # Rename acq-multiecho files to acq-MBME
-            me_files = sorted(glob(os.path.join(func_dir, "*acq-multiecho*")))
-            for me_file in me_files:
-                new_me_file = me_file.replace("acq-multiecho", "acq-MBME")
-                os.rename(me_file, new_me_file)
-
-                me_filename = os.path.join("func", os.path.basename(me_file))
-                new_me_filename = os.path.join("func", os.path.basename(new_me_file))
-
-                # Replace the filename in the scans.tsv file
-                scans_df = scans_df.replace({"filename": {me_filename: new_me_filename}})
-
-            # Rename acq-singleecho files to acq-MBSE
-            se_files = sorted(glob(os.path.join(func_dir, "*acq-singleecho*")))
-            for se_file in se_files:
-                new_se_file = se_file.replace("acq-singleecho", "acq-MBSE")
-                os.rename(se_file, new_se_file)
-
-                se_filename = os.path.join("func", os.path.basename(se_file))
-                new_se_filename = os.path.join("func", os.path.basename(new_se_file))
-
-                # Replace the filename in the scans.tsv file
-                scans_df = scans_df.replace({"filename": {se_filename: new_se_filename}})
-
-            # Rename task-frackack files to task-fracback
-            fracback_files = sorted(glob(os.path.join(func_dir, "*task-frackack*")))
-            for fracback_file in fracback_files:
-                new_fracback_file = fracback_file.replace("task-frackack", "task-fracback")
-                os.rename(fracback_file, new_fracback_file)
-
-                fracback_filename = os.path.join("func", os.path.basename(fracback_file))
-                new_fracback_filename = os.path.join("func", os.path.basename(new_fracback_file))
-
-                # Replace the filename in the scans.tsv file
-                scans_df = scans_df.replace(
-                    {"filename": {fracback_filename: new_fracback_filename}},
-                )
-
-            # Split out noise scans from all multi-echo BOLD files.
-            me_bolds = sorted(glob(os.path.join(func_dir, "*acq-MBME*_bold.nii.gz")))
-            for me_bold in me_bolds:
-                noise_scan = me_bold.replace("_bold.nii.gz", "_noRF.nii.gz")
-                if os.path.isfile(noise_scan):
-                    print(f"File exists: {os.path.basename(noise_scan)}")
-                    continue
-
-                img = nb.load(me_bold)
-                n_vols = img.shape[-1]
-                if n_vols not in (240, 204, 200):
-                    print(f"File is a partial scan: {os.path.basename(me_bold)}")
-                    continue
-
-                noise_img = img.slicer[..., -N_NOISE_VOLS:]
-                bold_img = img.slicer[..., :-N_NOISE_VOLS]
-
-                # Overwrite the BOLD scan
-                os.remove(me_bold)
-                bold_img.to_filename(me_bold)
-                noise_img.to_filename(noise_scan)
-
-                # Copy the JSON as well
-                shutil.copyfile(
-                    me_bold.replace(".nii.gz", ".json"),
-                    noise_scan.replace(".nii.gz", ".json"),
-                )
-
-                # Add noise scans to scans DataFrame
-                i_row = len(scans_df.index)
-                me_bold_fname = os.path.join("func", os.path.basename(me_bold))
-                noise_fname = os.path.join("func", os.path.basename(noise_scan))
-                scans_df.loc[i_row] = scans_df.loc[scans_df["filename"] == me_bold_fname].iloc[0]
-                scans_df.loc[i_row, "filename"] = noise_fname
-
-            # Copy first echo's sbref of multi-echo field maps without echo entity.
-            me_fmaps = sorted(glob(os.path.join(fmap_dir, "*_acq-ME*_echo-1_sbref.*")))
-            for me_fmap in me_fmaps:
-                out_fmap = me_fmap.replace("_echo-1_", "_").replace("_sbref", "_epi")
-                if os.path.isfile(out_fmap):
-                    print(f"File exists: {os.path.basename(out_fmap)}")
-                    continue
-
-                me_fmap_fname = os.path.join("fmap", os.path.basename(me_fmap))
-                out_fmap_fname = os.path.join("fmap", os.path.basename(out_fmap))
-                shutil.copyfile(me_fmap, out_fmap)
-                if me_fmap.endswith(".nii.gz"):
-                    i_row = len(scans_df.index)
-                    scans_df.loc[i_row] = scans_df.loc[
-                        scans_df["filename"] == me_fmap_fname
-                    ].iloc[0]
-                    scans_df.loc[i_row, "filename"] = out_fmap_fname
-
-            # Save out the modified scans.tsv file.
-            scans_df = scans_df.sort_values(by=["acq_time", "filename"])
-            os.remove(scans_file)
-            scans_df.to_csv(scans_file, sep="\t", na_rep="n/a", index=False)
+    parser = argparse.ArgumentParser(description="Fix BIDS files after heudiconv conversion.")
+    parser.add_argument(
+        "--dset-dir",
+        default="/cbica/projects/executive_function/mebold_trt/dset/",
+        help="BIDS dataset to fix.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print each session's planned changes without making them.",
+    )
+    parser.add_argument(
+        "--n-procs",
+        type=int,
+        default=1,
+        help="Number of sessions to fix concurrently. Default is 1.",
+    )
+    args = parser.parse_args()
+
+    session_dirs = sorted(glob(os.path.join(args.dset_dir, "sub-*", "ses-*")))
+    # Divide the CPUs between the sessions' noise scan splits
+    n_split_procs = max(1, default_n_threads() // args.n_procs)
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.n_procs) as executor:
+        futures = {
+            executor.submit(fix_session, session_dir, args.dry_run, n_split_procs): session_dir
+            for session_dir in session_dirs
+        }
+        for future in as_completed(futures):
+            session_dir = futures[future]
+            session = os.path.relpath(session_dir, args.dset_dir)
+            try:
+                report = future.result()
+            except Exception as exc:
+                print(f"FAILED: {session}")
+                traceback.print_exception(exc)
+                failed.append(session)
+            else:
+                print(f"{'PLANNED' if args.dry_run else 'FINISHED'}: {session}")
+                if report:
+                    print(report)
+
+    if failed:
+        raise RuntimeError(f"Failed to fix {len(failed)} session(s): {failed}")
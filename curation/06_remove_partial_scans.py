@@ -3,11 +3,16 @@
 
 import os
 import shutil
+import sys
 from glob import glob
 
 import nibabel as nb
 import pandas as pd
 
+sys.path.append("..")
+from processing.parallel_gzip import COMPRESSION_LEVELS, save_img
+from processing.split_volumes import split_files
+
 
 def _crop_run_files(
     run_files,
@@ -18,58 +23,59 @@ def _crop_run_files(
 ):
     scans_df = pd.read_table(scans_file)
 
+    # The files are streamed concurrently, each in one pass
+    split_jobs = []
     for run_file in run_files:
-        run_img = nb.load(run_file)
-        n_vols = run_img.shape[3]
+        # Only reads the header
+        n_vols = nb.load(run_file).shape[3]
+        noise_file = run_file.replace("_bold.nii.gz", "_noRF.nii.gz")
         if n_vols == n_uncropped_vols:
             # Split out last two volumes into noise scans
-            noise_file = run_file.replace("_bold.nii.gz", "_noRF.nii.gz")
             if os.path.isfile(noise_file):
                 print(f"File exists: {os.path.basename(noise_file)}")
                 continue
 
-            noise_img = run_img.slicer[..., -n_noise_vols:]
-            run_img = run_img.slicer[..., :-n_noise_vols]
-
             # Overwrite the BOLD scan
-            os.remove(run_file)
-            run_img.to_filename(run_file)
-            noise_img.to_filename(noise_file)
-
-            # Copy the JSON as well
-            shutil.copyfile(
-                run_file.replace(".nii.gz", ".json"),
-                noise_file.replace(".nii.gz", ".json"),
-            )
-
-            # Add noise scans to scans DataFrame
-            i_row = len(scans_df.index)
-            me_bold_fname = os.path.join("func", os.path.basename(run_file))
-            noise_fname = os.path.join("func", os.path.basename(noise_file))
-            scans_df.loc[i_row] = scans_df.loc[
-                scans_df["filename"] == me_bold_fname
-            ].iloc[0]
-            scans_df.loc[i_row, "filename"] = noise_fname
+            splits = [(run_file, n_vols - n_noise_vols), (noise_file, n_noise_vols)]
+            split_jobs.append((run_file, splits))
 
         elif n_vols == n_cropped_vols:
-            noise_file = run_file.replace("_bold.nii.gz", "_noRF.nii.gz")
-            noise_img = nb.load(noise_file)
-            if noise_img.shape[3] <= n_noise_vols:
+            if nb.load(noise_file).shape[3] <= n_noise_vols:
                 print(f"File already cropped: {os.path.basename(noise_file)}")
                 continue
 
-            noise_img = noise_img.slicer[..., :n_noise_vols]
-
             # Overwrite the noise scan
-            os.remove(noise_file)
-            noise_img.to_filename(noise_file)
+            split_jobs.append((noise_file, [(noise_file, n_noise_vols)]))
 
         else:
             print(f"File has {n_vols} volumes: {os.path.basename(run_file)}")
 
+    failed = split_files(split_jobs, compresslevel=COMPRESSION_LEVELS["release"])
+    for in_file, splits in split_jobs:
+        if in_file in failed or len(splits) == 1:
+            continue
+
+        run_file, noise_file = in_file, splits[1][0]
+
+        # Copy the JSON as well
+        shutil.copyfile(
+            run_file.replace(".nii.gz", ".json"),
+            noise_file.replace(".nii.gz", ".json"),
+        )
+
+        # Add noise scans to scans DataFrame
+        i_row = len(scans_df.index)
+        me_bold_fname = os.path.join("func", os.path.basename(run_file))
+        noise_fname = os.path.join("func", os.path.basename(noise_file))
+        scans_df.loc[i_row] = scans_df.loc[
+            scans_df["filename"] == me_bold_fname
+        ].iloc[0]
+        scans_df.loc[i_row, "filename"] = noise_fname
+
     scans_df = scans_df.sort_values(by=["acq_time", "filename"])
     os.remove(scans_file)
     scans_df.to_csv(scans_file, sep="\t", na_rep="n/a", index=False)
+    return failed
 
 
 def fix_sub_04_ses_1_task_fracback(dset_dir):
@@ -99,7 +105,7 @@ def fix_sub_04_ses_1_task_fracback(dset_dir):
 
             # Overwrite the BOLD scan
             os.remove(run_file)
-            run_img.to_filename(run_file)
+            save_img(run_img, run_file, level="release")
 
         elif n_vols != 218:
             print(f"File has {n_vols} volumes: {os.path.basename(run_file)}")
@@ -125,7 +131,7 @@ def fix_sub_04_ses_2_task_fracback(dset_dir):
             )
         )
     )
-    _crop_run_files(
+    return _crop_run_files(
         run_files,
         scans_file,
         n_noise_vols=2,
@@ -154,7 +160,7 @@ def fix_sub_04_ses_2_task_rest_acq_multiecho_run_02(dset_dir):
             )
         )
     )
-    _crop_run_files(
+    return _crop_run_files(
         run_files,
         scans_file,
         n_noise_vols=2,
@@ -170,7 +176,11 @@ if __name__ == "__main__":
     fix_sub_04_ses_1_task_fracback(dset_dir)
     # Split noise scans out of short files (239 vols) and shorten existing
     # noise scans.
-    fix_sub_04_ses_2_task_fracback(dset_dir)
+    failed = fix_sub_04_ses_2_task_fracback(dset_dir)
     # Split noise scans out of short files (203 vols) and shorten existing
     # noise scans.
-    fix_sub_04_ses_2_task_rest_acq_multiecho_run_02(dset_dir)
+    failed += fix_sub_04_ses_2_task_rest_acq_multiecho_run_02(dset_dir)
+
+    # The other files were split and recorded, so a rerun only retries these
+    if failed:
+        raise RuntimeError(f"Failed to split {len(failed)} file(s): {failed}")
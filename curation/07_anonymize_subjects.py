@@ -1,8 +1,24 @@
 #!/cbica/home/salot/miniconda3/envs/salot/bin/python
-"""Anonymize subject IDs in dataset."""
+"""Anonymize subject IDs in dataset.
 
+The dataset is walked once. Every ID is matched in a single pass over each name and
+each file's text, with one compiled pattern of all of the IDs (longest first, so an ID
+that's a prefix of another can't split it), and each match is replaced with its
+mapped ID at the same time, so a new ID is never replaced again by a later mapping.
+
+Files and folders are renamed deepest first, so every path from the walk stays valid
+until it's renamed, and IDs that swap are renamed through temporary names. TSV and
+JSON files are then rewritten in parallel, each to a temporary file that replaces the
+original. Run with ``--dry-run`` to print what would change without changing anything.
+"""
+
+import argparse
 import os
-from pathlib import Path
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import groupby
 
 # NOTE: This ID mapping used to include the actual subject IDs, but they are PII,
 # so we cannot share them here.
@@ -16,46 +32,161 @@ ID_MAPPER = {
     "sub-07": "sub-07",
     "sub-08": "sub-08",
 }
+TEXT_EXTS = (".tsv", ".json")
 
-if __name__ == "__main__":
-    dset_dir = "/cbica/projects/executive_function/mebold_trt/dset"
-
-    # Rename files and folders with new subject IDs
-    for orig_id, new_id in ID_MAPPER.items():
-        all_objects = list(
-            filter(
-                lambda path: not any(
-                    (part for part in path.parts if part.startswith("."))
-                )
-                and orig_id in path.name,
-                Path(dset_dir).rglob("*"),
-            )
-        )
-        all_objects = [o.absolute() for o in all_objects]
-        # Sort files and folders from deep to shallow
-        sorted_objects = sorted(all_objects, key=lambda x: len(x.parts), reverse=True)
-        for obj in sorted_objects:
-            fname = obj.name
-            fpath = obj.parent
-            new_fname = fname.replace(orig_id, new_id)
-            new_obj = fpath.joinpath(new_fname)
-            obj.rename(new_obj)
+
+@lru_cache
+def _id_pattern(id_items):
+    """Compile one pattern that matches every ID that changes."""
+    orig_ids = sorted((o for o, n in id_items if o != n), key=len, reverse=True)
+    if not orig_ids:
+        return None
+
+    return re.compile("|".join(re.escape(orig_id) for orig_id in orig_ids))
+
+
+def anonymize_text(text, id_mapper=ID_MAPPER):
+    """Replace every ID in a string in one pass.
+
+    Returns
+    -------
+    text : :obj:`str`
+    n_replaced : :obj:`int`
+    """
+    pattern = _id_pattern(tuple(id_mapper.items()))
+    if pattern is None:
+        return text, 0
+
+    return pattern.subn(lambda match: id_mapper[match.group(0)], text)
+
+
+def plan_anonymization(dset_dir, id_mapper=ID_MAPPER):
+    """Walk the dataset once and plan its renames and text rewrites.
+
+    Hidden files and folders are skipped.
+
+    Returns
+    -------
+    renames : :obj:`list` of (:obj:`str`, :obj:`str`) tuples
+        Old and new paths, deepest first.
+    text_files : :obj:`list` of (:obj:`str`, :obj:`str`) tuples
+        TSV and JSON files' paths before and after the renames.
+    """
+    renames = []
+    text_files = []
+    for root, dirs, files in os.walk(dset_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        files = [f for f in files if not f.startswith(".")]
+        new_root = anonymize_text(os.path.relpath(root, dset_dir), id_mapper)[0]
+        for name in dirs + files:
+            new_name, n_replaced = anonymize_text(name, id_mapper)
+            if n_replaced:
+                renames.append((os.path.join(root, name), os.path.join(root, new_name)))
+
+            if name in files and name.endswith(TEXT_EXTS):
+                new_path = os.path.normpath(os.path.join(dset_dir, new_root, new_name))
+                text_files.append((os.path.join(root, name), new_path))
+
+    # Sort files and folders from deep to shallow
+    renames.sort(key=lambda rename: rename[0].count(os.sep), reverse=True)
+    # A target may exist only if it's renamed too (e.g., two IDs that swap)
+    sources = {old for old, _ in renames}
+    collisions = [new for _, new in renames if new not in sources and os.path.lexists(new)]
+    if collisions:
+        raise FileExistsError(f"Renames would overwrite {collisions}")
+
+    return renames, text_files
+
+
+def rewrite_file(text_file, id_mapper=ID_MAPPER, dry_run=False):
+    """Replace the IDs in a text file, atomically.
+
+    Returns
+    -------
+    n_replaced : :obj:`int`
+    """
+    with open(text_file, "r") as fo:
+        data, n_replaced = anonymize_text(fo.read(), id_mapper)
+
+    if n_replaced and not dry_run:
+        tmp_file = f"{text_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as fo:
+            fo.write(data)
+        shutil.copymode(text_file, tmp_file)
+        os.replace(tmp_file, text_file)
+
+    return n_replaced
+
+
+def anonymize_dataset(dset_dir, id_mapper=ID_MAPPER, dry_run=False, n_procs=None):
+    """Rename files and folders and rewrite TSV and JSON files with new subject IDs."""
+    renames, text_files = plan_anonymization(dset_dir, id_mapper)
+
+    # Rename files and folders with new subject IDs, one depth at a time. Paths that
+    # another rename still needs go through a temporary name, so a swap can't collide.
+    sources = {old for old, _ in renames}
+    for _, depth_renames in groupby(renames, key=lambda rename: rename[0].count(os.sep)):
+        staged = []
+        for old, new in depth_renames:
+            print(f"\tRENAME: {os.path.relpath(old, dset_dir)} -> {os.path.basename(new)}")
+            if dry_run:
+                continue
+
+            if new in sources:
+                tmp = f"{new}.{os.getpid()}.tmp"
+                os.rename(old, tmp)
+                staged.append((tmp, new))
+            else:
+                os.rename(old, new)
+
+        for tmp, new in staged:
+            os.rename(tmp, new)
+
+    # The files have only been renamed if this isn't a dry run
+    text_files = [path if dry_run else new_path for path, new_path in text_files]
 
     # Replace subject IDs inside JSON and TSV files
-    all_files = list(
-        filter(
-            lambda path: not any((part for part in path.parts if part.startswith("."))),
-            Path(dset_dir).rglob("*"),
+    with ProcessPoolExecutor(max_workers=n_procs) as executor:
+        n_replaced = list(
+            executor.map(
+                rewrite_file,
+                text_files,
+                [id_mapper] * len(text_files),
+                [dry_run] * len(text_files),
+                chunksize=64,
+            )
         )
-    )
-    exts = [".tsv", ".json"]
-    all_files = [f.absolute() for f in all_files if f.suffix in exts]
-    for file_ in all_files:
-        data = file_.read_text()
-        os.remove(file_)
 
-        for orig_id, new_id in ID_MAPPER.items():
-            data = data.replace(orig_id, new_id)
+    n_rewritten = 0
+    for text_file, n in zip(text_files, n_replaced):
+        if n:
+            print(f"\tREWRITE: {os.path.relpath(text_file, dset_dir)} ({n} IDs)")
+            n_rewritten += 1
 
-        with open(str(file_), "w") as fo:
-            fo.write(data)
+    if dry_run:
+        print(f"Would rename {len(renames)} files and folders and rewrite {n_rewritten} of "
+              f"{len(text_files)} text files")
+    else:
+        print(f"Renamed {len(renames)} files and folders and rewrote {n_rewritten} of "
+              f"{len(text_files)} text files")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Anonymize subject IDs in dataset.")
+    parser.add_argument(
+        "--dset-dir",
+        default="/cbica/projects/executive_function/mebold_trt/dset",
+        help="BIDS dataset to anonymize.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the renames and rewrites without making them.",
+    )
+    parser.add_argument(
+        "--n-procs",
+        type=int,
+        help="Number of processes for rewriting text files. Defaults to the number of CPUs.",
+    )
+    args = parser.parse_args()
+    anonymize_dataset(args.dset_dir, dry_run=args.dry_run, n_procs=args.n_procs)
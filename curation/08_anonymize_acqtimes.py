@@ -6,50 +6,121 @@ scan is set to January 1st, 1800. In a longitudinal study, each session is
 anonymized relative to the first session, so that time between sessions is
 preserved.
 
+Every scans.tsv file is read at once, and their acquisition times are parsed and
+shifted together, with each subject's offset computed from their first session's
+file. The files are then written back in parallel.
+
 Overwrites scan tsv files in dataset. Only run this *after* data collection
 is complete for the study, especially if it's longitudinal.
 """
 
+import argparse
 import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from glob import glob
 
 import pandas as pd
-from dateutil import parser
+
+BASELINE = pd.Timestamp("1800-01-01")
+
+
+def shift_acq_times(scans_dfs):
+    """Shift every scans file's acquisition times relative to its subject's first scan.
+
+    Parameters
+    ----------
+    scans_dfs : :obj:`dict`
+        Scans DataFrames by file, for any number of subjects.
+
+    Returns
+    -------
+    shifted : :obj:`dict`
+        Shifted acquisition times by file, as datetimes.
+    """
+    acq_times = pd.concat(
+        {scans_file: df["acq_time"] for scans_file, df in scans_dfs.items()},
+        names=["scans_file", "row"],
+    ).reset_index()
+    acq_times["subject"] = acq_times["scans_file"].map(
+        lambda f: os.path.basename(os.path.dirname(os.path.dirname(f)))
+    )
+
+    # Anonymize in terms of first scan in each subject's first session.
+    first_files = acq_times.groupby("subject")["scans_file"].transform("min")
+    first_scans = (
+        acq_times.loc[acq_times["scans_file"] == first_files]
+        .groupby("subject")["acq_time"]
+        .min()
+    )
+    first_dts = pd.to_datetime(first_scans.str.split("T").str[0], format="ISO8601")
+    diffs = acq_times["subject"].map(first_dts - BASELINE)
+
+    shifted = pd.to_datetime(acq_times["acq_time"], format="ISO8601") - diffs
+    shifted.index = acq_times["row"]
+
+    # The files' rows are in order, so split them back out by position
+    shifted_by_file = {}
+    start = 0
+    for scans_file, df in scans_dfs.items():
+        stop = start + len(df)
+        shifted_by_file[scans_file] = shifted.iloc[start:stop]
+        start = stop
+
+    return shifted_by_file
+
+
+def write_scans(scans_file, df, acq_times):
+    """Write a scans file with new acquisition times, atomically."""
+    df = df.copy()
+    df["acq_time"] = acq_times.astype(str).str.replace(" ", "T")
+
+    tmp_file = f"{scans_file}.{os.getpid()}.tmp"
+    df.to_csv(
+        tmp_file,
+        sep="\t",
+        lineterminator="\n",
+        na_rep="n/a",
+        index=False,
+    )
+    os.replace(tmp_file, scans_file)
+
 
 if __name__ == "__main__":
-    dset_dir = "/cbica/projects/executive_function/mebold_trt/dset"
-
-    bl_dt = parser.parse("1800-01-01")
-
-    subject_dirs = sorted(glob(os.path.join(dset_dir, "sub-*")))
-    for subject_dir in subject_dirs:
-        sub_id = os.path.basename(subject_dir)
-        print(f"Processing {sub_id}")
-
-        scans_files = sorted(glob(os.path.join(subject_dir, "ses-*/*_scans.tsv")))
-
-        for i_ses, scans_file in enumerate(scans_files):
-            ses_dir = os.path.dirname(scans_file)
-            ses_name = os.path.basename(ses_dir)
-            print(f"\t{ses_name}")
-
-            df = pd.read_table(scans_file)
-            if i_ses == 0:
-                # Anonymize in terms of first scan for subject.
-                first_scan = df["acq_time"].min()
-                first_dt = parser.parse(first_scan.split("T")[0])
-                diff = first_dt - bl_dt
-
-            acq_times = df["acq_time"].apply(parser.parse)
-            acq_times = (acq_times - diff).astype(str)
-            df["acq_time"] = acq_times
-            df["acq_time"] = df["acq_time"].str.replace(" ", "T")
-
-            os.remove(scans_file)
-            df.to_csv(
-                scans_file,
-                sep="\t",
-                lineterminator="\n",
-                na_rep="n/a",
-                index=False,
-            )
+    parser = argparse.ArgumentParser(description="Anonymize acquisition datetimes.")
+    parser.add_argument(
+        "--dset-dir",
+        default="/cbica/projects/executive_function/mebold_trt/dset",
+        help="BIDS dataset to anonymize.",
+    )
+    parser.add_argument(
+        "--n-procs",
+        type=int,
+        help="Number of scans files to write concurrently. Defaults to the number of CPUs.",
+    )
+    args = parser.parse_args()
+
+    scans_files = sorted(glob(os.path.join(args.dset_dir, "sub-*", "ses-*", "*_scans.tsv")))
+    with ThreadPoolExecutor(max_workers=args.n_procs) as executor:
+        scans_dfs = dict(zip(scans_files, executor.map(pd.read_table, scans_files)))
+
+    shifted = shift_acq_times(scans_dfs)
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.n_procs) as executor:
+        futures = {
+            executor.submit(write_scans, f, scans_dfs[f], shifted[f]): f for f in scans_files
+        }
+        for future in as_completed(futures):
+            name = os.path.relpath(futures[future], args.dset_dir)
+            try:
+                future.result()
+            except Exception as exc:
+                print(f"FAILED: {name}")
+                traceback.print_exception(exc)
+                failed.append(name)
+            else:
+                print(f"DONE: {name}")
+
+    if failed:
+        raise RuntimeError(f"Failed to write {len(failed)} scans file(s): {failed}")
@@ -1,29 +1,46 @@
 #!/cbica/home/salot/miniconda3/envs/salot/bin/python
-"""Remove unneeded fields from bottom-level JSON files."""
+"""Remove unneeded fields from bottom-level JSON files.
 
-import json
+The sidecars are loaded and cleaned in memory, and only the ones that change are
+written, so rerunning this script writes nothing. Every sidecar is marked for writing,
+so that any that weren't written with our formatting are normalized too.
+"""
+
+import argparse
 import os
-from glob import glob
+import sys
 
-if __name__ == "__main__":
-    dset_dir = "/cbica/projects/executive_function/mebold_trt/dset/"
-    drop_keys = [
-        "AcquisitionTime",
-        "CogAtlasID",
-        "InstitutionAddress",
-        "TaskName",
-        "ImageComments",
-    ]
+sys.path.append("..")
+from processing.sidecar_store import SidecarStore
 
-    json_files = sorted(glob(os.path.join(dset_dir, "sub-*/ses-*/*/*.json")))
-    for json_file in json_files:
-        with open(json_file, "r") as fo:
-            json_data = json.load(fo)
+DROP_KEYS = [
+    "AcquisitionTime",
+    "CogAtlasID",
+    "InstitutionAddress",
+    "TaskName",
+    "ImageComments",
+]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remove unneeded fields from JSON files.")
+    parser.add_argument(
+        "--dset-dir",
+        default="/cbica/projects/executive_function/mebold_trt/dset/",
+        help="BIDS dataset to clean.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the JSON files that would change without writing them.",
+    )
+    args = parser.parse_args()
 
-        for drop_key in drop_keys:
-            if drop_key in json_data.keys():
-                json_data.pop(drop_key)
+    store = SidecarStore(args.dset_dir)
+    store.mark_dirty()
+    store.drop_keys(DROP_KEYS)
+    changed = store.flush(dry_run=args.dry_run)
+    for json_file in changed:
+        print(f"\tUPDATED: {os.path.relpath(json_file, args.dset_dir)}")
 
-        os.remove(json_file)
-        with open(json_file, "w") as fo:
-            json.dump(json_data, fo, indent=4, sort_keys=True)
+    action = "Would update" if args.dry_run else "Updated"
+    print(f"{action} {len(changed)} of {len(store)} JSON files")
@@ -2,17 +2,32 @@
 """Fix BIDS files after heudiconv conversion.
 
 Copy first echo of each multi-echo field map without echo entity.
+The sidecars are copied in the sidecar store and written together at the end.
 """
 
+import argparse
+import copy
 import os
 import shutil
+import sys
 from glob import glob
 
 import pandas as pd
 
+sys.path.append("..")
+from processing.sidecar_store import SidecarStore
 
 if __name__ == "__main__":
-    dset_dir = "/cbica/projects/executive_function/mebold_trt/dset/"
+    parser = argparse.ArgumentParser(description="Copy first echo of multi-echo field maps.")
+    parser.add_argument(
+        "--dset-dir",
+        default="/cbica/projects/executive_function/mebold_trt/dset/",
+        help="BIDS dataset to fix.",
+    )
+    args = parser.parse_args()
+    dset_dir = args.dset_dir
+
+    store = SidecarStore(dset_dir)
     subject_dirs = sorted(glob(os.path.join(dset_dir, "sub-*")))
     for subject_dir in subject_dirs:
         sub_id = os.path.basename(subject_dir)
@@ -30,10 +45,14 @@ if __name__ == "__main__":
             me_fmaps = sorted(glob(os.path.join(fmap_dir, "*_acq-MESE*echo-1_epi.*")))
             for me_fmap in me_fmaps:
                 out_fmap = me_fmap.replace("_echo-1_", "_")
-                if os.path.isfile(out_fmap):
+                if os.path.isfile(out_fmap) or out_fmap in store:
                     print(f"File exists: {os.path.basename(out_fmap)}")
                     continue
 
+                if me_fmap.endswith(".json"):
+                    store.add(out_fmap, copy.deepcopy(store[me_fmap]))
+                    continue
+
                 me_fmap_fname = os.path.join("fmap", os.path.basename(me_fmap))
                 out_fmap_fname = os.path.join("fmap", os.path.basename(out_fmap))
                 shutil.copyfile(me_fmap, out_fmap)
@@ -48,3 +67,5 @@ if __name__ == "__main__":
             scans_df = scans_df.sort_values(by=["acq_time", "filename"])
             os.remove(scans_file)
             scans_df.to_csv(scans_file, sep="\t", na_rep="n/a", index=False)
+
+    store.flush()
@@ -1,10 +1,17 @@
 """Check that multi-echo scans are the right length."""
 
+import sys
+
 from bids import BIDSLayout
 from bids.layout import Query
-import nibabel as nb
+
+sys.path.append("..")
+from processing.metadata_index import MetadataIndex
 
 layout = BIDSLayout("/cbica/projects/executive_function/mebold_trt/ds005250", validate=False)
+metadata_index = MetadataIndex(
+    "/cbica/projects/executive_function/mebold_trt/derivatives/metadata_index.json"
+)
 files = layout.get(echo=1, reconstruction="nordic", part="mag", suffix=["noRF", "bold"], extension=["nii.gz"])
 for f in files:
     print(f.filename)
@@ -17,7 +24,7 @@ for f in files:
         if len(echo_file) != 1:
             raise ValueError(f"Something's wrong with {file_entities}\n{len(echo_file)} files found:\n{echo_file}")
 
-        img_size = nb.load(echo_file[0].path).shape
+        img_size = tuple(metadata_index.get(echo_file[0].path)["shape"])
         size_check[f"mag_{i_echo}"] = img_size
 
     file_entities["part"] = "phase"
@@ -27,7 +34,7 @@ for f in files:
         if len(echo_file) != 1:
             raise ValueError(f"Something's wrong with {file_entities}\n{len(echo_file)} files found:\n{echo_file}")
 
-        img_size = nb.load(echo_file[0].path).shape
+        img_size = tuple(metadata_index.get(echo_file[0].path)["shape"])
         size_check[f"phase_{i_echo}"] = img_size
 
     test_size = size_check["mag_1"]
@@ -37,3 +44,5 @@ for f in files:
     for k, v in size_check.items():
         if test_size != v:
             print(f"Size of {k} ({v}) != {f.filename} ({test_size})")
+
+metadata_index.save()
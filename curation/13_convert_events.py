@@ -1,8 +1,25 @@
 #!/usr/bin/env python
 # coding: utf-8
-"""Parse fractal n-back log files and convert them to BIDS format."""
-
+"""Parse fractal n-back log files and convert them to BIDS format.
+
+The stimulus tables are read once and shared by every log. Each log's event table is
+parsed in one call to :func:`pandas.read_csv`, and the logs are converted in parallel.
+Each response is assigned to the last trial that started before it with a sorted
+search over the trial onsets, and the trials are classified with boolean masks.
+
+Logs for the same session (e.g., from a restarted task) convert to the same events
+file, so only the last of them in sorted order is converted, as when the logs were
+converted one at a time. Events files are written to a temporary file first and then
+moved into place.
+"""
+
+import argparse
+import csv
+import io
 import os
+import re
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from glob import glob
 
 import numpy as np
@@ -20,28 +37,29 @@ ID_MAPPER = {
     "07": "sub-07",
     "08": "sub-08",
 }
+TRIAL_TYPES = {
+    "stimuli/mask_Fix_xhair.jpg": "fixation",
+    "stimuli/crosshair.jpg": "fixation",
+    "stimuli/2back_img_0.jpg": "instruction",
+    "stimuli/2back_img_2.jpg": "instruction",
+}
+CONDITIONS = {
+    "stimuli/2back_img_0.jpg": "0back",
+    "stimuli/2back_img_2.jpg": "2back",
+}
+STIM_0BACK = "stimuli/fnb_formB_19.jpg"
 
 
-def main(in_file):
-    subject_session = os.path.basename(in_file).split("-")[0]
-    subject, session = subject_session.split("_")
-    subject_id = ID_MAPPER.get(subject, None)
-    if not subject_id:
-        print(f"Subject {subject}_{session} does not match anything.")
-        return
-
-    print(f"Processing {subject_id} ses-{session}...")
-    out_file = os.path.join(
-        subject_id,
-        f"ses-{session}",
-        "func",
-        f"{subject_id}_ses-{session}_task-fracback_acq-MBME_events.tsv",
-    )
-    os.makedirs(os.path.dirname(out_file), exist_ok=True)
-
-    with open(in_file, "r") as fo:
-        orig_data = fo.read()
+def load_stimuli():
+    """Read the stimulus tables.
 
+    Returns
+    -------
+    stimuli_df : :obj:`pandas.DataFrame`
+        Trial events, in order.
+    grouped_trial_df : :obj:`pandas.DataFrame`
+        Every event, with fixations and instructions grouped into blocks.
+    """
     trial_df = pd.read_table("stimuli_and_timing_ungrouped.tsv")
 
     stimuli_df = trial_df.loc[trial_df["event_type"] == "trial"]
@@ -49,154 +67,135 @@ def main(in_file):
 
     grouped_trial_df = pd.read_table("stimuli_and_timing_grouped.tsv")
     grouped_trial_df["overall"] = grouped_trial_df.index.values + 1
+    return stimuli_df, grouped_trial_df
 
-    data = orig_data.split("\n")
-    header_idx = [i for i, r in enumerate(data) if r.startswith("Subject")][0]
-    end_idx = [i for i, r in enumerate(data) if r == "{"][0]
-    data = data[header_idx:end_idx]
-    data = [r for r in data if r]
-    data = [r.split("\t") for r in data]
-    n_cols = len(data[0])
-    new_data = []
-    for row in data:
-        n_missing = n_cols - len(row)
-        new_row = row + ([None] * n_missing)
-        new_data.append(new_row)
-
-    df = pd.DataFrame(columns=new_data[0], data=new_data[1:])
 
-    df = df.loc[df["Event Type"].isin(["Picture", "Response"])]
+def read_log(in_file):
+    """Read the event table of a Presentation log file, as strings."""
+    with open(in_file, "r") as fo:
+        orig_data = fo.read()
 
-    subject_trial_df = df.loc[df["Code"] == "pic1"]
-    subject_trial_df["Time"] = subject_trial_df["Time"].astype(float)
-    subject_trial_df = subject_trial_df[["Trial", "Time"]]
-    subject_trial_df = subject_trial_df.reset_index(drop=True)
+    # The event table runs from its header to the line with just "{"
+    start = re.search(r"^Subject", orig_data, flags=re.MULTILINE).start()
+    stop = re.search(r"^\{$", orig_data, flags=re.MULTILINE).start()
+    return pd.read_csv(
+        io.StringIO(orig_data[start:stop]),
+        sep="\t",
+        dtype=str,
+        quoting=csv.QUOTE_NONE,
+        keep_default_na=False,
+    )
 
-    combined_trial_df = pd.concat((stimuli_df, subject_trial_df), axis=1)
-    combined_trial_df = combined_trial_df.loc[
-        combined_trial_df["stim_file"] != "stimuli/crosshair.jpg"
-    ]
-    combined_trial_df["Time"] = combined_trial_df["Time"].astype(float)
-    combined_trial_df = combined_trial_df.reset_index(drop=True)
-    combined_trial_df["trial"] = combined_trial_df.index.values + 1
 
-    response_df = df.loc[df["Event Type"] == "Response"]
-    response_df["Time At Response"] = response_df["Time"].astype(float)
-    response_df = response_df[["Trial", "Time At Response", "TTime"]]
-
-    combined_trial_df["response_time"] = np.nan
-    trial_times = combined_trial_df["Time"].values
-    for time_at_response in response_df["Time At Response"].values:
-        trial_idx = np.where(time_at_response > trial_times)[0]
-        if trial_idx.size:
-            trial_idx = trial_idx[-1]
-            combined_trial_df.loc[trial_idx, "response_time"] = (
-                time_at_response - trial_times[trial_idx]
-            )
+def match_responses(trial_times, response_times):
+    """Get each trial's response time from the last response that followed it.
 
-    # Time seems to be in tenths of milliseconds (1 / 10000 second)
-    combined_trial_df["response_time"] = combined_trial_df["response_time"] / 10000
-    result = pd.merge(grouped_trial_df, combined_trial_df, on="trial", how="outer")
+    Each response goes to the last trial that started strictly before it.
 
-    result = result.sort_values(by="overall")
-    result["trial_type"] = "trial"
-    result.loc[result["stim_file_x"] == "stimuli/mask_Fix_xhair.jpg", "trial_type"] = (
-        "fixation"
-    )
-    result.loc[result["stim_file_x"] == "stimuli/crosshair.jpg", "trial_type"] = (
-        "fixation"
-    )
-    result.loc[result["stim_file_x"] == "stimuli/2back_img_0.jpg", "trial_type"] = (
-        "instruction"
-    )
-    result.loc[result["stim_file_x"] == "stimuli/2back_img_2.jpg", "trial_type"] = (
-        "instruction"
-    )
-    result["condition"] = None
-    result.loc[result["stim_file_x"] == "stimuli/2back_img_0.jpg", "condition"] = (
-        "0back"
-    )
-    result.loc[result["stim_file_x"] == "stimuli/2back_img_2.jpg", "condition"] = (
-        "2back"
-    )
-    result["condition"] = result["condition"].ffill()
-    result.loc[
-        (result["trial_type"] == "trial") & (result["condition"] == "0back"),
-        "trial_type",
-    ] = "0back"
-    result.loc[
-        (result["trial_type"] == "trial") & (result["condition"] == "2back"),
-        "trial_type",
-    ] = "2back"
-    result = result.reset_index(drop=True)
-    onsets = result["duration_x"].cumsum().values
-    onsets = np.hstack(([0], onsets))[:-1]
-    result["onset"] = onsets
+    Returns
+    -------
+    response_times : :obj:`numpy.ndarray`
+        Time from each trial's onset to its response, or NaN if there wasn't one.
+    """
+    valid_trials = np.flatnonzero(~np.isnan(trial_times))
+    valid_times = trial_times[valid_trials]
+    if np.any(np.diff(valid_times) < 0):
+        raise ValueError("Trial times are out of order")
+
+    i_trials = np.searchsorted(valid_times, response_times, side="left") - 1
+    matched = i_trials >= 0
+    responses = pd.Series(response_times[matched], index=valid_trials[i_trials[matched]])
+    # A later response to the same trial replaces an earlier one
+    responses = responses[~responses.index.duplicated(keep="last")]
 
-    result[["onset", "duration_x", "trial_type", "response_time", "stim_file_x"]]
-    result["stim_file_x_2before"] = result["stim_file_x"].shift(4)
+    trial_response_times = np.full(trial_times.shape, np.nan)
+    trial_response_times[responses.index] = responses.values - trial_times[responses.index]
+    return trial_response_times
 
-    result["correct"] = None
-    result["classification"] = None
 
+def classify_trials(result):
+    """Classify trials as true or false positives or negatives."""
     resp_idx = result["response_time"] > 0
     noresp_idx = ~resp_idx
 
-    # 0back
-    stim_0back = "stimuli/fnb_formB_19.jpg"
     idx_0back = result["trial_type"] == "0back"
-    idx_pos_0back = result["stim_file_x"] == stim_0back
-    idx_neg_0back = result["stim_file_x"] != stim_0back
-
-    # 0back true positives
-    result.loc[idx_0back & resp_idx & idx_pos_0back, "correct"] = True
-    result.loc[idx_0back & resp_idx & idx_pos_0back, "classification"] = "true positive"
-
-    # 0back true negatives
-    result.loc[idx_0back & noresp_idx & idx_neg_0back, "correct"] = True
-    result.loc[idx_0back & noresp_idx & idx_neg_0back, "classification"] = (
-        "true negative"
-    )
-
-    # 0back false negatives
     idx_2back = result["trial_type"] == "2back"
-    result.loc[idx_0back & noresp_idx & idx_pos_0back, "correct"] = False
-    result.loc[idx_0back & noresp_idx & idx_pos_0back, "classification"] = (
-        "false negative"
+    # 0back targets are one stimulus, and 2back targets match the stimulus 2 trials back
+    stim_2before = result["stim_file_x"].shift(4)
+    idx_pos = (idx_0back & (result["stim_file_x"] == STIM_0BACK)) | (
+        idx_2back & (result["stim_file_x"] == stim_2before)
+    )
+    idx_neg = (idx_0back & (result["stim_file_x"] != STIM_0BACK)) | (
+        idx_2back & (result["stim_file_x"] != stim_2before)
     )
 
-    # 0back false positives
-    result.loc[idx_0back & resp_idx & idx_neg_0back, "correct"] = True
-    result.loc[idx_0back & resp_idx & idx_neg_0back, "classification"] = (
-        "false positive"
+    return np.select(
+        [
+            resp_idx & idx_pos,
+            noresp_idx & idx_neg,
+            noresp_idx & idx_pos,
+            resp_idx & idx_neg,
+        ],
+        ["true positive", "true negative", "false negative", "false positive"],
+        default=None,
     )
 
-    # 2back
-    idx_2back = result["trial_type"] == "2back"
-    idx_pos_2back = result["stim_file_x"] == result["stim_file_x_2before"]
-    idx_neg_2back = result["stim_file_x"] != result["stim_file_x_2before"]
 
-    # 2back true positives
-    result.loc[idx_2back & resp_idx & idx_pos_2back, "correct"] = True
-    result.loc[idx_2back & resp_idx & idx_pos_2back, "classification"] = "true positive"
+def events_path(in_file):
+    """Get the events file a log converts to, or None if its subject isn't in ID_MAPPER."""
+    subject_session = os.path.basename(in_file).split("-")[0]
+    subject, session = subject_session.split("_")
+    subject_id = ID_MAPPER.get(subject, None)
+    if not subject_id:
+        return None
 
-    # 2back true negatives
-    result.loc[idx_2back & noresp_idx & idx_neg_2back, "correct"] = True
-    result.loc[idx_2back & noresp_idx & idx_neg_2back, "classification"] = (
-        "true negative"
+    return os.path.join(
+        subject_id,
+        f"ses-{session}",
+        "func",
+        f"{subject_id}_ses-{session}_task-fracback_acq-MBME_events.tsv",
     )
 
-    # 2back false negatives
-    result.loc[idx_2back & noresp_idx & idx_pos_2back, "correct"] = False
-    result.loc[idx_2back & noresp_idx & idx_pos_2back, "classification"] = (
-        "false negative"
-    )
 
-    # 2back false positives
-    result.loc[idx_2back & resp_idx & idx_neg_2back, "correct"] = True
-    result.loc[idx_2back & resp_idx & idx_neg_2back, "classification"] = (
-        "false positive"
+def main(in_file, stimuli_df, grouped_trial_df):
+    out_file = events_path(in_file)
+    if out_file is None:
+        subject_session = os.path.basename(in_file).split("-")[0]
+        print(f"Subject {subject_session} does not match anything.")
+        return
+
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+
+    df = read_log(in_file)
+    df = df.loc[df["Event Type"].isin(["Picture", "Response"])]
+
+    subject_trial_df = df.loc[df["Code"] == "pic1", ["Trial", "Time"]]
+    subject_trial_df = subject_trial_df.astype({"Time": float}).reset_index(drop=True)
+
+    combined_trial_df = pd.concat((stimuli_df, subject_trial_df), axis=1)
+    combined_trial_df = combined_trial_df.loc[
+        combined_trial_df["stim_file"] != "stimuli/crosshair.jpg"
+    ]
+    combined_trial_df = combined_trial_df.reset_index(drop=True)
+    combined_trial_df["trial"] = combined_trial_df.index.values + 1
+
+    response_times = df.loc[df["Event Type"] == "Response", "Time"].astype(float).values
+    trial_response_times = match_responses(
+        combined_trial_df["Time"].values.astype(float), response_times
     )
+    # Time seems to be in tenths of milliseconds (1 / 10000 second)
+    combined_trial_df["response_time"] = trial_response_times / 10000
+    result = pd.merge(grouped_trial_df, combined_trial_df, on="trial", how="outer")
+
+    result = result.sort_values(by="overall")
+    trial_type = result["stim_file_x"].map(TRIAL_TYPES).fillna("trial")
+    condition = result["stim_file_x"].map(CONDITIONS).ffill()
+    result["trial_type"] = trial_type.mask((trial_type == "trial") & condition.notna(), condition)
+    result = result.reset_index(drop=True)
+    onsets = result["duration_x"].cumsum().values
+    onsets = np.hstack(([0], onsets))[:-1]
+    result["onset"] = onsets
+    result["classification"] = classify_trials(result)
 
     result2 = result[
         [
@@ -216,14 +215,60 @@ def main(in_file):
             "trial": "trial_number",
         }
     )
-    result2.to_csv(out_file, sep="\t", index=False, na_rep="n/a")
+    tmp_file = f"{out_file}.{os.getpid()}.tmp"
+    result2.to_csv(tmp_file, sep="\t", index=False, na_rep="n/a")
+    os.replace(tmp_file, out_file)
+    return out_file
 
 
 if __name__ == "__main__":
-    log_files = sorted(
-        glob(
-            "/cbica/projects/executive_function/mebold_trt/sourcedata/task_log_files/*.log",
-        ),
+    parser = argparse.ArgumentParser(description="Convert fractal n-back logs to BIDS.")
+    parser.add_argument(
+        "--log-dir",
+        default="/cbica/projects/executive_function/mebold_trt/sourcedata/task_log_files",
+        help="Folder with the Presentation log files.",
     )
+    parser.add_argument(
+        "--n-procs",
+        type=int,
+        help="Number of logs to convert concurrently. Defaults to the number of CPUs.",
+    )
+    args = parser.parse_args()
+
+    log_files = sorted(glob(os.path.join(args.log_dir, "*.log")))
+    stimuli_df, grouped_trial_df = load_stimuli()
+
+    # Only convert the last log for each events file, so two workers never write one file
+    last_logs = {}
     for log_file in log_files:
-        main(log_file)
+        last_logs[events_path(log_file) or log_file] = log_file
+
+    for log_file in log_files:
+        last_log = last_logs.get(events_path(log_file) or log_file)
+        if last_log != log_file:
+            print(
+                f"SKIPPED: {os.path.basename(log_file)} "
+                f"(superseded by {os.path.basename(last_log)})"
+            )
+    log_files = sorted(last_logs.values())
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.n_procs) as executor:
+        futures = {
+            executor.submit(main, log_file, stimuli_df, grouped_trial_df): log_file
+            for log_file in log_files
+        }
+        for future in as_completed(futures):
+            log_file = os.path.basename(futures[future])
+            try:
+                out_file = future.result()
+            except Exception as exc:
+                print(f"FAILED: {log_file}")
+                traceback.print_exception(exc)
+                failed.append(log_file)
+            else:
+                if out_file:
+                    print(f"DONE: {log_file} -> {out_file}")
+
+    if failed:
+        raise RuntimeError(f"Failed to convert {len(failed)} log(s): {failed}")
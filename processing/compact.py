@@ -0,0 +1,335 @@
+"""Mask-compacted echo stacks for running tedana with less memory.
+
+tedana loads every echo over the full field of view with ``get_fdata``, so a run
+with five echoes holds several float64 copies of mostly out-of-brain voxels.
+Here each echo is streamed once, a few volumes at a time, into a
+(voxels x echoes x time) memory-mapped array that only covers the brain mask.
+tedana reads that array instead of the echo files, and its image outputs are put
+back in the original space afterwards.
+
+tedana's reports plot maps on a 3D grid, so the stack covers the mask's bounding box
+rather than a flat list of in-mask voxels. Voxels outside the mask are zeroed.
+
+The stack is stored as float32 when the echoes' values fit it exactly, and tedana is
+given it as float64, like ``get_fdata`` would, so it sees the same in-mask values.
+:func:`benchmark` checks a compact run's outputs against a full-FOV run's; run it with
+``python -m processing.compact`` from the repository root.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+import nibabel as nb
+import numpy as np
+import pandas as pd
+from tedana import io as tedana_io
+from tedana.workflows import tedana_workflow
+
+from processing.decay import _simulate
+from processing.parallel_gzip import save_img
+
+
+def mask_bounding_box(mask_data):
+    """Get the slices that bound the nonzero voxels of a 3D mask."""
+    coords = np.nonzero(mask_data)
+    if not coords[0].size:
+        raise ValueError("Mask is empty")
+
+    return tuple(slice(int(c.min()), int(c.max()) + 1) for c in coords)
+
+
+def _stack_dtype(echo_imgs):
+    """Get float32 if every echo's values are exactly representable in it, else float64.
+
+    Scaled echoes are float64, since nibabel applies scale factors in float64 for
+    ``get_fdata`` but in the scale factors' own dtype when slicing.
+    """
+    for echo_img in echo_imgs:
+        proxy = echo_img.dataobj
+        unscaled = proxy.slope == 1 and proxy.inter == 0
+        if not (unscaled and np.can_cast(echo_img.get_data_dtype(), np.float32)):
+            return np.dtype(np.float64)
+
+    return np.dtype(np.float32)
+
+
+def write_compact_stack(echo_files, mask, out_dir, prefix, chunk_size=32):
+    """Stream echo files into a memory-mapped stack of in-mask voxels.
+
+    Parameters
+    ----------
+    echo_files : :obj:`list` of :obj:`str`
+        Echo-wise BOLD files, in echo order.
+    mask : :obj:`str`
+        Brain mask file.
+    out_dir : :obj:`str`
+        Directory to write the stack and cropped mask to.
+    prefix : :obj:`str`
+        Prefix for the output files.
+    chunk_size : :obj:`int`, optional
+        Number of volumes to read at a time.
+
+    Returns
+    -------
+    stack_file : :obj:`str`
+        ``.npy`` file with the (voxels x echoes x time) stack, in float32 if that holds
+        the echoes' values exactly and in float64 otherwise.
+    mask_file : :obj:`str`
+        Mask cropped to the stack's bounding box.
+    ref_img : img_like
+        Single-volume reference image on the cropped grid, with the echoes' TR.
+    bbox : :obj:`tuple` of :obj:`slice`
+        Bounding box of the stack in the original image.
+    """
+    mask_img = nb.load(mask)
+    mask_data = np.asanyarray(mask_img.dataobj).astype(bool)
+    bbox = mask_bounding_box(mask_data)
+    mask_flat = mask_data[bbox].reshape(-1)
+
+    mask_file = os.path.join(out_dir, f"{prefix}_desc-compact_mask.nii.gz")
+    save_img(mask_img.slicer[bbox], mask_file, level="intermediate")
+
+    n_vols = nb.load(echo_files[0]).shape[3]
+    dtype = _stack_dtype(nb.load(f) for f in echo_files)
+    ref_img = nb.load(echo_files[0]).slicer[bbox + (slice(0, 1),)]
+    ref_img = nb.Nifti1Image(
+        np.zeros(ref_img.shape, dtype=np.float32), ref_img.affine, ref_img.header
+    )
+
+    stack_file = os.path.join(out_dir, f"{prefix}_desc-compact_bold.npy")
+    stack = np.lib.format.open_memmap(
+        stack_file,
+        mode="w+",
+        dtype=dtype,
+        shape=(mask_flat.size, len(echo_files), n_vols),
+    )
+    for i_echo, echo_file in enumerate(echo_files):
+        # Keep the gzip stream open so each chunk continues where the last one stopped
+        echo_img = nb.load(echo_file, keep_file_open=True)
+        if echo_img.shape != mask_data.shape + (n_vols,):
+            raise ValueError(f"{echo_file} doesn't match the mask and first echo")
+
+        echo_data = echo_img.dataobj
+        if dtype == np.float64:
+            # Scale the whole echo at once, so it's scaled in float64 as get_fdata does
+            echo_data = np.asanyarray(echo_data, dtype=np.float64)
+
+        for start in range(0, n_vols, chunk_size):
+            stop = min(start + chunk_size, n_vols)
+            chunk = np.asarray(echo_data[..., start:stop], dtype=dtype)[bbox]
+            chunk = chunk.reshape(-1, stop - start)
+            chunk[~mask_flat] = 0
+            stack[:, i_echo, start:stop] = chunk
+
+        del echo_img, echo_data
+
+    stack.flush()
+    del stack
+    return stack_file, mask_file, ref_img, bbox
+
+
+def crop_img(in_file, bbox, out_file):
+    """Crop a 3D or 4D image to a bounding box, for tedana to read from scratch."""
+    save_img(nb.load(in_file).slicer[bbox], out_file, level="intermediate")
+
+
+def uncrop_img(in_file, mask, bbox):
+    """Put a cropped image back in the brain mask's space, in place.
+
+    tedana zeroes most maps outside the mask but leaves some (like the RMSE map) NaN,
+    so the padding matches what the image has outside the mask within the bounding box.
+    """
+    cropped_img = nb.load(in_file)
+    mask_img = nb.load(mask)
+    cropped_data = np.asanyarray(cropped_img.dataobj)
+    outside = ~np.asanyarray(mask_img.dataobj).astype(bool)[bbox]
+    fill = 0
+    if outside.any() and np.isnan(cropped_data[outside]).all():
+        fill = np.nan
+
+    full_data = np.full(
+        mask_img.shape[:3] + cropped_data.shape[3:],
+        fill,
+        dtype=cropped_data.dtype,
+    )
+    full_data[bbox] = cropped_data
+    full_img = nb.Nifti1Image(full_data, mask_img.affine, cropped_img.header)
+
+    # Write next to the original and rename, so the output is never half-written
+    tmp_file = in_file.replace(".nii", f".{os.getpid()}.tmp.nii")
+    full_img.to_filename(tmp_file)
+    os.replace(tmp_file, in_file)
+
+
+@contextmanager
+def patch_tedana_load_data(stack_file, ref_img):
+    """Make tedana read a compact stack instead of loading its echo files.
+
+    The stack is loaded as float64, like tedana's own ``get_fdata``, so every step works
+    on the same values as it would with the echo files.
+    The file names tedana is given are still recorded as its inputs.
+    """
+    original_load_data = tedana_io.load_data
+
+    def _load_compact(data, n_echos=None, dummy_scans=0):
+        data_cat = np.load(stack_file, mmap_mode="r")
+        return data_cat[..., dummy_scans:].astype(np.float64), ref_img
+
+    tedana_io.load_data = _load_compact
+    try:
+        yield
+    finally:
+        tedana_io.load_data = original_load_data
+
+
+def _simulate_run(
+    out_dir,
+    shape=(14, 14, 10),
+    n_vols=80,
+    echo_times=(14.2, 35.9, 57.6, 79.3, 101.0),
+    scaled=False,
+    seed=0,
+):
+    """Write simulated echo files with an ellipsoid brain mask that's smaller than the grid."""
+    rng = np.random.default_rng(seed)
+    ijk = np.indices(shape)
+    center = (np.array(shape) - 1) / 2
+    radii = np.array(shape) / 2 - 1
+    distance = (ijk - center[:, None, None, None]) / radii[:, None, None, None]
+    mask_data = (distance**2).sum(axis=0) <= 1
+    n_voxels = int(mask_data.sum())
+
+    # A few components whose amplitude scales with echo time (BOLD-like) or doesn't
+    data_cat = _simulate(n_voxels, n_vols, echo_times, seed=seed)
+    te_scaling = np.asarray(echo_times) / np.mean(echo_times)
+    for i_comp, period in enumerate((20, 13, 31, 9)):
+        time_series = np.sin(2 * np.pi * np.arange(n_vols) / period)
+        weights = rng.normal(0, 0.01, n_voxels)[:, None, None] * data_cat.mean(2, keepdims=True)
+        scaling = te_scaling if i_comp % 2 == 0 else np.ones(len(echo_times))
+        data_cat += weights * scaling[None, :, None] * time_series[None, None, :]
+
+    affine = np.diag([3.0, 3.0, 3.0, 1.0])
+    echo_files = []
+    for i_echo in range(len(echo_times)):
+        echo_data = rng.uniform(0, 50, shape + (n_vols,))
+        echo_data[mask_data] = data_cat[:, i_echo]
+        if scaled:
+            echo_img = nb.Nifti1Image(echo_data, affine, dtype=np.int16)
+            echo_img.header.set_slope_inter(np.abs(echo_data).max() / 32000, 0.5)
+        else:
+            echo_img = nb.Nifti1Image(echo_data.astype(np.float32), affine)
+        echo_img.header.set_zooms((3.0, 3.0, 3.0, 2.0))
+        echo_files.append(os.path.join(out_dir, f"echo-{i_echo + 1}_bold.nii.gz"))
+        echo_img.to_filename(echo_files[-1])
+
+    mask = os.path.join(out_dir, "mask.nii.gz")
+    nb.Nifti1Image(mask_data.astype(np.uint8), affine).to_filename(mask)
+    return echo_files, list(echo_times), mask
+
+
+def _compare_outputs(full_dir, compact_dir, prefix, rtol):
+    """Compare two tedana runs' registered images and tables.
+
+    Returns
+    -------
+    max_diff : :obj:`float`
+        Largest relative difference between the runs' images.
+    """
+    with open(os.path.join(full_dir, f"{prefix}_desc-tedana_registry.json"), "r") as fo:
+        registry = json.load(fo)
+
+    max_diff = 0
+    for key, out_file in registry.items():
+        if key == "input img":
+            continue
+
+        full_file = os.path.join(full_dir, out_file)
+        compact_file = os.path.join(compact_dir, out_file)
+        assert os.path.isfile(compact_file), f"The compact run has no {key}"
+        if out_file.endswith(".nii.gz"):
+            full_data = nb.load(full_file).get_fdata()
+            compact_data = nb.load(compact_file).get_fdata()
+            np.testing.assert_allclose(
+                compact_data, full_data, rtol=rtol, atol=0, err_msg=f"{key} differs"
+            )
+            diff = np.abs(compact_data - full_data) / np.maximum(np.abs(full_data), 1e-30)
+            max_diff = max(max_diff, diff.max())
+        elif out_file.endswith(".tsv"):
+            pd.testing.assert_frame_equal(
+                pd.read_table(compact_file),
+                pd.read_table(full_file),
+                check_exact=False,
+                rtol=rtol,
+                atol=0,
+                obj=key,
+            )
+
+    return max_diff
+
+
+def benchmark(scaled=False, rtol=1e-7, **simulate_kwargs):
+    """Run tedana on simulated echoes with and without a compact stack and compare them.
+
+    Every registered image must match the full-FOV run's within `rtol` once it's put
+    back in the original space, and every table (metrics, mixing matrices,
+    classifications) must match too. tedana writes float32 images, so `rtol` is about
+    one float32 step; giving tedana the stack in float32 fails it.
+    With `scaled`, the echoes are int16 with scale factors, so the stack is float64.
+
+    Raises
+    ------
+    AssertionError
+        If any output differs from the full-FOV run's by more than `rtol`.
+    """
+    tedana_kwargs = dict(
+        prefix="sub-01",
+        masktype=["dropout", "decay"],
+        fittype="curvefit",
+        tedort=True,
+        tree="minimal",
+        no_reports=True,
+        quiet=True,
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        echo_files, echo_times, mask = _simulate_run(tmp_dir, scaled=scaled, **simulate_kwargs)
+        full_dir = os.path.join(tmp_dir, "full")
+        tedana_workflow(echo_files, echo_times, out_dir=full_dir, mask=mask, **tedana_kwargs)
+
+        compact_dir = os.path.join(tmp_dir, "compact")
+        os.makedirs(compact_dir)
+        stack_file, compact_mask, ref_img, bbox = write_compact_stack(
+            echo_files, mask, out_dir=tmp_dir, prefix="sub-01"
+        )
+        with patch_tedana_load_data(stack_file, ref_img):
+            tedana_workflow(
+                echo_files, echo_times, out_dir=compact_dir, mask=compact_mask, **tedana_kwargs
+            )
+
+        with open(os.path.join(compact_dir, "sub-01_desc-tedana_registry.json"), "r") as fo:
+            compact_outputs = [v for k, v in json.load(fo).items() if k != "input img"]
+        for out_file in compact_outputs:
+            if out_file.endswith(".nii.gz"):
+                uncrop_img(os.path.join(compact_dir, out_file), mask, bbox)
+
+        stack_dtype = np.load(stack_file, mmap_mode="r").dtype
+        grid_shape = nb.load(mask).shape
+        max_diff = _compare_outputs(full_dir, compact_dir, "sub-01", rtol)
+
+    print(f"{'Scaled int16' if scaled else 'float32'} echoes, {stack_dtype} stack")
+    print(f"\tbounding box: {tuple(s.stop - s.start for s in bbox)} of {grid_shape}")
+    print(f"\timages: max relative difference {max_diff:.2e}")
+    return max_diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that tedana's outputs on a compact stack match a full-FOV run."
+    )
+    parser.add_argument("--n-vols", type=int, default=80)
+    parser.add_argument("--rtol", type=float, default=1e-7)
+    args = parser.parse_args()
+    for scaled in (False, True):
+        benchmark(scaled=scaled, rtol=args.rtol, n_vols=args.n_vols)
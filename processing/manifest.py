@@ -0,0 +1,145 @@
+"""Content-fingerprint manifests for resuming per-run derivatives.
+
+A manifest is a JSON file written next to a run's outputs once the run finishes.
+It records the SHA-256 of every input file, the processing parameters, and the
+outputs the run produced. A run is only considered done if all of those still match.
+
+Hashes are reused from the previous manifest when a file's size and mtime haven't
+changed, so checking a finished run doesn't reread its inputs.
+"""
+
+import hashlib
+import json
+import os
+
+CHUNK_SIZE = 2**20
+
+
+def hash_file(path):
+    """Compute the SHA-256 of a file, reading it in chunks."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as fo:
+        for chunk in iter(lambda: fo.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def fingerprint_inputs(inputs, previous=None):
+    """Fingerprint a set of input files.
+
+    Parameters
+    ----------
+    inputs : :obj:`dict`
+        Input files, keyed by a label (e.g., "mask").
+    previous : :obj:`dict` or None
+        Fingerprints from an earlier call. Hashes are reused for files whose path,
+        size, and mtime are unchanged.
+
+    Returns
+    -------
+    fingerprints : :obj:`dict`
+        Path, size, mtime, and SHA-256 for each label.
+        Missing files get a hash of None, so they never match.
+    """
+    previous = previous or {}
+    fingerprints = {}
+    for label, path in inputs.items():
+        path = os.path.abspath(path)
+        if not os.path.isfile(path):
+            fingerprints[label] = {"path": path, "size": None, "mtime": None, "sha256": None}
+            continue
+
+        stat = os.stat(path)
+        record = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime}
+        old_record = previous.get(label, {})
+        if all(old_record.get(k) == v for k, v in record.items()) and old_record.get("sha256"):
+            record["sha256"] = old_record["sha256"]
+        else:
+            record["sha256"] = hash_file(path)
+
+        fingerprints[label] = record
+
+    return fingerprints
+
+
+def load_manifest(manifest_file):
+    """Load a manifest, or return None if it's missing or unreadable."""
+    if not os.path.isfile(manifest_file):
+        return None
+
+    try:
+        with open(manifest_file, "r") as fo:
+            return json.load(fo)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def write_manifest(manifest_file, inputs, parameters, outputs):
+    """Write a manifest atomically, so an interrupted write never looks finished."""
+    manifest = {"Inputs": inputs, "Parameters": parameters, "Outputs": sorted(outputs)}
+    tmp_file = f"{manifest_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as fo:
+        json.dump(manifest, fo, sort_keys=True, indent=4)
+    os.replace(tmp_file, manifest_file)
+
+
+def check_manifest(manifest_file, inputs, parameters, refresh=False):
+    """Decide whether a run needs to be (re)done.
+
+    Parameters
+    ----------
+    manifest_file : :obj:`str`
+        The run's manifest. Output paths in it are relative to its directory.
+    inputs : :obj:`dict`
+        The run's current input files, keyed by label.
+    parameters : :obj:`dict`
+        The run's current processing parameters. Must be JSON-serializable.
+    refresh : :obj:`bool`, optional
+        If a finished run's inputs only have new mtimes, rewrite the manifest with them,
+        so they aren't rehashed next time. Default is False, which never writes.
+
+    Returns
+    -------
+    status : {"new", "stale", "partial", "done"}
+        "new" if there's no manifest, "stale" if any input or parameter changed,
+        "partial" if any recorded output is missing, and "done" otherwise.
+    reasons : :obj:`list` of :obj:`str`
+        The changed inputs and parameters, or the missing outputs.
+    """
+    manifest = load_manifest(manifest_file)
+    if manifest is None:
+        return "new", []
+
+    # Compare through JSON so tuples, numpy scalars, etc. match what was written
+    parameters = json.loads(json.dumps(parameters))
+    old_parameters = manifest.get("Parameters", {})
+    reasons = [
+        f"parameter {k}"
+        for k in sorted(set(parameters) | set(old_parameters))
+        if parameters.get(k) != old_parameters.get(k)
+    ]
+
+    old_inputs = manifest.get("Inputs", {})
+    new_inputs = fingerprint_inputs(inputs, previous=old_inputs)
+    for label in sorted(set(new_inputs) | set(old_inputs)):
+        old_hash = old_inputs.get(label, {}).get("sha256")
+        new_hash = new_inputs.get(label, {}).get("sha256")
+        if old_hash is None or old_hash != new_hash:
+            reasons.append(f"input {label}")
+
+    if reasons:
+        return "stale", reasons
+
+    out_dir = os.path.dirname(os.path.abspath(manifest_file))
+    missing = [
+        f for f in manifest.get("Outputs", []) if not os.path.isfile(os.path.join(out_dir, f))
+    ]
+    if missing:
+        return "partial", missing
+
+    if refresh and new_inputs != old_inputs:
+        # Same content, new mtimes (e.g., copied files); refresh them to skip rehashing
+        write_manifest(manifest_file, new_inputs, manifest["Parameters"], manifest["Outputs"])
+
+    return "done", []
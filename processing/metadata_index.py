@@ -0,0 +1,170 @@
+"""A persistent index of header-level metadata for the raw and fMRIPrep trees.
+
+Each entry is keyed by absolute path and remembers the file's size and mtime,
+so it's only re-read when the file changes. What gets stored depends on the file:
+
+-   NIfTI files: ``shape``, ``zooms``, and ``dtype``, from the header alone.
+-   JSON sidecars: ``EchoTime``, ``RepetitionTime``, and ``StartTime``, when present.
+-   fMRIPrep confounds files: ``n_volumes`` and ``dummy_scans``, inferred from the
+    non-steady-state outlier columns.
+
+Run this file to build or refresh an index. Only new or changed files are read.
+"""
+
+import argparse
+import fcntl
+import json
+import os
+from glob import glob
+
+import nibabel as nb
+import numpy as np
+import pandas as pd
+
+SIDECAR_FIELDS = ["EchoTime", "RepetitionTime", "StartTime"]
+INDEXED_PATTERNS = [
+    "sub-*/ses-*/*/*.nii.gz",
+    "sub-*/ses-*/*/*.json",
+    "sub-*/ses-*/func/*_desc-confounds_timeseries.tsv",
+]
+
+
+def count_dummy_scans(confounds_df):
+    """Infer the number of initial non-steady-state volumes from an fMRIPrep confounds file."""
+    nss_cols = [c for c in confounds_df.columns if c.startswith("non_steady_state_outlier")]
+
+    dummy_scans = 0
+    if nss_cols:
+        initial_volumes_df = confounds_df[nss_cols]
+        dummy_scans = np.any(initial_volumes_df.to_numpy(), axis=1)
+        dummy_scans = np.where(dummy_scans)[0]
+
+        # reasonably assumes all NSS volumes are contiguous
+        dummy_scans = int(dummy_scans[-1] + 1)
+
+    return dummy_scans
+
+
+def _read_metadata(path):
+    """Read the indexed metadata for one file."""
+    if path.endswith((".nii", ".nii.gz")):
+        header = nb.load(path).header
+        return {
+            "shape": [int(i) for i in header.get_data_shape()],
+            "zooms": [float(i) for i in header.get_zooms()],
+            "dtype": str(header.get_data_dtype()),
+        }
+    elif path.endswith(".json"):
+        with open(path, "r") as fo:
+            metadata = json.load(fo)
+        return {k: metadata[k] for k in SIDECAR_FIELDS if k in metadata}
+    elif path.endswith("_desc-confounds_timeseries.tsv"):
+        confounds_df = pd.read_table(
+            path,
+            usecols=lambda c: c.startswith("non_steady_state_outlier"),
+        )
+        # usecols drops the row count when no columns match, so count lines instead
+        with open(path, "r") as fo:
+            n_volumes = sum(1 for _ in fo) - 1
+        return {"n_volumes": n_volumes, "dummy_scans": count_dummy_scans(confounds_df)}
+    else:
+        raise ValueError(f"Don't know how to index {path}")
+
+
+class MetadataIndex:
+    """Cached file metadata, keyed by path, size, and mtime.
+
+    Parameters
+    ----------
+    index_file : :obj:`str` or None
+        JSON file to load the index from and save it to.
+        If None, the index is only kept in memory.
+    """
+
+    def __init__(self, index_file=None):
+        self.index_file = index_file
+        self._entries = {}
+        self._changed = set()
+        if index_file is not None and os.path.isfile(index_file):
+            with open(index_file, "r") as fo:
+                self._entries = json.load(fo)
+
+    def get(self, path):
+        """Get the metadata for a file, reading it only if it's new or has changed."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self._entries.get(path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime, **_read_metadata(path)}
+            self._entries[path] = entry
+            self._changed.add(path)
+
+        return entry
+
+    def update(self, root):
+        """Index every file of interest under a BIDS-style root, dropping deleted ones."""
+        root = os.path.abspath(root)
+        paths = set()
+        for pattern in INDEXED_PATTERNS:
+            paths.update(glob(os.path.join(root, pattern)))
+
+        for path in sorted(paths):
+            self.get(path)
+
+        deleted = [p for p in self._entries if p.startswith(root + os.sep) and p not in paths]
+        for path in deleted:
+            del self._entries[path]
+            self._changed.add(path)
+
+        return len(paths), len(deleted)
+
+    def save(self):
+        """Write the index, keeping entries other processes added in the meantime.
+
+        The read, merge, and write happen under an exclusive lock on
+        ``{index_file}.lock``, so processes saving at once don't drop each other's
+        entries.
+        """
+        if self.index_file is None or not self._changed:
+            return
+
+        with open(f"{self.index_file}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = {}
+                if os.path.isfile(self.index_file):
+                    with open(self.index_file, "r") as fo:
+                        entries = json.load(fo)
+
+                for path in self._changed:
+                    if path in self._entries:
+                        entries[path] = self._entries[path]
+                    else:
+                        entries.pop(path, None)
+
+                # Write to a temporary file and rename, so readers never see a partial index
+                tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+                with open(tmp_file, "w") as fo:
+                    json.dump(entries, fo, sort_keys=True, indent=1)
+                os.replace(tmp_file, self.index_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self._entries = entries
+        self._changed = set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or refresh a metadata index.")
+    parser.add_argument("index_file", help="JSON index file to create or update.")
+    parser.add_argument("roots", nargs="+", help="BIDS raw or derivatives directories to index.")
+    args = parser.parse_args()
+
+    index = MetadataIndex(args.index_file)
+    for root in args.roots:
+        n_files, n_deleted = index.update(root)
+        print(f"{root}: {n_files} files, {n_deleted} removed")
+
+    n_changed = len(index._changed)
+    index.save()
+    print(f"Updated {n_changed} entries in {args.index_file}")
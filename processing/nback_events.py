@@ -0,0 +1,230 @@
+"""Jeanette Mumford's ConsDurRTDur model for the fractional n-back events.
+
+Each 0-back and 2-back trial is modeled with its own (constant) duration, and every
+trial with a response gets a second "RTDur" event lasting the response time.
+
+:func:`model_rtdur` applies the model to a long-format table of any number of runs at
+once, and :class:`RTDurEvents` keeps the modeled events for a whole dataset in one
+columnar ``.npz`` cache that's only rebuilt when an events file or the model changes.
+Consumers pull per-run slices from it.
+
+The cache is built without an RT cutoff. Censoring (e.g., ``max_rt=2``, since long RTs
+are a lie) is applied when a run is read, so the same cache serves every analysis.
+"""
+
+import argparse
+import hashlib
+import inspect
+import json
+import os
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+EVENTS_PATTERN = "sub-*/ses-*/func/*_task-fracback_acq-MBME_events.tsv"
+EVENTS_COLUMNS = ["onset", "duration", "trial_type", "response_time"]
+# Trial types to model (after lower-casing), renamed to valid Python identifiers
+TRIAL_TYPES = {"0back": "zero_back", "2back": "two_back"}
+# Bump when the cache's arrays change; changes to the model are picked up from its source
+CACHE_VERSION = 1
+
+
+def model_rtdur(events_df, max_rt=None, group_col=None):
+    """Apply the ConsDurRTDur model to one or more runs' events.
+
+    Parameters
+    ----------
+    events_df : :obj:`pandas.DataFrame`
+        Events with onset, duration, trial_type, and response_time columns.
+        Trial types are matched case-insensitively.
+    max_rt : :obj:`float` or None, optional
+        Response times longer than this are treated as missing.
+    group_col : :obj:`str` or None, optional
+        Column identifying each event's run, for tables with several runs.
+        It's kept, and events are sorted by it and then by onset.
+
+    Returns
+    -------
+    rtdur_df : :obj:`pandas.DataFrame`
+        The trials plus one RTDur event per trial with a response.
+    """
+    columns = ([group_col] if group_col else []) + EVENTS_COLUMNS
+    trial_type = events_df["trial_type"].astype(str).str.lower()
+    keep = trial_type.isin(list(TRIAL_TYPES)).to_numpy()
+    trials_df = events_df.loc[keep, columns].assign(
+        trial_type=trial_type[keep].map(TRIAL_TYPES),
+        response_time=pd.to_numeric(events_df.loc[keep, "response_time"], errors="coerce"),
+    )
+    if max_rt is not None:
+        trials_df["response_time"] = trials_df["response_time"].where(
+            trials_df["response_time"] <= max_rt
+        )
+
+    responses_df = trials_df.loc[trials_df["response_time"].notna()]
+    responses_df = responses_df.assign(duration=responses_df["response_time"], trial_type="RTDur")
+
+    # A stable sort keeps each trial ahead of its RTDur event
+    rtdur_df = pd.concat((trials_df, responses_df), ignore_index=True)
+    sort_cols = ([group_col] if group_col else []) + ["onset"]
+    rtdur_df = rtdur_df.sort_values(by=sort_cols, kind="stable")
+    return rtdur_df.reset_index(drop=True)
+
+
+def events_to_rtdur(events_df, max_rt=None):
+    """Implement Jeanette Mumford's ConsDurRTDur model on an events dataframe."""
+    return model_rtdur(events_df, max_rt=max_rt)
+
+
+def censor_rtdur(rtdur_df, max_rt):
+    """Apply an RT cutoff to events that were modeled without one."""
+    too_long = rtdur_df["response_time"] > max_rt
+    rtdur_df = rtdur_df.loc[~(too_long & (rtdur_df["trial_type"] == "RTDur"))].copy()
+    rtdur_df.loc[rtdur_df["response_time"] > max_rt, "response_time"] = np.nan
+    return rtdur_df.reset_index(drop=True)
+
+
+def _cache_version():
+    """Fingerprint the cache format and the model, so changing either rebuilds the cache."""
+    key = {
+        "cache_version": CACHE_VERSION,
+        "model": inspect.getsource(model_rtdur),
+        "trial_types": TRIAL_TYPES,
+        "columns": EVENTS_COLUMNS,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _stat_files(files):
+    """Get the sizes and mtimes that decide whether the cache is current."""
+    stats = [os.stat(f) for f in files]
+    return np.array([s.st_size for s in stats]), np.array([s.st_mtime for s in stats])
+
+
+class RTDurEvents:
+    """Modeled n-back events for a whole BIDS dataset, cached in one file.
+
+    Parameters
+    ----------
+    bids_dir : :obj:`str`
+        Raw BIDS dataset with the events files.
+    cache_file : :obj:`str` or None
+        ``.npz`` file to keep the modeled events in. If None, they're only kept in memory.
+    """
+
+    def __init__(self, bids_dir, cache_file=None):
+        self.bids_dir = os.path.abspath(bids_dir)
+        self.cache_file = cache_file
+        self.files = sorted(glob(os.path.join(self.bids_dir, EVENTS_PATTERN)))
+        sizes, mtimes = _stat_files(self.files)
+        relative_files = [os.path.relpath(f, self.bids_dir) for f in self.files]
+
+        self.table = None
+        if cache_file is not None and os.path.isfile(cache_file):
+            self.table = self._load(relative_files, sizes, mtimes)
+
+        if self.table is None:
+            self.table = self._build(relative_files)
+            if cache_file is not None:
+                self._save(relative_files, sizes, mtimes)
+
+        # Runs are contiguous in the sorted table, so each one is a slice
+        run_files, starts, counts = np.unique(
+            self.table["events_file"].to_numpy(), return_index=True, return_counts=True
+        )
+        self._slices = {f: slice(0, 0) for f in relative_files}
+        self._slices.update({f: slice(s, s + c) for f, s, c in zip(run_files, starts, counts)})
+
+    def _build(self, relative_files):
+        """Read every events file and model them all at once."""
+        if not relative_files:
+            return pd.DataFrame(columns=["events_file"] + EVENTS_COLUMNS)
+
+        events_df = pd.concat(
+            [
+                pd.read_table(os.path.join(self.bids_dir, f), usecols=EVENTS_COLUMNS)
+                for f in relative_files
+            ],
+            keys=relative_files,
+            names=["events_file", None],
+        )
+        events_df = events_df.reset_index(level="events_file")
+        return model_rtdur(events_df, group_col="events_file")
+
+    def _load(self, relative_files, sizes, mtimes):
+        """Load the cache, or return None if the model or any events file changed."""
+        with np.load(self.cache_file, allow_pickle=False) as cache:
+            if (
+                "version" not in cache.files
+                or str(cache["version"]) != _cache_version()
+                or cache["files"].tolist() != relative_files
+                or not np.array_equal(cache["sizes"], sizes)
+                or not np.array_equal(cache["mtimes"], mtimes)
+            ):
+                return None
+
+            return pd.DataFrame(
+                {
+                    "events_file": cache["files"][cache["file_codes"]],
+                    "onset": cache["onset"],
+                    "duration": cache["duration"],
+                    "trial_type": cache["trial_types"][cache["trial_type_codes"]],
+                    "response_time": cache["response_time"],
+                }
+            )
+
+    def _save(self, relative_files, sizes, mtimes):
+        """Write the cache atomically, one array per column."""
+        file_codes = pd.Categorical(self.table["events_file"], categories=relative_files)
+        trial_types = pd.Categorical(self.table["trial_type"])
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_file,
+            version=np.array(_cache_version()),
+            files=np.array(relative_files, dtype=str),
+            sizes=sizes,
+            mtimes=mtimes,
+            file_codes=file_codes.codes,
+            onset=self.table["onset"].to_numpy(dtype=float),
+            duration=self.table["duration"].to_numpy(dtype=float),
+            trial_types=np.array(trial_types.categories, dtype=str),
+            trial_type_codes=trial_types.codes,
+            response_time=self.table["response_time"].to_numpy(dtype=float),
+        )
+        os.replace(tmp_file, self.cache_file)
+
+    def get(self, events_file, max_rt=None):
+        """Get one run's modeled events.
+
+        Parameters
+        ----------
+        events_file : :obj:`str`
+            The run's events file, in the BIDS dataset.
+        max_rt : :obj:`float` or None, optional
+            Response times longer than this are treated as missing.
+
+        Returns
+        -------
+        rtdur_df : :obj:`pandas.DataFrame`
+            Onset, duration, trial_type, and response_time columns.
+        """
+        relative_file = os.path.relpath(os.path.abspath(events_file), self.bids_dir)
+        if relative_file not in self._slices:
+            raise KeyError(f"No events for {events_file} in {self.bids_dir}")
+
+        rtdur_df = self.table.iloc[self._slices[relative_file]][EVENTS_COLUMNS]
+        rtdur_df = rtdur_df.reset_index(drop=True)
+        if max_rt is not None:
+            rtdur_df = censor_rtdur(rtdur_df, max_rt)
+
+        return rtdur_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or refresh the n-back events cache.")
+    parser.add_argument("bids_dir", help="Raw BIDS dataset.")
+    parser.add_argument("cache_file", help=".npz file to write the modeled events to.")
+    args = parser.parse_args()
+
+    events = RTDurEvents(args.bids_dir, args.cache_file)
+    print(f"{len(events.files)} runs, {len(events.table)} events in {args.cache_file}")
@@ -0,0 +1,220 @@
+"""A node-local cache of decompressed, memory-mappable copies of ``.nii.gz`` files.
+
+Every read of a ``.nii.gz`` file gunzips it again, on one thread. The cache keeps an
+uncompressed ``.nii`` copy of each file it's asked for on local scratch, so later
+reads (by this job or any other on the node) memory-map it instead.
+
+-   Entries are named by the SHA-256 of the compressed source, so a changed file gets
+    a new entry and identical files share one. Source hashes are remembered by path,
+    size, and mtime, so an unchanged file isn't rehashed.
+-   The cache is held to a size budget by evicting the least recently used entries.
+    Entries used in the last ``min_age`` seconds are never evicted, so a file isn't
+    removed between another job looking it up and opening it. Files that are already
+    open or memory-mapped stay readable after they're evicted.
+-   Entries are decompressed to a temporary file and renamed, under a per-entry lock,
+    so concurrent jobs never see a partial entry or decompress the same file twice.
+
+The cache is configured with environment variables, so every loader uses the same one:
+``NIFTI_CACHE_DIR`` turns it on, and ``NIFTI_CACHE_MAX_GB`` sets the budget.
+Without ``NIFTI_CACHE_DIR``, :func:`cached_path` returns its input unchanged.
+
+Run this file to show the cache's contents or to trim it to its budget.
+"""
+
+import argparse
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+import nibabel as nb
+
+CHUNK_SIZE = 2**24
+DEFAULT_MAX_GB = 100
+DEFAULT_MIN_AGE = 600
+
+
+@contextmanager
+def _locked(lock_file):
+    """Hold an exclusive lock on a file, shared with other processes on the node."""
+    with open(lock_file, "a") as fo:
+        fcntl.flock(fo, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fo, fcntl.LOCK_UN)
+
+
+class NiftiCache:
+    """Decompressed copies of ``.nii.gz`` files, keyed by content.
+
+    Parameters
+    ----------
+    cache_dir : :obj:`str`
+        Cache directory, ideally on node-local scratch.
+    max_bytes : :obj:`int`
+        Size budget for the cached ``.nii`` files.
+    min_age : :obj:`float`, optional
+        Entries used within this many seconds are never evicted.
+    """
+
+    def __init__(self, cache_dir, max_bytes, min_age=DEFAULT_MIN_AGE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        os.makedirs(os.path.join(cache_dir, "sources"), exist_ok=True)
+
+    def _source_hash(self, source):
+        """Get a source file's SHA-256, reusing it if the file hasn't changed."""
+        stat = os.stat(source)
+        record = {"path": source, "size": stat.st_size, "mtime": stat.st_mtime}
+        path_key = hashlib.sha256(source.encode()).hexdigest()
+        record_file = os.path.join(self.cache_dir, "sources", f"{path_key}.json")
+        if os.path.isfile(record_file):
+            try:
+                with open(record_file, "r") as fo:
+                    old_record = json.load(fo)
+                if all(old_record.get(k) == v for k, v in record.items()):
+                    return old_record["sha256"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        sha = hashlib.sha256()
+        with open(source, "rb") as fo:
+            for chunk in iter(lambda: fo.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+
+        record["sha256"] = sha.hexdigest()
+        tmp_file = f"{record_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as fo:
+            json.dump(record, fo)
+        os.replace(tmp_file, record_file)
+        return record["sha256"]
+
+    def path(self, source):
+        """Get the path of a source file's uncompressed copy, creating it if needed."""
+        source = os.path.abspath(source)
+        if not source.endswith(".nii.gz"):
+            return source
+
+        entry = os.path.join(self.cache_dir, f"{self._source_hash(source)}.nii")
+        with _locked(f"{entry}.lock"):
+            try:
+                # The entry's mtime is its last use, for LRU eviction
+                os.utime(entry)
+            except FileNotFoundError:
+                tmp_file = f"{entry}.{os.getpid()}.tmp"
+                with gzip.open(source, "rb") as f_in, open(tmp_file, "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+                os.replace(tmp_file, entry)
+                created = True
+            else:
+                created = False
+
+        if created:
+            self.evict(keep=entry)
+
+        return entry
+
+    def entries(self):
+        """List the cached files as (path, size, last use), least recently used first."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".nii"):
+                continue
+
+            entry = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(entry)
+            except FileNotFoundError:
+                continue
+
+            entries.append((entry, stat.st_size, stat.st_mtime))
+
+        return sorted(entries, key=lambda e: e[2])
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits its budget.
+
+        Returns
+        -------
+        n_evicted : :obj:`int`
+        """
+        with _locked(os.path.join(self.cache_dir, "evict.lock")):
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            cutoff = time.time() - self.min_age
+            n_evicted = 0
+            for entry, size, last_use in entries:
+                if total <= self.max_bytes:
+                    break
+
+                if entry == keep or last_use > cutoff:
+                    continue
+
+                # Recheck under the entry's lock, in case another job just used it
+                with _locked(f"{entry}.lock"):
+                    try:
+                        if os.stat(entry).st_mtime > cutoff:
+                            continue
+                        os.remove(entry)
+                    except FileNotFoundError:
+                        pass
+
+                total -= size
+                n_evicted += 1
+
+        return n_evicted
+
+
+def get_cache():
+    """Get the cache configured by ``NIFTI_CACHE_DIR``, or None if it isn't set."""
+    cache_dir = os.environ.get("NIFTI_CACHE_DIR")
+    if not cache_dir:
+        return None
+
+    max_gb = float(os.environ.get("NIFTI_CACHE_MAX_GB", DEFAULT_MAX_GB))
+    return NiftiCache(cache_dir, int(max_gb * 2**30))
+
+
+def cached_path(source):
+    """Get a memory-mappable copy of a ``.nii.gz`` file, if the cache is on.
+
+    Other files, and every file when ``NIFTI_CACHE_DIR`` isn't set, are returned as is.
+    """
+    cache = get_cache()
+    if cache is None:
+        return str(source)
+
+    return cache.path(str(source))
+
+
+def load(source, **kwargs):
+    """Load an image through the cache, memory-mapping it when it's cached."""
+    return nb.load(cached_path(source), **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show or trim the decompressed NIfTI cache.")
+    parser.add_argument(
+        "--evict",
+        action="store_true",
+        help="Remove least recently used entries until the cache fits its budget.",
+    )
+    args = parser.parse_args()
+
+    cache = get_cache()
+    if cache is None:
+        raise SystemExit("NIFTI_CACHE_DIR isn't set")
+
+    if args.evict:
+        print(f"Evicted {cache.evict()} entries")
+
+    entries = cache.entries()
+    total = sum(size for _, size, _ in entries)
+    print(f"{cache.cache_dir}: {len(entries)} entries, {total / 2**30:.1f} of "
+          f"{cache.max_bytes / 2**30:.1f} GB")
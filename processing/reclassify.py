@@ -0,0 +1,212 @@
+"""Re-run a tedana decision tree on a finished run's saved component metrics.
+
+The decision tree only reads the component table (kappa, rho, the external
+regressor fit statistics, etc.) and a few cross-component metrics, all of which
+tedana saves. Applying a changed tree to them gives the same classifications as
+a full rerun, without refitting T2*, PCA, or ICA.
+
+If the external regressors change, their fit statistics can be recomputed from the
+saved ICA mixing matrix as well. tedana's fit solves for all components at once for
+each model, so this takes about as long as the tree itself.
+
+The classification outputs (metrics, status table, decision tree, cross-component
+metrics, and orthogonalized mixing matrix) are rewritten. Image outputs, figures,
+and the HTML report are not, so they still show the original classifications.
+"""
+
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from tedana import io as tedana_io
+from tedana.metrics.collect import get_metadata
+from tedana.metrics.external import fit_regressors, validate_extern_regress
+from tedana.reporting.quality_metrics import calculate_rejected_components_impact
+from tedana.selection import automatic_selection
+from tedana.selection.component_selector import ComponentSelector
+
+# Columns the decision tree (re)creates
+CLASSIFICATION_COLUMNS = [
+    "classification",
+    "classification_tags",
+    "Var Exp of rejected to accepted",
+]
+# Cross-component metrics that come from the ICA itself, not the tree
+ICA_METRICS = ["fastica_convergence_warning_count", "robustica_mean_index_quality"]
+# Columns added by fitting the external regressors, e.g., "pval nuisance model"
+REGRESSOR_METRIC_PATTERN = re.compile(r"^(Fstat|pval|R2stat) .+ model$")
+
+
+def compare_regressors(old_regressors, new_regressors, tol=1e-8):
+    """Describe the differences between two sets of external regressors.
+
+    Parameters
+    ----------
+    old_regressors, new_regressors : :obj:`pandas.DataFrame`
+        Regressors, with one column per regressor.
+    tol : :obj:`float`, optional
+        Smallest absolute difference to report.
+
+    Returns
+    -------
+    changes : :obj:`list` of :obj:`str`
+        One line per added, removed, or changed regressor. Empty if they match.
+    """
+    changes = [f"added {c}" for c in new_regressors.columns if c not in old_regressors.columns]
+    changes += [
+        f"removed {c}" for c in old_regressors.columns if c not in new_regressors.columns
+    ]
+    if len(old_regressors) != len(new_regressors):
+        changes.append(f"length changed from {len(old_regressors)} to {len(new_regressors)}")
+        return changes
+
+    for col in new_regressors.columns:
+        if col not in old_regressors.columns:
+            continue
+
+        old_values = old_regressors[col].to_numpy(dtype=float)
+        new_values = new_regressors[col].to_numpy(dtype=float)
+        max_diff = np.nanmax(np.abs(new_values - old_values), initial=0)
+        if max_diff > tol or not np.array_equal(np.isnan(old_values), np.isnan(new_values)):
+            r = np.corrcoef(old_values, new_values)[0, 1]
+            changes.append(f"changed {col} (max abs diff {max_diff:.4g}, r = {r:.4f})")
+
+    return changes
+
+
+def _regressor_models(external_regressor_config):
+    """Reduce an external regressor config to the parts that affect the fit statistics."""
+    if not external_regressor_config:
+        return []
+
+    return [
+        {
+            "regress_ID": model["regress_ID"],
+            "detrend": model.get("detrend"),
+            "statistic": model.get("statistic"),
+            "regressors": sorted(model.get("regressors", [])),
+            "partial_models": model.get("partial_models"),
+        }
+        for model in sorted(external_regressor_config, key=lambda m: m["regress_ID"])
+    ]
+
+
+def reclassify_run(
+    tedana_run_out_dir,
+    prefix,
+    tree,
+    tedort=True,
+    external_regressors=None,
+    dummy_scans=0,
+):
+    """Apply a decision tree to a finished tedana run's saved metrics.
+
+    Parameters
+    ----------
+    tedana_run_out_dir : :obj:`str`
+        The run's tedana output directory.
+    prefix : :obj:`str`
+        The run's tedana output prefix.
+    tree : :obj:`str`
+        Decision tree JSON file.
+    tedort : :obj:`bool`, optional
+        Whether to re-orthogonalize the rejected components' time series with respect
+        to the newly accepted ones, as tedana's ``tedort`` option does.
+    external_regressors : :obj:`pandas.DataFrame` or None, optional
+        New external regressors, including any dummy volumes. If given, the tree's
+        regressor models are refit to the saved ICA mixing matrix with them.
+        Otherwise the saved fit statistics are reused.
+    dummy_scans : :obj:`int`, optional
+        Number of dummy volumes at the start of `external_regressors`.
+
+    Returns
+    -------
+    n_changed : :obj:`int`
+        Number of components whose classification changed.
+    """
+    io_generator = tedana_io.OutputGenerator(
+        os.path.join(tedana_run_out_dir, f"{prefix}_desc-adaptiveGoodSignal_mask.nii.gz"),
+        convention="bids",
+        out_dir=tedana_run_out_dir,
+        prefix=prefix,
+        make_figures=False,
+    )
+    # Set after initializing, since overwrite=True there deletes the confounds file
+    io_generator.overwrite = True
+
+    component_table = pd.read_table(io_generator.get_name("ICA metrics tsv"))
+    old_classification = component_table["classification"].copy()
+    component_table = component_table.drop(
+        columns=[c for c in CLASSIFICATION_COLUMNS if c in component_table.columns]
+    )
+    with open(io_generator.get_name("ICA cross component metrics json"), "r") as fo:
+        old_cross_component_metrics = json.load(fo)
+
+    with open(io_generator.get_name("ICA decision tree json"), "r") as fo:
+        old_tree = json.load(fo)
+
+    mixing_df = pd.read_table(io_generator.get_name("ICA mixing tsv"))
+    mixing = mixing_df.to_numpy()
+
+    selector = ComponentSelector(tree)
+    old_config = old_tree.get("external_regressor_config")
+    if external_regressors is not None:
+        component_table = component_table.drop(
+            columns=[c for c in component_table.columns if REGRESSOR_METRIC_PATTERN.match(c)]
+        )
+        config = selector.tree.get("external_regressor_config")
+        if config:
+            external_regressors, config = validate_extern_regress(
+                external_regressors=external_regressors,
+                external_regressor_config=config,
+                n_vols=mixing.shape[0] + dummy_scans,
+                dummy_scans=dummy_scans,
+            )
+            component_table = fit_regressors(component_table, external_regressors, config, mixing)
+
+        old_config = config
+    elif _regressor_models(selector.tree.get("external_regressor_config")) != _regressor_models(
+        old_config
+    ):
+        raise ValueError(
+            f"The external regressor models in {tree} don't match the ones used for {prefix}, "
+            "so the saved fit statistics can't be reused"
+        )
+
+    missing_metrics = sorted(set(selector.necessary_metrics) - set(component_table.columns))
+    if missing_metrics:
+        raise ValueError(
+            f"{tree} needs metrics that weren't calculated for {prefix}: {missing_metrics}"
+        )
+
+    # The config has already been checked against the regressors file
+    selector.tree["external_regressor_config"] = old_config
+    selector = automatic_selection(
+        component_table,
+        selector,
+        n_echos=old_cross_component_metrics["n_echos"],
+        n_vols=old_cross_component_metrics["n_vols"],
+        n_independent_echos=old_cross_component_metrics.get("n_independent_echos"),
+    )
+    for metric in ICA_METRICS:
+        if metric in old_cross_component_metrics:
+            selector.cross_component_metrics_[metric] = old_cross_component_metrics[metric]
+
+    calculate_rejected_components_impact(selector, mixing)
+    selector.to_files(io_generator)
+    io_generator.save_file(get_metadata(selector.component_table_), "ICA metrics json")
+
+    if tedort:
+        acc_ts = mixing[:, selector.accepted_comps_]
+        rej_ts = mixing[:, selector.rejected_comps_]
+        betas = np.linalg.lstsq(acc_ts, rej_ts, rcond=None)[0]
+        mixing[:, selector.rejected_comps_] = rej_ts - np.dot(acc_ts, betas)
+        io_generator.save_file(
+            pd.DataFrame(mixing, columns=mixing_df.columns),
+            "ICA orthogonalized mixing tsv",
+        )
+
+    new_classification = selector.component_table_["classification"]
+    return int((new_classification != old_classification).sum())
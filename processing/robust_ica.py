@@ -0,0 +1,367 @@
+"""Parallel, seeded robust ICA for tedana's robustica stage.
+
+tedana's ``r_ica`` hands all of its FastICA restarts to robustica, which runs them
+one after another. The functions here run the restarts on a process pool instead.
+Each restart gets its seed up front, from the same generator robustica uses,
+so the decomposition does not depend on the number of workers.
+
+In adaptive mode, restarts are run in fixed-size batches and clustered after each
+batch. Once both the mean index quality (iq) and the cluster centrotypes stop
+changing by more than a tolerance, no more restarts are scheduled.
+"""
+
+import json
+import logging
+import warnings
+from contextlib import contextmanager
+from functools import partial
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from robustica import RobustICA, abs_pearson_dist, corrmats
+from scipy import stats
+from sklearn import manifold
+from sklearn.exceptions import ConvergenceWarning
+from tedana.config import WARN_IQ
+from tedana.decomposition import ica as tedana_ica
+
+LGR = logging.getLogger("GENERAL")
+
+
+def restart_seeds(fixed_seed, n_robust_runs):
+    """Get the FastICA seed for each robust ICA restart.
+
+    This matches the seeds robustica draws internally for ``random_state=fixed_seed``.
+    """
+    rng = np.random.RandomState(fixed_seed)
+    return rng.randint(0, n_robust_runs * 100, size=n_robust_runs)
+
+
+def _run_restart(rica, data, seed):
+    """Run one FastICA restart and flag whether it converged."""
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter("always", category=ConvergenceWarning)
+        result = rica._run_ica(data, seed)
+
+    result["converged"] = not any(
+        issubclass(w.category, ConvergenceWarning)
+        and "FastICA did not converge" in str(w.message)
+        for w in caught_warnings
+    )
+    return result
+
+
+def _make_robustica(n_components, n_robust_runs, max_it, fixed_seed, robust_method):
+    return RobustICA(
+        n_components=n_components,
+        robust_runs=n_robust_runs,
+        whiten="arbitrary-variance",
+        max_iter=max_it,
+        random_state=fixed_seed,
+        robust_dimreduce=False,
+        fun="logcosh",
+        robust_method=robust_method,
+        verbose=False,
+    )
+
+
+def _cluster_restarts(results, n_components, max_it, fixed_seed, robust_method):
+    """Cluster the components from a set of finished restarts.
+
+    Returns the fitted RobustICA object and the per-cluster quality table.
+    """
+    rica = _make_robustica(n_components, len(results), max_it, fixed_seed, robust_method)
+    rica.S_all = np.hstack([r["S"] for r in results])
+    rica.A_all = np.hstack([r["A"] for r in results])
+    rica.time = {i: r["time"] for i, r in enumerate(results)}
+    (
+        rica.S,
+        rica.A,
+        rica.S_std,
+        rica.A_std,
+        rica.clustering.stats_,
+        rica.signs_,
+        rica.orientation_,
+    ) = rica._compute_robust_components(rica.S_all, rica.A_all)
+    q = rica.evaluate_clustering(
+        rica.S_all,
+        rica.clustering.labels_,
+        rica.signs_,
+        rica.orientation_,
+    )
+    return rica, q
+
+
+def _centrotypes(rica, q):
+    """Get the centrotype of each non-outlier cluster.
+
+    The centrotype is the member with the highest summed absolute correlation
+    to the other members of its cluster.
+    """
+    S_all = rica.S_all * rica.signs_
+    labels = rica.clustering.labels_
+    centrotypes = []
+    for cluster_id in q.loc[q["cluster_id"] >= 0, "cluster_id"]:
+        members = S_all[:, labels == cluster_id]
+        similarity = np.abs(np.corrcoef(members.T)).sum(axis=0)
+        centrotypes.append(members[:, np.argmax(similarity)])
+
+    return np.column_stack(centrotypes)
+
+
+def _centrotype_drift(old_centrotypes, new_centrotypes):
+    """Measure how far the centrotypes moved between two clusterings.
+
+    Each new centrotype is matched to its most correlated old centrotype.
+    The drift is one minus the mean absolute correlation of the matches, so it's 0
+    when the clusters are unchanged. Appearing or vanishing clusters count as
+    full drift.
+    """
+    correl = np.abs(corrmats(new_centrotypes.T, old_centrotypes.T))
+    matched = correl.max(axis=1)
+    n_clusters = max(new_centrotypes.shape[1], old_centrotypes.shape[1])
+    return 1 - matched.sum() / n_clusters
+
+
+def _run_adaptive(
+    rica,
+    data,
+    seeds,
+    n_jobs,
+    n_components,
+    max_it,
+    fixed_seed,
+    stability_tol,
+    min_robust_runs,
+    check_every,
+):
+    """Run restarts in batches until the clusters are stable or the seeds run out."""
+    results = []
+    old_iq, old_centrotypes = None, None
+    iq, drift = np.nan, np.nan
+    with Parallel(n_jobs=n_jobs) as parallel:
+        while len(results) < len(seeds):
+            batch_seeds = seeds[len(results):len(results) + check_every]
+            results += parallel(delayed(_run_restart)(rica, data, seed) for seed in batch_seeds)
+            if len(results) < min_robust_runs:
+                continue
+
+            try:
+                check_rica, q = _cluster_restarts(
+                    results, n_components, max_it, fixed_seed, "DBSCAN"
+                )
+                centrotypes = _centrotypes(check_rica, q)
+            except Exception:
+                # Too few restarts for DBSCAN to find any clusters yet
+                LGR.info(f"Clusters not yet defined after {len(results)} restarts")
+                continue
+
+            iq = float(np.mean(q[q["cluster_id"] >= 0].iq))
+            if old_iq is not None:
+                drift = _centrotype_drift(old_centrotypes, centrotypes)
+                LGR.info(
+                    f"After {len(results)} restarts: mean iq {iq:.4f} "
+                    f"(change {abs(iq - old_iq):.4f}), centrotype drift {drift:.4f}"
+                )
+                if (abs(iq - old_iq) < stability_tol) and (drift < stability_tol):
+                    LGR.info(
+                        f"Robust ICA clusters stable after {len(results)} of "
+                        f"{len(seeds)} restarts"
+                    )
+                    break
+
+            old_iq, old_centrotypes = iq, centrotypes
+
+    return results, iq, drift
+
+
+def robust_ica(
+    data,
+    n_components,
+    fixed_seed,
+    n_robust_runs,
+    max_it,
+    n_jobs=1,
+    restarts_file=None,
+    stability_tol=None,
+    min_robust_runs=10,
+    check_every=5,
+):
+    """Perform robustica on `data` with the FastICA restarts run in parallel.
+
+    This is a drop-in replacement for :func:`tedana.decomposition.ica.r_ica`.
+
+    Parameters
+    ----------
+    data : (S x T) :obj:`numpy.ndarray`
+        Dimensionally reduced optimally combined functional data.
+    n_components : :obj:`int`
+        Number of components retained from PCA decomposition.
+    fixed_seed : :obj:`int`
+        Seed for ensuring reproducibility of ICA results.
+    n_robust_runs : :obj:`int`
+        Number of FastICA restarts.
+    max_it : :obj:`int`
+        Maximum number of iterations for each FastICA restart.
+    n_jobs : :obj:`int`, optional
+        Number of worker processes to run the restarts on. Default is 1.
+    restarts_file : :obj:`str` or None, optional
+        If given, a TSV with the seed, runtime, and convergence of each restart
+        is written to this path, along with a JSON sidecar recording how many
+        restarts were used.
+    stability_tol : :obj:`float` or None, optional
+        If given, stop scheduling restarts once the change in mean index quality
+        and the centrotype drift between consecutive checks are both below this value.
+        `n_robust_runs` is then the upper limit on the number of restarts.
+        Default is None, which always runs `n_robust_runs` restarts.
+    min_robust_runs : :obj:`int`, optional
+        Minimum number of restarts before stability is checked. Default is 10.
+    check_every : :obj:`int`, optional
+        Number of restarts between stability checks. This doesn't depend on
+        `n_jobs`, so the stopping point doesn't either. Default is 5.
+
+    Returns
+    -------
+    Same as :func:`tedana.decomposition.ica.r_ica`.
+    """
+    if fixed_seed == -1:
+        fixed_seed = np.random.randint(low=1, high=1000)
+
+    seeds = restart_seeds(fixed_seed, n_robust_runs)
+    rica = _make_robustica(n_components, n_robust_runs, max_it, fixed_seed, "DBSCAN")
+    iq, drift = np.nan, np.nan
+    if stability_tol is None:
+        LGR.info(f"Running {n_robust_runs} FastICA restarts on {n_jobs} worker(s)")
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(_run_restart)(rica, data, seed) for seed in seeds
+        )
+    else:
+        LGR.info(
+            f"Running up to {n_robust_runs} FastICA restarts on {n_jobs} worker(s), "
+            f"stopping once clusters are stable to within {stability_tol}"
+        )
+        results, iq, drift = _run_adaptive(
+            rica,
+            data,
+            seeds,
+            n_jobs=n_jobs,
+            n_components=n_components,
+            max_it=max_it,
+            fixed_seed=fixed_seed,
+            stability_tol=stability_tol,
+            min_robust_runs=min_robust_runs,
+            check_every=check_every,
+        )
+
+    n_robust_runs_max = n_robust_runs
+    n_robust_runs = len(results)
+    restarts_df = pd.DataFrame(
+        {
+            "restart": np.arange(1, n_robust_runs + 1),
+            "seed": seeds[:n_robust_runs],
+            "seconds": [r["time"] for r in results],
+            "converged": [r["converged"] for r in results],
+        }
+    )
+    for row in restarts_df.itertuples():
+        LGR.info(
+            f"FastICA restart {row.restart}/{n_robust_runs} (seed {row.seed}) "
+            f"took {row.seconds:.1f}s"
+        )
+
+    if restarts_file is not None:
+        restarts_df.to_csv(restarts_file, sep="\t", index=False)
+        restarts_metadata = {
+            "NRobustRunsUsed": n_robust_runs,
+            "NRobustRunsMax": n_robust_runs_max,
+            "StabilityTolerance": stability_tol,
+            "FinalIndexQualityCheck": None if np.isnan(iq) else iq,
+            "FinalCentrotypeDrift": None if np.isnan(drift) else drift,
+        }
+        with open(restarts_file.replace(".tsv", ".json"), "w") as fo:
+            json.dump(restarts_metadata, fo, sort_keys=True, indent=4)
+
+    # tedana's thresholds and wording (typo included), out of the restarts actually run
+    fastica_convergence_warning_count = int((~restarts_df["converged"]).sum())
+    nonconverge_message = (
+        "For RobustICA, FastICA did not converge in "
+        f"{fastica_convergence_warning_count} of {n_robust_runs} interations."
+    )
+    if fastica_convergence_warning_count / n_robust_runs > 0.25:
+        LGR.warning(
+            f"{nonconverge_message} "
+            "Failing >1/4 of the time means inputted data are not appropriate for ICA. "
+            "Consider rerunning with fewer initial PCA components."
+        )
+    elif fastica_convergence_warning_count / n_robust_runs > 0.1:
+        LGR.warning(
+            f"{nonconverge_message} "
+            "Consider rerunning with fewer initial PCA components."
+        )
+    elif fastica_convergence_warning_count > 0:
+        LGR.info(nonconverge_message)
+
+    # Unlike tedana, a clustering failure doesn't require rerunning the restarts
+    robust_method = "DBSCAN"
+    try:
+        rica, q = _cluster_restarts(results, n_components, max_it, fixed_seed, robust_method)
+    except Exception:
+        robust_method = "AgglomerativeClustering"
+        LGR.warning(
+            "DBSCAN clustering method did not converge. "
+            "Agglomerative clustering will be tried now."
+        )
+        try:
+            rica, q = _cluster_restarts(results, n_components, max_it, fixed_seed, robust_method)
+        except Exception:
+            raise ValueError("RobustICA failed to converge")
+
+    # Excluding outliers (cluster -1) from the index quality calculation
+    index_quality = np.array(np.mean(q[q["cluster_id"] >= 0].iq))
+    if index_quality < WARN_IQ:
+        LGR.warning(
+            f"The resultant mean Index Quality is low ({index_quality}). "
+            "It is recommended to rerun the process with a different seed."
+        )
+
+    # Excluding outliers (cluster -1) when calculating the mixing matrix
+    mixing = rica.A[:, q["cluster_id"] >= 0]
+    mixing = stats.zscore(mixing, axis=0)
+    LGR.info(
+        f"RobustICA with {n_robust_runs} robust runs and seed {fixed_seed} was used. "
+        f"{mixing.shape[1]} components identified. "
+        f"The mean Index Quality is {index_quality}."
+    )
+
+    c_labels = rica.clustering.labels_
+    perplexity = min(rica.S_all.shape[1] - 1, 80)
+    perplexity = perplexity - 1 if perplexity < 81 else 80
+    t_sne = manifold.TSNE(
+        n_components=2,
+        perplexity=perplexity,
+        init="random",
+        n_iter=2500,
+        random_state=10,
+    )
+    similarity_t_sne = t_sne.fit_transform(abs_pearson_dist(rica.S_all))
+
+    return (
+        mixing,
+        fixed_seed,
+        c_labels,
+        similarity_t_sne,
+        fastica_convergence_warning_count,
+        index_quality,
+    )
+
+
+@contextmanager
+def patch_tedana_robustica(**kwargs):
+    """Make tedana use :func:`robust_ica`, with `kwargs`, for its robustica stage."""
+    original_r_ica = tedana_ica.r_ica
+    tedana_ica.r_ica = partial(robust_ica, **kwargs)
+    try:
+        yield
+    finally:
+        tedana_ica.r_ica = original_r_ica
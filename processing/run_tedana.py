@@ -3,43 +3,60 @@
 import argparse
 import json
 import os
+import sys
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager
 from glob import glob
 
-import nibabel as nb
 import numpy as np
 import pandas as pd
-from nilearn.glm.first_level import make_first_level_design_matrix
+import tedana
 from tedana.workflows import tedana_workflow
+from threadpoolctl import threadpool_limits
+
+# Run by path from the sbatch script, so make the repository root importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from processing.compact import (
+    crop_img,
+    patch_tedana_load_data,
+    uncrop_img,
+    write_compact_stack,
+)
+from processing.decay import estimate_t2s_s0
+from processing.manifest import (
+    check_manifest,
+    fingerprint_inputs,
+    load_manifest,
+    write_manifest,
+)
+from processing.metadata_index import MetadataIndex
+from processing.nback_events import events_to_rtdur
+from processing.nifti_cache import cached_path
+from processing.parallel_gzip import patch_nibabel_gzip
+from processing.reclassify import compare_regressors, reclassify_run
+from processing.regressors import build_task_regressors
+from processing.robust_ica import patch_tedana_robustica
 
 
 MOTION_COLUMNS = ["rot_x", "rot_y", "rot_z", "trans_x", "trans_y", "trans_z"]
-
-
-def events_to_rtdur(events_df):
-    """Implement Jeanette Mumford's ConsDurRTDur model on an events dataframe."""
-    # Limit to 0back and 2back trials
-    events_df = events_df.loc[
-        events_df["trial_type"].str.lower().isin(["0back", "2back"])
-    ].copy()
-    events_df = events_df[["onset", "duration", "trial_type", "response_time"]]
-
-    # Normalize casing then rename to valid Python identifiers
-    events_df["trial_type"] = events_df["trial_type"].str.lower()
-    events_df["trial_type"] = events_df["trial_type"].replace(
-        {
-            "0back": "zero_back",
-            "2back": "two_back",
-        }
-    )
-
-    response_events_df = events_df.loc[~np.isnan(events_df["response_time"])].copy()
-    response_events_df.loc[:, "duration"] = response_events_df.loc[:, "response_time"]
-    response_events_df.loc[:, "trial_type"] = "RTDur"
-
-    cons_dur_rt_dur_events_df = pd.concat((events_df, response_events_df))
-    cons_dur_rt_dur_events_df = cons_dur_rt_dur_events_df.sort_values(by="onset")
-    cons_dur_rt_dur_events_df = cons_dur_rt_dur_events_df.reset_index(drop=True)
-    return cons_dur_rt_dur_events_df
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+# tedana settings shared by every run; changing any of them invalidates finished runs
+TEDANA_PARAMS = {
+    "masktype": ["dropout", "decay"],
+    "fittype": "curvefit",
+    "combmode": "t2s",
+    "tedort": True,
+    "tedpca": "aic",
+    "ica_method": "robustica",
+    "n_robust_runs": 50,
+}
 
 
 def build_motion_confounds(confounds_df):
@@ -50,24 +67,48 @@ def build_motion_confounds(confounds_df):
     return confounds_df[MOTION_COLUMNS]
 
 
-def build_fracback_regressors(events_file, frame_times):
-    events_df = pd.read_table(events_file)
-    events_df = events_to_rtdur(events_df)
-
-    if events_df.empty:
-        zeros = np.zeros((len(frame_times), 3))
-        return pd.DataFrame(zeros, columns=["zero_back", "two_back", "RTDur"])
-
-    design_matrix = make_first_level_design_matrix(
-        frame_times=frame_times,
-        events=events_df,
+def build_fracback_regressors(events_file, n_volumes, tr):
+    """Build the ConsDurRTDur task regressors for an n-back run, zero-filling missing ones."""
+    task_regressors = build_task_regressors(
+        events_file,
+        tr=tr,
+        n_volumes=n_volumes,
         hrf_model="glover",
-        drift_model=None,
+        transform=events_to_rtdur,
     )
+    return task_regressors.reindex(columns=["zero_back", "two_back", "RTDur"], fill_value=0.0)
+
 
-    design_matrix = design_matrix[["zero_back", "two_back", "RTDur"]]
+def build_external_regressors(base_file, confounds_file, n_volumes, tr):
+    """Build the external regressors for a run: motion, plus task regressors for n-back."""
+    confounds_df = pd.read_table(confounds_file, usecols=lambda c: c in MOTION_COLUMNS)
+    motion_confounds = build_motion_confounds(confounds_df)
+
+    if len(motion_confounds) != n_volumes:
+        raise ValueError(
+            f"Motion confounds ({len(motion_confounds)}) do not match truncated volumes ({n_volumes})"
+        )
+
+    confounds = motion_confounds
+
+    if "task-fracback" in os.path.basename(base_file):
+        events_file = base_file.replace(
+            "_echo-1_part-mag_bold.nii.gz",
+            "_events.tsv",
+        )
+        assert os.path.isfile(events_file), events_file
+
+        fracback_confounds = build_fracback_regressors(events_file, n_volumes, tr)
+
+        confounds = pd.concat(
+            [
+                motion_confounds.reset_index(drop=True),
+                fracback_confounds.reset_index(drop=True),
+            ],
+            axis=1,
+        )
 
-    return design_matrix
+    return confounds
 
 
 def _normalize_session_label(session_label):
@@ -82,181 +123,593 @@ def _normalize_subject_label(subject_label):
     return subject_label if subject_label.startswith("sub-") else f"sub-{subject_label}"
 
 
-def run_tedana(
-    raw_dir,
+def _run_tedana_single(
+    base_file,
     fmriprep_dir,
     tedana_out_dir,
-    session_label=None,
-    subject_label=None,
+    robustica_n_jobs=None,
+    robustica_stability_tol=None,
+    t2s_prefit=False,
+    metadata_index=None,
+    compact_input=False,
 ):
-    print("TEDANA")
-
-    session_glob = _normalize_session_label(session_label) or "ses-*"
-    subject_glob = _normalize_subject_label(subject_label) or "sub-*"
+    """Run tedana on one multi-echo run, identified by its first-echo raw file.
+
+    If `robustica_n_jobs` is set, the robust ICA restarts are run in parallel on that
+    many worker processes and their seeds and runtimes are written to
+    ``{prefix}_desc-robustica_restarts.tsv``.
+    If `robustica_stability_tol` is set, restarts stop once the clusters are stable,
+    and the number used is recorded in ``{prefix}_desc-robustica_restarts.json``.
+    If `t2s_prefit` is True, T2*/S0 are fit with the batched estimator in ``decay.py``
+    and the T2* map is given to tedana instead of running its voxel-wise curvefit.
+    Echo times, TR, volume counts, and dummy scans are looked up in the
+    `metadata_index` file (created if needed) instead of being read from each file.
+    If `compact_input` is True, tedana reads a stack of the voxels in the mask's
+    bounding box (see ``compact.py``) instead of the full echo files, and its image
+    outputs are padded back to the original space afterwards.
+    """
+    index = MetadataIndex(metadata_index)
+    raw_files = sorted(glob(base_file.replace("echo-1", "echo-*")))
+    tr = None
+    n_volumes = None
+
+    base_filename = os.path.basename(base_file)
+    print(f"\t{base_filename}")
+    subject = base_filename.split("_")[0]
+    session = base_filename.split("_")[1]
+    prefix = base_filename.split("_echo-1")[0]
+
+    # Get the fMRIPrep brain mask
+    mask_base = base_filename.split("_echo-1")[0]
+    mask = os.path.join(
+        fmriprep_dir,
+        subject,
+        session,
+        "func",
+        f"{mask_base}_part-mag_desc-brain_mask.nii.gz",
+    )
+    assert os.path.isfile(mask), mask
 
-    base_search = os.path.join(
-        raw_dir,
-        subject_glob,
-        session_glob,
+    # Get the fMRIPrep confounds file and identify the number of non-steady-state volumes
+    confounds_file = os.path.join(
+        fmriprep_dir,
+        subject,
+        session,
         "func",
-        "sub-*_ses-*_echo-1_part-mag_bold.nii.gz",
+        f"{mask_base}_part-mag_desc-confounds_timeseries.tsv",
     )
-    base_files = sorted(glob(base_search))
-    if not base_files:
-        raise FileNotFoundError(base_search)
+    dummy_scans = index.get(confounds_file)["dummy_scans"]
 
-    for base_file in base_files:
-        raw_files = sorted(glob(base_file.replace("echo-1", "echo-*")))
-        tr = None
-        n_volumes = None
-
-        base_filename = os.path.basename(base_file)
-        print(f"\t{base_filename}")
-        subject = base_filename.split("_")[0]
-        session = base_filename.split("_")[1]
-        prefix = base_filename.split("_echo-1")[0]
-
-        # Get the fMRIPrep brain mask
-        mask_base = base_filename.split("_echo-1")[0]
-        mask = os.path.join(
-            fmriprep_dir,
-            subject,
-            session,
-            "func",
-            f"{mask_base}_part-mag_desc-brain_mask.nii.gz",
-        )
-        assert os.path.isfile(mask), mask
+    print(f"\t\t{dummy_scans} dummy scans")
 
-        # Get the fMRIPrep confounds file and identify the number of non-steady-state volumes
-        confounds_file = os.path.join(
+    echo_times = []
+    fmriprep_files = []
+    for raw_file in raw_files:
+        base_query = os.path.basename(raw_file).split("_bold.nii.gz")[0]
+
+        # Get echo time from json file
+        echo_times.append(index.get(raw_file.replace(".nii.gz", ".json"))["EchoTime"])
+
+        # Get the fMRIPrep BOLD files
+        fmriprep_file = os.path.join(
             fmriprep_dir,
             subject,
             session,
             "func",
-            f"{mask_base}_part-mag_desc-confounds_timeseries.tsv",
+            f"{base_query}_desc-preproc_bold.nii.gz",
+        )
+        assert os.path.isfile(fmriprep_file), fmriprep_file
+        fmriprep_files.append(fmriprep_file)
+
+        echo_metadata = index.get(fmriprep_file)
+        if tr is None:
+            tr = echo_metadata["zooms"][3]
+        if n_volumes is None:
+            n_volumes = echo_metadata["shape"][-1]
+
+    if tr is None or n_volumes is None:
+        raise RuntimeError(
+            f"Unable to determine TR or volume count for {base_filename}"
         )
-        confounds_df = pd.read_table(confounds_file)
-        nss_cols = [
-            c for c in confounds_df.columns if c.startswith("non_steady_state_outlier")
-        ]
 
-        dummy_scans = 0
-        if nss_cols:
-            initial_volumes_df = confounds_df[nss_cols]
-            dummy_scans = np.any(initial_volumes_df.to_numpy(), axis=1)
-            dummy_scans = np.where(dummy_scans)[0]
+    index.save()
 
-            # reasonably assumes all NSS volumes are contiguous
-            dummy_scans = int(dummy_scans[-1] + 1)
+    # Decompressed copies on local scratch, if NIFTI_CACHE_DIR is set, so the echoes
+    # are gunzipped once per node instead of once per read
+    echo_files = [cached_path(f) for f in fmriprep_files]
 
-        print(f"\t\t{dummy_scans} dummy scans")
+    confounds = build_external_regressors(base_file, confounds_file, n_volumes, tr)
 
-        echo_times = []
-        fmriprep_files = []
-        for raw_file in raw_files:
-            base_query = os.path.basename(raw_file).split("_bold.nii.gz")[0]
+    tedana_run_out_dir = os.path.join(tedana_out_dir, subject, session, "func")
+    os.makedirs(tedana_run_out_dir, exist_ok=True)
 
-            # Get echo time from json file
-            with open(raw_file.replace(".nii.gz", ".json"), "r") as f:
-                echo_times.append(json.load(f)["EchoTime"])
+    tree = _run_tree(prefix)
 
-            # Get the fMRIPrep BOLD files
-            fmriprep_file = os.path.join(
-                fmriprep_dir,
-                subject,
-                session,
-                "func",
-                f"{base_query}_desc-preproc_bold.nii.gz",
+    confounds_file = os.path.join(tedana_run_out_dir, f"{prefix}_confounds.tsv")
+    confounds.to_csv(confounds_file, sep="\t", index=False)
+
+    tedana_kwargs = dict(
+        data=echo_files,
+        tes=echo_times,
+        mask=mask,
+        out_dir=tedana_run_out_dir,
+        prefix=prefix,
+        tree=tree,
+        external_regressors=confounds_file,
+        dummy_scans=dummy_scans,
+        # Stale or partial runs are redone in place
+        overwrite=True,
+        **TEDANA_PARAMS,
+    )
+    if t2s_prefit:
+        print("\t\tFitting T2* and S0 maps")
+        t2smap = os.path.join(tedana_run_out_dir, f"{prefix}_desc-prefit_T2starmap.nii.gz")
+        estimate_t2s_s0(
+            echo_files=echo_files,
+            echo_times=echo_times,
+            mask=mask,
+            out_t2s=t2smap,
+            out_s0=os.path.join(tedana_run_out_dir, f"{prefix}_desc-prefit_S0map.nii.gz"),
+            masktype=tedana_kwargs["masktype"],
+            dummy_scans=dummy_scans,
+        )
+        tedana_kwargs["t2smap"] = t2smap
+
+    with ExitStack() as stack:
+        if robustica_n_jobs is not None or robustica_stability_tol is not None:
+            restarts_file = os.path.join(
+                tedana_run_out_dir,
+                f"{prefix}_desc-robustica_restarts.tsv",
+            )
+            stack.enter_context(
+                patch_tedana_robustica(
+                    n_jobs=robustica_n_jobs or 1,
+                    restarts_file=restarts_file,
+                    stability_tol=robustica_stability_tol,
+                )
+            )
+
+        if compact_input:
+            print("\t\tCompacting echoes")
+            # Goes in $TMPDIR, which is node-local scratch on most clusters
+            compact_dir = stack.enter_context(
+                tempfile.TemporaryDirectory(prefix=f"{prefix}_compact-")
             )
-            assert os.path.isfile(fmriprep_file), fmriprep_file
-            fmriprep_files.append(fmriprep_file)
-
-            # Remove non-steady-state volumes
-            echo_img = nb.load(fmriprep_file)
-            if tr is None:
-                tr = echo_img.header.get_zooms()[3]
-            if n_volumes is None:
-                n_volumes = echo_img.shape[-1]
-
-        if tr is None or n_volumes is None:
-            raise RuntimeError(
-                f"Unable to determine TR or volume count for {base_filename}"
+            stack_file, compact_mask, ref_img, bbox = write_compact_stack(
+                echo_files,
+                mask,
+                out_dir=compact_dir,
+                prefix=prefix,
             )
+            tedana_kwargs["mask"] = compact_mask
+            if "t2smap" in tedana_kwargs:
+                compact_t2smap = os.path.join(compact_dir, os.path.basename(t2smap))
+                crop_img(t2smap, bbox, compact_t2smap)
+                tedana_kwargs["t2smap"] = compact_t2smap
+
+            stack.enter_context(patch_tedana_load_data(stack_file, ref_img))
+
+        tedana_workflow(**tedana_kwargs)
+
+    if compact_input:
+        out_files = _registry_outputs(tedana_run_out_dir, prefix)
+        if "t2smap" in tedana_kwargs:
+            # tedana copies a given T2* map into its outputs without registering it
+            out_files.append(f"{prefix}_T2starmap.nii.gz")
+
+        for out_file in out_files:
+            if out_file.endswith(".nii.gz"):
+                uncrop_img(os.path.join(tedana_run_out_dir, out_file), mask, bbox)
+
+    _write_rejected_timeseries(tedana_run_out_dir, prefix, dummy_scans)
+
+
+def _write_rejected_timeseries(tedana_run_out_dir, prefix, dummy_scans):
+    """Write the rejected components' time series, padded with zeros for dummy volumes."""
+    mixing = os.path.join(tedana_run_out_dir, f"{prefix}_desc-ICAOrth_mixing.tsv")
+    mixing_df = pd.read_table(mixing)
+    metrics = os.path.join(tedana_run_out_dir, f"{prefix}_desc-tedana_metrics.tsv")
+    metrics_df = pd.read_table(metrics, index_col="Component")
+    comps_rejected = metrics_df[metrics_df["classification"] == "rejected"].index.tolist()
+    mixing_df = mixing_df[comps_rejected]
+    if dummy_scans > 0:
+        # Add dummy volumes to the rejected array
+        rejected_arr = mixing_df.to_numpy()
+        dummy_arr = np.zeros((dummy_scans, rejected_arr.shape[1]))
+        rejected_arr = np.concatenate((dummy_arr, rejected_arr), axis=0)
+        mixing_df = pd.DataFrame(rejected_arr, columns=mixing_df.columns)
+
+    out_confounds = os.path.join(tedana_run_out_dir, f"{prefix}_desc-rejected_timeseries.tsv")
+    mixing_df.to_csv(out_confounds, sep="\t", index=False)
+
+
+def _run_paths(base_file, tedana_out_dir):
+    """Get the output directory and file prefix for a run."""
+    base_filename = os.path.basename(base_file)
+    subject, session = base_filename.split("_")[:2]
+    prefix = base_filename.split("_echo-1")[0]
+    tedana_run_out_dir = os.path.join(tedana_out_dir, subject, session, "func")
+    return tedana_run_out_dir, prefix
+
+
+def _run_tree(prefix):
+    """Get the decision tree for a run."""
+    if "task-fracback" in prefix:
+        return "tedana_minimal_task.json"
+
+    return "tedana_minimal_rest.json"
+
+
+def _run_inputs(base_file, fmriprep_dir):
+    """List every file a run's outputs depend on, keyed by a short label."""
+    base_filename = os.path.basename(base_file)
+    subject, session = base_filename.split("_")[:2]
+    prefix = base_filename.split("_echo-1")[0]
+    func_dir = os.path.join(fmriprep_dir, subject, session, "func")
+
+    inputs = {}
+    for raw_file in sorted(glob(base_file.replace("echo-1", "echo-*"))):
+        base_query = os.path.basename(raw_file).split("_bold.nii.gz")[0]
+        echo = base_query.split("_echo-")[1].split("_")[0]
+        inputs[f"echo-{echo}_json"] = raw_file.replace(".nii.gz", ".json")
+        inputs[f"echo-{echo}_bold"] = os.path.join(
+            func_dir,
+            f"{base_query}_desc-preproc_bold.nii.gz",
+        )
+
+    inputs["mask"] = os.path.join(func_dir, f"{prefix}_part-mag_desc-brain_mask.nii.gz")
+    inputs["confounds"] = os.path.join(
+        func_dir,
+        f"{prefix}_part-mag_desc-confounds_timeseries.tsv",
+    )
+    if "task-fracback" in prefix:
+        inputs["events"] = base_file.replace("_echo-1_part-mag_bold.nii.gz", "_events.tsv")
+
+    inputs["tree"] = _run_tree(prefix)
+    return inputs
+
+
+def _run_parameters(prefix, run_kwargs):
+    """Collect the settings a run's outputs depend on."""
+    return {
+        **TEDANA_PARAMS,
+        "tree": _run_tree(prefix),
+        "tedana_version": tedana.__version__,
+        # The number of restart workers doesn't change the results, so it's left out
+        "robustica_stability_tol": run_kwargs["robustica_stability_tol"],
+        "t2s_prefit": run_kwargs["t2s_prefit"],
+        "compact_input": run_kwargs["compact_input"],
+    }
+
+
+def _registry_outputs(tedana_run_out_dir, prefix):
+    """List the outputs in a run's tedana registry, relative to its output directory."""
+    registry_file = os.path.join(tedana_run_out_dir, f"{prefix}_desc-tedana_registry.json")
+    with open(registry_file, "r") as fo:
+        registry = json.load(fo)
+
+    return [v for k, v in registry.items() if k != "input img"]
+
+
+def _run_outputs(tedana_run_out_dir, prefix):
+    """List a finished run's outputs, relative to its output directory."""
+    outputs = _registry_outputs(tedana_run_out_dir, prefix)
+    outputs += [
+        f"{prefix}_desc-tedana_registry.json",
+        f"{prefix}_tedana_report.html",
+        f"{prefix}_confounds.tsv",
+        f"{prefix}_desc-rejected_timeseries.tsv",
+    ]
+    optional_outputs = [
+        f"{prefix}_T2starmap.nii.gz",
+        f"{prefix}_desc-prefit_T2starmap.nii.gz",
+        f"{prefix}_desc-prefit_S0map.nii.gz",
+        f"{prefix}_desc-robustica_restarts.tsv",
+        f"{prefix}_desc-robustica_restarts.json",
+    ]
+    outputs += [
+        f for f in optional_outputs if os.path.isfile(os.path.join(tedana_run_out_dir, f))
+    ]
+    return outputs
+
+
+def _has_run_outputs(tedana_run_out_dir, prefix):
+    """Check whether a run has every output a finished run has, with or without a manifest."""
+    try:
+        outputs = _run_outputs(tedana_run_out_dir, prefix)
+    except (OSError, json.JSONDecodeError):
+        return False
+
+    return all(os.path.isfile(os.path.join(tedana_run_out_dir, f)) for f in outputs)
+
+
+def _adopt_run(base_file, fmriprep_dir, tedana_out_dir, run_kwargs):
+    """Write a manifest for a run that finished before manifests were written.
+
+    The run's current inputs and the current parameters are recorded as the ones it
+    was made with, so only adopt runs that were made with the current settings.
+    """
+    tedana_run_out_dir, prefix = _run_paths(base_file, tedana_out_dir)
+    write_manifest(
+        os.path.join(tedana_run_out_dir, f"{prefix}_desc-manifest.json"),
+        inputs=fingerprint_inputs(_run_inputs(base_file, fmriprep_dir)),
+        parameters=_run_parameters(prefix, run_kwargs),
+        outputs=_run_outputs(tedana_run_out_dir, prefix),
+    )
+
+
+def _run_tedana_tracked(base_file, fmriprep_dir, tedana_out_dir, run_kwargs):
+    """Run tedana on one run and write its manifest once everything is in place."""
+    tedana_run_out_dir, prefix = _run_paths(base_file, tedana_out_dir)
+    manifest_file = os.path.join(tedana_run_out_dir, f"{prefix}_desc-manifest.json")
+
+    # Drop the old manifest first, so a crash partway through leaves the run unfinished
+    previous = load_manifest(manifest_file) or {}
+    if os.path.isfile(manifest_file):
+        os.remove(manifest_file)
+
+    # Fingerprint the inputs before running, so changes made mid-run show up as stale
+    inputs = fingerprint_inputs(
+        _run_inputs(base_file, fmriprep_dir),
+        previous=previous.get("Inputs"),
+    )
+    _run_tedana_single(base_file, fmriprep_dir, tedana_out_dir, **run_kwargs)
+    write_manifest(
+        manifest_file,
+        inputs=inputs,
+        parameters=_run_parameters(prefix, run_kwargs),
+        outputs=_run_outputs(tedana_run_out_dir, prefix),
+    )
+
 
-        motion_confounds = build_motion_confounds(confounds_df)
+@contextmanager
+def _redirect_output(log_file):
+    """Send everything written to stdout/stderr, including from C extensions, to a file."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    with open(log_file, "a") as fo:
+        os.dup2(fo.fileno(), 1)
+        os.dup2(fo.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+
+
+def _run_tedana_worker(base_file, fmriprep_dir, tedana_out_dir, n_threads, run_kwargs):
+    """Run a single run in a worker process, with capped threads and its own log file."""
+    for var in THREAD_ENV_VARS:
+        # Inherited by any processes the worker spawns (e.g., joblib workers)
+        os.environ[var] = str(n_threads)
+
+    tedana_run_out_dir, prefix = _run_paths(base_file, tedana_out_dir)
+    os.makedirs(tedana_run_out_dir, exist_ok=True)
+    log_file = os.path.join(tedana_run_out_dir, f"{prefix}_run_tedana.log")
+    gzip_output = patch_nibabel_gzip("derivative", n_threads=n_threads)
+    with _redirect_output(log_file), threadpool_limits(limits=n_threads), gzip_output:
+        try:
+            _run_tedana_tracked(base_file, fmriprep_dir, tedana_out_dir, run_kwargs)
+        except Exception:
+            traceback.print_exc()
+            raise
+
+    return log_file
+
+
+def _reclassify(
+    base_files,
+    fmriprep_dir,
+    tedana_out_dir,
+    metadata_index=None,
+    plan=False,
+    recompute_regressors=False,
+):
+    """Re-run the current decision trees on finished runs and rewrite their exports.
 
-        if len(motion_confounds) != n_volumes:
-            raise ValueError(
-                f"Motion confounds ({len(motion_confounds)}) do not match truncated volumes ({n_volumes})"
+    If `recompute_regressors` is True, the external regressors are rebuilt first,
+    compared with the saved ones, and refit to the saved ICA mixing matrix.
+    """
+    index = MetadataIndex(metadata_index)
+    for base_file in base_files:
+        tedana_run_out_dir, prefix = _run_paths(base_file, tedana_out_dir)
+        metrics_file = os.path.join(tedana_run_out_dir, f"{prefix}_desc-tedana_metrics.tsv")
+        if not os.path.isfile(metrics_file):
+            print(f"SKIPPED: {prefix} (no tedana outputs)")
+            continue
+
+        inputs = _run_inputs(base_file, fmriprep_dir)
+        dummy_scans = index.get(inputs["confounds"])["dummy_scans"]
+        external_regressors = None
+        if recompute_regressors:
+            echo_metadata = index.get(inputs["echo-1_bold"])
+            external_regressors = build_external_regressors(
+                base_file,
+                inputs["confounds"],
+                n_volumes=echo_metadata["shape"][-1],
+                tr=echo_metadata["zooms"][3],
             )
+            regressors_file = os.path.join(tedana_run_out_dir, f"{prefix}_confounds.tsv")
+            changes = compare_regressors(pd.read_table(regressors_file), external_regressors)
+            print(f"{prefix}: {len(changes) or 'no'} regressor changes")
+            for change in changes:
+                print(f"\t{change}")
+
+        if plan:
+            print(f"TODO: {prefix} (reclassify with {inputs['tree']})")
+            continue
 
-        confounds = motion_confounds
+        if external_regressors is not None:
+            external_regressors.to_csv(regressors_file, sep="\t", index=False)
 
-        if "task-fracback" in prefix:
-            events_file = base_file.replace(
-                "_echo-1_part-mag_bold.nii.gz",
-                "_events.tsv",
+        n_changed = reclassify_run(
+            tedana_run_out_dir,
+            prefix,
+            inputs["tree"],
+            external_regressors=external_regressors,
+            dummy_scans=dummy_scans,
+        )
+        _write_rejected_timeseries(tedana_run_out_dir, prefix, dummy_scans)
+
+        # Record the new tree and regressor inputs, so the run isn't redone because of them
+        manifest_file = os.path.join(tedana_run_out_dir, f"{prefix}_desc-manifest.json")
+        manifest = load_manifest(manifest_file)
+        if manifest is not None:
+            updated = ["tree", "confounds", "events"] if recompute_regressors else ["tree"]
+            manifest["Inputs"].update(
+                fingerprint_inputs({k: v for k, v in inputs.items() if k in updated})
             )
-            assert os.path.isfile(events_file), events_file
+            write_manifest(
+                manifest_file,
+                inputs=manifest["Inputs"],
+                parameters=manifest["Parameters"],
+                outputs=manifest["Outputs"],
+            )
+
+        print(f"RECLASSIFIED: {prefix} ({n_changed} components changed)")
 
-            frame_times = np.arange(n_volumes) * tr
-            fracback_confounds = build_fracback_regressors(events_file, frame_times)
+    index.save()
 
-            confounds = pd.concat(
-                [
-                    motion_confounds.reset_index(drop=True),
-                    fracback_confounds.reset_index(drop=True),
-                ],
-                axis=1,
+
+def run_tedana(
+    raw_dir,
+    fmriprep_dir,
+    tedana_out_dir,
+    session_label=None,
+    subject_label=None,
+    n_procs=1,
+    n_threads=None,
+    robustica_n_jobs=None,
+    robustica_stability_tol=None,
+    t2s_prefit=False,
+    metadata_index=None,
+    compact_input=False,
+    plan=False,
+    reclassify=False,
+    recompute_regressors=False,
+    adopt_existing=False,
+):
+    print("TEDANA")
+
+    session_glob = _normalize_session_label(session_label) or "ses-*"
+    subject_glob = _normalize_subject_label(subject_label) or "sub-*"
+
+    base_search = os.path.join(
+        raw_dir,
+        subject_glob,
+        session_glob,
+        "func",
+        "sub-*_ses-*_echo-1_part-mag_bold.nii.gz",
+    )
+    base_files = sorted(glob(base_search))
+    if not base_files:
+        raise FileNotFoundError(base_search)
+
+    run_kwargs = {
+        "robustica_n_jobs": robustica_n_jobs,
+        "robustica_stability_tol": robustica_stability_tol,
+        "t2s_prefit": t2s_prefit,
+        "metadata_index": metadata_index,
+        "compact_input": compact_input,
+    }
+
+    if reclassify or recompute_regressors:
+        with patch_nibabel_gzip("derivative"):
+            _reclassify(
+                base_files,
+                fmriprep_dir,
+                tedana_out_dir,
+                metadata_index,
+                plan=plan,
+                recompute_regressors=recompute_regressors,
             )
+        return
 
-        tedana_run_out_dir = os.path.join(tedana_out_dir, subject, session, "func")
-        os.makedirs(tedana_run_out_dir, exist_ok=True)
-        if os.path.isfile(
-            os.path.join(tedana_run_out_dir, f"{prefix}_tedana_report.html")
-        ):
+    # Drop runs whose manifest still matches their inputs before any work is scheduled
+    todo_files = []
+    unmanifested = []
+    for base_file in base_files:
+        tedana_run_out_dir, prefix = _run_paths(base_file, tedana_out_dir)
+        status, reasons = check_manifest(
+            os.path.join(tedana_run_out_dir, f"{prefix}_desc-manifest.json"),
+            inputs=_run_inputs(base_file, fmriprep_dir),
+            parameters=_run_parameters(prefix, run_kwargs),
+            refresh=not plan,
+        )
+        if status == "done":
             print(f"DONE: {prefix}")
             continue
 
-        tree = "tedana_minimal_rest.json"
-        if "task-fracback" in prefix:
-            tree = "tedana_minimal_task.json"
+        if status == "new" and _has_run_outputs(tedana_run_out_dir, prefix):
+            # Finished before manifests were written; never redone without being asked
+            unmanifested.append(prefix)
+            if adopt_existing and not plan:
+                _adopt_run(base_file, fmriprep_dir, tedana_out_dir, run_kwargs)
+                print(f"ADOPTED: {prefix}")
+            elif adopt_existing:
+                print(f"UNMANIFESTED: {prefix} (would be adopted)")
+            else:
+                print(
+                    f"UNMANIFESTED: {prefix} (finished without a manifest; pass "
+                    "--adopt-existing to record one, or remove its outputs to redo it)"
+                )
+            continue
 
-        confounds_file = os.path.join(tedana_run_out_dir, f"{prefix}_confounds.tsv")
-        confounds.to_csv(confounds_file, sep="\t", index=False)
+        reason_str = f": {', '.join(reasons)}" if reasons else ""
+        print(f"TODO: {prefix} ({status}{reason_str})")
+        todo_files.append(base_file)
 
-        tedana_workflow(
-            data=fmriprep_files,
-            tes=echo_times,
-            mask=mask,
-            masktype=["dropout", "decay"],
-            out_dir=tedana_run_out_dir,
-            prefix=prefix,
-            fittype="curvefit",
-            combmode="t2s",
-            tree=tree,
-            tedort=True,
-            external_regressors=confounds_file,
-            tedpca="aic",
-            ica_method="robustica",
-            n_robust_runs=50,
-            dummy_scans=dummy_scans,
+    if plan:
+        print(
+            f"\t{len(todo_files)} of {len(base_files)} runs would be run; "
+            f"{len(unmanifested)} finished without a manifest"
         )
-        mixing = os.path.join(tedana_run_out_dir, f"{prefix}_desc-ICAOrth_mixing.tsv")
-        mixing_df = pd.read_table(mixing)
-        metrics = os.path.join(tedana_run_out_dir, f"{prefix}_desc-tedana_metrics.tsv")
-        metrics_df = pd.read_table(metrics, index_col="Component")
-        comps_rejected = metrics_df[metrics_df["classification"] == "rejected"].index.tolist()
-        mixing_df = mixing_df[comps_rejected]
-        if dummy_scans > 0:
-            # Add dummy volumes to the rejected array
-            rejected_arr = mixing_df.to_numpy()
-            dummy_arr = np.zeros((dummy_scans, rejected_arr.shape[1]))
-            rejected_arr = np.concatenate((dummy_arr, rejected_arr), axis=0)
-            mixing_df = pd.DataFrame(rejected_arr, columns=mixing_df.columns)
-
-        out_confounds = os.path.join(tedana_run_out_dir, f"{prefix}_desc-rejected_timeseries.tsv")
-        mixing_df.to_csv(out_confounds, sep="\t", index=False)
+        return
+
+    if n_procs == 1:
+        with patch_nibabel_gzip("derivative"):
+            for base_file in todo_files:
+                _run_tedana_tracked(base_file, fmriprep_dir, tedana_out_dir, run_kwargs)
+
+        return
+
+    if n_threads is None:
+        n_cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count()))
+        n_threads = max(1, n_cpus // n_procs)
+
+    print(f"\tRunning {len(todo_files)} runs on {n_procs} workers ({n_threads} threads each)")
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_procs) as executor:
+        futures = {
+            executor.submit(
+                _run_tedana_worker,
+                base_file,
+                fmriprep_dir,
+                tedana_out_dir,
+                n_threads,
+                run_kwargs,
+            ): base_file
+            for base_file in todo_files
+        }
+        for future in as_completed(futures):
+            base_file = futures[future]
+            _, prefix = _run_paths(base_file, tedana_out_dir)
+            try:
+                log_file = future.result()
+            except Exception as exc:
+                # Don't let one crashed run stop the others
+                print(f"FAILED: {prefix} ({type(exc).__name__}: {exc})")
+                failed.append(prefix)
+            else:
+                print(f"FINISHED: {prefix} (log: {log_file})")
+
+    if failed:
+        raise RuntimeError(f"tedana failed for {len(failed)} run(s): {failed}")
 
 
 if __name__ == "__main__":
@@ -284,6 +737,103 @@ if __name__ == "__main__":
         "--subject-label",
         help="Optional subject label (with or without 'sub-' prefix) to restrict processing.",
     )
+    parser.add_argument(
+        "--n-procs",
+        type=int,
+        default=1,
+        help=(
+            "Number of runs to process concurrently, each in its own worker process "
+            "with its own log file. Default is 1 (serial)."
+        ),
+    )
+    parser.add_argument(
+        "--n-threads",
+        type=int,
+        help=(
+            "BLAS/OpenMP threads per worker when --n-procs > 1. "
+            "Defaults to the available CPUs divided by --n-procs."
+        ),
+    )
+    parser.add_argument(
+        "--robustica-n-jobs",
+        type=int,
+        help=(
+            "Run the robust ICA restarts in parallel on this many worker processes, "
+            "with a fixed seed per restart, and write each restart's runtime to "
+            "*_desc-robustica_restarts.tsv. By default tedana runs them serially."
+        ),
+    )
+    parser.add_argument(
+        "--robustica-stability-tol",
+        type=float,
+        help=(
+            "Stop running robust ICA restarts once the change in mean index quality and "
+            "the centrotype drift between checks are both below this value. "
+            "The 50 restarts become an upper limit, and the number actually used is "
+            "written to *_desc-robustica_restarts.json. By default all 50 are run."
+        ),
+    )
+    parser.add_argument(
+        "--t2s-prefit",
+        action="store_true",
+        help=(
+            "Fit T2* and S0 for all voxels at once with a batched nonlinear solver and "
+            "pass the T2* map to tedana, instead of tedana's voxel-by-voxel curvefit."
+        ),
+    )
+    parser.add_argument(
+        "--metadata-index",
+        help=(
+            "JSON metadata index (see metadata_index.py) to read echo times, TRs, volume "
+            "counts, and dummy scans from. It's created or updated as needed."
+        ),
+    )
+    parser.add_argument(
+        "--compact-input",
+        action="store_true",
+        help=(
+            "Stream the echoes into a memory-mapped stack covering only the brain mask's "
+            "bounding box and run tedana on that, to cut peak memory. "
+            "Image outputs are padded back to the original space."
+        ),
+    )
+    parser.add_argument(
+        "--reclassify",
+        action="store_true",
+        help=(
+            "Re-run only the decision tree on finished runs, using their saved component "
+            "metrics and mixing matrices, and rewrite *_desc-rejected_timeseries.tsv. "
+            "tedana's images and report are not updated."
+        ),
+    )
+    parser.add_argument(
+        "--recompute-regressors",
+        action="store_true",
+        help=(
+            "Like --reclassify, but first rebuild the external regressors (motion and task), "
+            "report how they differ from the saved *_confounds.tsv, and refit them to the "
+            "saved ICA mixing matrix instead of reusing the saved fit statistics."
+        ),
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help=(
+            "Only report which runs would be run and why (no manifest, changed inputs or "
+            "parameters, or missing outputs), without running anything. Runs with every "
+            "output but no manifest are reported as unmanifested."
+        ),
+    )
+    parser.add_argument(
+        "--adopt-existing",
+        action="store_true",
+        help=(
+            "Write manifests for runs that have every output but no manifest (i.e., that "
+            "finished before manifests were written), recording their current inputs and "
+            "the current parameters, instead of skipping them. Only use this if they were "
+            "made with the current settings."
+        ),
+    )
     args = parser.parse_args()
 
     run_tedana(
@@ -292,4 +842,15 @@ if __name__ == "__main__":
         tedana_out_dir=args.tedana_out_dir,
         session_label=args.session_label,
         subject_label=args.subject_label,
+        n_procs=args.n_procs,
+        n_threads=args.n_threads,
+        robustica_n_jobs=args.robustica_n_jobs,
+        robustica_stability_tol=args.robustica_stability_tol,
+        t2s_prefit=args.t2s_prefit,
+        metadata_index=args.metadata_index,
+        compact_input=args.compact_input,
+        plan=args.plan,
+        reclassify=args.reclassify,
+        recompute_regressors=args.recompute_regressors,
+        adopt_existing=args.adopt_existing,
     )
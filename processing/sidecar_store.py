@@ -0,0 +1,177 @@
+"""An in-memory store of a BIDS dataset's JSON sidecars.
+
+The JSON curation steps used to open, parse, and rewrite each sidecar on its own, and
+some sidecars were rewritten once per field map that pointed at them. Here every
+sidecar is read in one pass, on a thread pool, and edited in memory.
+:meth:`SidecarStore.flush` then writes only the sidecars that were edited and whose
+serialized content differs from what's on disk, each to a temporary file that replaces
+the original, so rerunning a step writes nothing. Sidecars are edited through
+:meth:`SidecarStore.edit`, :meth:`SidecarStore.add`, or :meth:`SidecarStore.drop_keys`,
+which mark them dirty. A sidecar that was only read is never rewritten, even if its
+formatting differs from ours.
+
+Sidecars are serialized as the curation scripts always have, with
+``json.dumps(metadata, indent=4, sort_keys=True)``.
+"""
+
+import json
+import os
+import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from glob import glob
+
+from processing.parallel_gzip import default_n_threads
+
+SIDECAR_PATTERN = "sub-*/ses-*/*/*.json"
+
+
+def _read(path):
+    with open(path, "r") as fo:
+        return fo.read()
+
+
+def _write(path, text):
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as fo:
+        fo.write(text)
+
+    if os.path.isfile(path):
+        shutil.copymode(path, tmp_file)
+    os.replace(tmp_file, path)
+
+
+def dumps(metadata):
+    """Serialize a sidecar."""
+    return json.dumps(metadata, indent=4, sort_keys=True)
+
+
+class SidecarStore:
+    """Every sidecar in a dataset, loaded at once and flushed only where it changed.
+
+    Parameters
+    ----------
+    dset_dir : :obj:`str`
+        BIDS dataset.
+    pattern : :obj:`str`, optional
+        Glob of the sidecars to load, relative to ``dset_dir``.
+    n_threads : :obj:`int`, optional
+        Threads for reading and writing. Defaults to ``SLURM_CPUS_PER_TASK`` or the
+        number of CPUs.
+    """
+
+    def __init__(self, dset_dir, pattern=SIDECAR_PATTERN, n_threads=None):
+        self.dset_dir = dset_dir
+        self.n_threads = n_threads or default_n_threads()
+        paths = sorted(glob(os.path.join(dset_dir, pattern)))
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            texts = list(executor.map(_read, paths))
+
+        # What's on disk, to compare against when flushing
+        self._on_disk = dict(zip(paths, texts))
+        self._metadata = {path: json.loads(text) for path, text in zip(paths, texts)}
+        self._dirty = set()
+        self._dirs = defaultdict(list)
+        for path in paths:
+            self._dirs[os.path.dirname(path)].append(os.path.basename(path))
+
+    def __contains__(self, path):
+        return path in self._metadata
+
+    def __getitem__(self, path):
+        """Get a sidecar's metadata for reading. Use :meth:`edit` to change it."""
+        return self._metadata[path]
+
+    def __iter__(self):
+        return iter(sorted(self._metadata))
+
+    def __len__(self):
+        return len(self._metadata)
+
+    def add(self, path, metadata):
+        """Add a new sidecar, which is written on the next flush."""
+        if path in self._metadata:
+            raise FileExistsError(f"{path} is already in the store")
+
+        self._metadata[path] = metadata
+        self._dirty.add(path)
+        self._dirs[os.path.dirname(path)].append(os.path.basename(path))
+
+    def glob(self, pattern):
+        """Find sidecars in the store, like :func:`glob.glob`.
+
+        Only the filename may have wildcards.
+        """
+        directory, name_pattern = os.path.split(pattern)
+        names = self._dirs.get(directory, [])
+        return sorted(os.path.join(directory, n) for n in names if fnmatchcase(n, name_pattern))
+
+    def sessions(self):
+        """List the session directories that have sidecars."""
+        return sorted({os.path.dirname(directory) for directory in self._dirs})
+
+    def edit(self, path):
+        """Get a sidecar's metadata for editing, marking it to be written on the next flush."""
+        metadata = self._metadata[path]
+        self._dirty.add(path)
+        return metadata
+
+    def mark_dirty(self, paths=None):
+        """Mark sidecars (all of them by default) to be written on the next flush.
+
+        Sidecars whose serialized content already matches what's on disk are still skipped,
+        so this only rewrites the ones whose formatting differs.
+        """
+        self._dirty.update(self if paths is None else paths)
+
+    def drop_keys(self, keys, paths=None):
+        """Remove fields from sidecars (all of them by default).
+
+        Only the sidecars that had any of the fields are marked dirty.
+        """
+        for path in self if paths is None else paths:
+            metadata = self._metadata[path]
+            for key in keys:
+                if key in metadata:
+                    metadata.pop(key)
+                    self._dirty.add(path)
+
+    def changed(self):
+        """List the edited sidecars whose content differs from what's on disk.
+
+        Returns
+        -------
+        changed : :obj:`dict`
+            Serialized content, by path.
+        """
+        changed = {}
+        for path in sorted(self._dirty):
+            text = dumps(self._metadata[path])
+            if self._on_disk.get(path) != text:
+                changed[path] = text
+
+        return changed
+
+    def flush(self, dry_run=False):
+        """Write the edited sidecars that changed.
+
+        Parameters
+        ----------
+        dry_run : :obj:`bool`, optional
+            List the sidecars without writing them, and keep them dirty.
+
+        Returns
+        -------
+        changed : :obj:`list` of :obj:`str`
+            Sidecars that were written (or would be, in a dry run).
+        """
+        changed = self.changed()
+        if not dry_run:
+            with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+                list(executor.map(_write, changed.keys(), changed.values()))
+
+            self._on_disk.update(changed)
+            self._dirty.clear()
+
+        return list(changed)
@@ -0,0 +1,120 @@
+"""Split 4D NIfTI files into consecutive volume ranges in one streaming pass.
+
+Splitting the noise volumes off a run with nibabel loads the whole run, slices it
+twice, and compresses both halves on one core. Here the run is decompressed once,
+volume by volume, and each volume's bytes are copied into the output it belongs to,
+through :class:`~parallel_gzip.ParallelGzipWriter`. The data are copied as stored, so
+the data type and scaling are unchanged, and memory use doesn't depend on the number
+of volumes.
+
+Outputs are written to temporary files and renamed once every output is complete, so
+a run can be split in place (e.g., the BOLD volumes back into the original file).
+"""
+
+import gzip
+import io
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import nibabel as nb
+import numpy as np
+
+from processing.parallel_gzip import ParallelGzipWriter, default_n_threads
+
+
+def split_volumes(in_file, splits, compresslevel=1, n_threads=None):
+    """Stream a 4D ``.nii.gz`` file's volumes into several files.
+
+    Parameters
+    ----------
+    in_file : :obj:`str`
+        4D gzipped NIfTI file.
+    splits : :obj:`list` of (:obj:`str`, :obj:`int`) tuples
+        Output files and their number of volumes, in order from the first volume.
+        Volumes after the last range are dropped, and aren't decompressed.
+        An output may be ``in_file`` itself.
+    compresslevel : :obj:`int`, optional
+        gzip compression level for the outputs.
+    n_threads : :obj:`int`, optional
+        Compression threads per output.
+    """
+    with gzip.open(in_file, "rb") as f_in:
+        header = nb.Nifti1Header.from_fileobj(f_in)
+        shape = header.get_data_shape()
+        if len(shape) != 4:
+            raise ValueError(f"{in_file} is {len(shape)}D, not 4D")
+
+        if sum(n_vols for _, n_vols in splits) > shape[3]:
+            raise ValueError(f"{in_file} has {shape[3]} volumes, not {splits}")
+
+        offset = int(header["vox_offset"])
+        volume_bytes = int(np.prod(shape[:3])) * header.get_data_dtype().itemsize
+        f_in.seek(offset)
+
+        tmp_files = []
+        try:
+            for out_file, n_vols in splits:
+                tmp_file = f"{out_file}.{os.getpid()}.tmp"
+                tmp_files.append(tmp_file)
+                out_header = header.copy()
+                out_header.set_data_shape(shape[:3] + (n_vols,))
+                header_bytes = io.BytesIO()
+                out_header.write_to(header_bytes)
+                with ParallelGzipWriter(tmp_file, compresslevel, n_threads) as f_out:
+                    f_out.write(header_bytes.getvalue().ljust(offset, b"\0"))
+                    for _ in range(n_vols):
+                        volume = f_in.read(volume_bytes)
+                        if len(volume) != volume_bytes:
+                            raise ValueError(f"{in_file} is truncated")
+
+                        f_out.write(volume)
+        except BaseException:
+            for tmp_file in tmp_files:
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+            raise
+
+    for (out_file, _), tmp_file in zip(splits, tmp_files):
+        os.replace(tmp_file, out_file)
+
+
+def split_files(jobs, n_procs=None, compresslevel=1):
+    """Split several files at once.
+
+    Parameters
+    ----------
+    jobs : :obj:`list` of (:obj:`str`, :obj:`list`) tuples
+        Input files and their ``splits``, as for :func:`split_volumes`.
+    n_procs : :obj:`int`, optional
+        Files to split concurrently. Defaults to one per file, up to the number of CPUs.
+        The CPUs are divided between them for compression.
+
+    Returns
+    -------
+    failed : :obj:`list` of :obj:`str`
+        Input files that couldn't be split. Their outputs weren't written.
+    """
+    if not jobs:
+        return []
+
+    n_cpus = default_n_threads()
+    n_procs = n_procs or min(len(jobs), n_cpus)
+    n_threads = max(1, n_cpus // n_procs)
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_procs) as executor:
+        futures = {
+            executor.submit(split_volumes, in_file, splits, compresslevel, n_threads): in_file
+            for in_file, splits in jobs
+        }
+        for future in as_completed(futures):
+            in_file = futures[future]
+            try:
+                future.result()
+            except Exception as exc:
+                print(f"FAILED: {os.path.basename(in_file)}")
+                traceback.print_exception(exc)
+                failed.append(in_file)
+
+    return failed